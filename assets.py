@@ -0,0 +1,155 @@
+import hashlib
+import os
+import threading
+import time
+from base64 import b64encode
+
+import cv2
+
+import util
+
+"""
+In-memory cache of the guidance images sent to the client. Each image is read and encoded once per client profile, at
+startup or on first use, instead of every time a step returns it
+
+Profiles set the max width and height of the images sent and the JPEG quality. The format is chosen by file extension:
+JPEG files (photos, including tire-rim-legend.jpg) are sent as JPEG, so that they aren't blown up by lossless encoding,
+PNG files (e.g. tire-legend.png) as PNG. A profile without a JPEG quality sends every image as PNG
+"""
+
+photo_extensions = (".jpg", ".jpeg")  # images sent as JPEG, under profiles with a JPEG quality
+
+
+class Asset:
+    """
+    A guidance image, encoded the way it is sent to the client
+    """
+    def __init__(self, name, encoded, encode_time, cache=None, profile=None, image_format="png"):
+        """
+        :param name: file name in the resource directory
+        :param encoded: base64 of the encoded image
+        :param encode_time: seconds it took to read and encode the image
+        :param cache: AssetCache holding the image's encodings for other profiles
+        :param profile: client profile the image is encoded for
+        :param image_format: "png" or "jpeg"
+        """
+        self.name = name
+        self.encoded = encoded.decode("ascii")
+        self.digest = hashlib.sha1(encoded).hexdigest()  # identifies the image to clients that already have it
+        self.encode_time = encode_time
+        self.cache = cache
+        self.profile = profile
+        self.format = image_format
+
+    def for_profile(self, profile):
+        """
+        Returns the same image encoded for another client profile
+        """
+        if self.cache is None or self.cache.profile_name(profile) == self.profile:
+            return self
+        return self.cache.get(self.name, profile)
+
+    def size(self):
+        return len(self.encoded)
+
+
+class AssetCache:
+    """
+    Guidance images keyed by file name and client profile. Look ups of a file that can't be read return None, like
+    cv2.imread
+    """
+    def __init__(self, directory, profiles=None, default_profile="default"):
+        """
+        :param directory: of the image files
+        :param profiles: dict of profile name -> {"max_wh": max width and height or None for full size, "quality": JPEG
+                         quality (0 to 100) or None for PNG only}. None to send every image as full size PNG
+        :param default_profile: profile of clients that don't name one, or name one that doesn't exist
+        """
+        self.directory = directory
+        self.profiles = profiles or {default_profile: {"max_wh": None, "quality": None}}
+        self.default_profile = default_profile
+        self.assets = {}  # (file name, profile) -> Asset, or None if the file can't be read
+        self.lock = threading.Lock()
+        self.preloader = None  # thread of preload_in_background
+        self.hits = 0
+        self.time_saved = 0  # seconds of encoding saved by cache hits
+
+    def profile_name(self, profile):
+        return profile if profile in self.profiles else self.default_profile
+
+    def get(self, name, profile=None):
+        """
+        Returns the Asset of an image file for a client profile, loading it on first use
+        :param profile: name of the client's profile, None for the default one
+        """
+        key = (name, self.profile_name(profile))
+        with self.lock:
+            if key in self.assets:
+                asset = self.assets[key]
+                if asset is not None:
+                    self.hits += 1
+                    self.time_saved += asset.encode_time
+                return asset
+
+            asset = self.load(*key)
+            self.assets[key] = asset
+            return asset
+
+    def load(self, name, profile):
+        """
+        Read an image file, and scale it down and encode it for a client profile
+        """
+        start = time.time()
+        img = cv2.imread(os.path.join(self.directory, name))
+        if img is None:
+            return None
+        settings = self.profiles[profile]
+        max_wh = settings.get("max_wh")
+        if max_wh is not None and max(img.shape[:2]) > max_wh:
+            ratio = float(max_wh) / max(img.shape[:2])
+            size = (max(1, int(round(img.shape[1] * ratio))), max(1, int(round(img.shape[0] * ratio))))
+            img = cv2.resize(img, size, interpolation=cv2.INTER_AREA)
+
+        if settings.get("quality") is not None and name.lower().endswith(photo_extensions):
+            image_format, data = "jpeg", util.cv_image2raw_jpg(img, settings["quality"])
+        else:
+            image_format, data = "png", util.cv_image2raw_png(img)
+        return Asset(name, b64encode(data), time.time() - start, self, profile, image_format)
+
+    def preload(self, names=None):
+        """
+        Load images for the default profile ahead of their first use
+        :param names: of the files to load, defaults to every file in the directory
+        """
+        if names is None:
+            names = sorted(os.listdir(self.directory))
+        for name in names:
+            key = (name, self.default_profile)
+            with self.lock:
+                if key not in self.assets:
+                    self.assets[key] = self.load(*key)
+
+    def preload_in_background(self, names=None):
+        """
+        Load images ahead of their first use on a background thread, started once. Images looked up before they are
+        loaded are loaded on demand
+        """
+        with self.lock:
+            if self.preloader is not None:
+                return
+            # not a daemon: OpenCV aborts the process if it is still encoding at interpreter shutdown
+            self.preloader = threading.Thread(target=self.preload, args=(names,), name="preload")
+        self.preloader.start()
+
+    def stats(self):
+        """
+        Returns the number of cached images, their size in bytes, cache hits and seconds of encoding saved by them
+        """
+        with self.lock:
+            loaded = [asset for asset in self.assets.values() if asset is not None]
+            return {
+                "assets": len(loaded),
+                "bytes": sum(asset.size() for asset in loaded),
+                "hits": self.hits,
+                "encode_time_saved": round(self.time_saved, 3)
+            }
@@ -0,0 +1,72 @@
+"""
+Size and encoding cost of the guidance images for each client profile in config.GUIDANCE_IMAGE_PROFILES
+
+For every image in resources/images, encodes it for each profile with a cold assets.AssetCache, and measures the bytes
+of a response carrying it and the time responses.ResponseEncoder takes to build that response once the image is cached.
+The "lossless" profile is how every image was sent before profiles: full size PNG.
+
+Usage: python benchmarks/bench_assets.py [--repeat 50]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import assets
+import config
+import responses
+
+
+def main():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    parser = argparse.ArgumentParser(description="Size and encoding cost of the guidance images per client profile")
+    parser.add_argument("--images", default=os.path.join(root, "resources", "images"))
+    parser.add_argument("--repeat", type=int, default=50, help="responses built per image, for timing")
+    args = parser.parse_args()
+
+    profiles = config.GUIDANCE_IMAGE_PROFILES
+    names = sorted(os.listdir(args.images))
+    totals = {}
+    print("%-24s %-9s %6s %11s %11s %11s" % ("image", "profile", "format", "response KB", "encode ms",
+                                             "respond ms"))
+    for profile in sorted(profiles):
+        cache = assets.AssetCache(args.images, profiles)
+        encoder = responses.ResponseEncoder()
+        header = {"task_id": "bench", "image_profile": profile}
+        size = encode = respond = 0
+        for name in names:
+            asset = cache.get(name, profile)
+            if asset is None:
+                continue
+            instruction = {"image": asset}
+            result = encoder.encode(header, instruction, [])
+            start = time.time()
+            for _ in range(args.repeat):
+                encoder.encode(header, instruction, [])
+            respond_time = (time.time() - start) / args.repeat
+            print("%-24s %-9s %6s %11.1f %11.1f %11.2f" % (name, profile, asset.format, len(result) / 1024.0,
+                                                           asset.encode_time * 1000, respond_time * 1000))
+            size += len(result)
+            encode += asset.encode_time
+            respond += respond_time
+        totals[profile] = (size, encode, respond)
+
+    print()
+    print("%-9s %13s %13s %13s" % ("profile", "response KB", "encode ms", "respond ms"))
+    base = totals.get("lossless")
+    for profile in sorted(totals):
+        size, encode, respond = totals[profile]
+        line = "%-9s %13.1f %13.1f %13.2f" % (profile, size / 1024.0, encode * 1000, respond * 1000)
+        if base is not None and profile != "lossless":
+            line += "   %.1fx smaller, %.1fx faster to encode, %.1fx faster to respond" % (
+                base[0] / float(size), base[1] / encode, base[2] / respond)
+        print(line)
+    print("(totals over %d images, one response each)" % len(names))
+
+
+if __name__ == "__main__":
+    main()
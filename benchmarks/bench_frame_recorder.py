@@ -0,0 +1,135 @@
+"""
+Timing comparison of car_task.FrameRecorder against the original deque based one
+
+Feeds both recorders the same sequence of jittering boxes, with occasional jumps and class changes, checking that they
+agree on stability and the averaged bbox at every frame, and times add_and_check_stable, averaged_bbox and
+averaged_class for a few window sizes. The original averaged_class counts classes in a de-duplicated list, so it returns
+an arbitrary class of the window rather than the most frequent one; it is timed but not compared.
+
+Usage: python benchmarks/bench_frame_recorder.py [--frames 20000]
+"""
+from __future__ import print_function
+
+import argparse
+import os
+import random
+import sys
+import time
+from collections import deque
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import car_task
+
+sizes = [5, 15, 60]
+classes = ["thin_wheel_side", "thick_wheel_side", "wrong_wheel"]
+
+
+class ReferenceFrameRecorder:
+    """
+    Original FrameRecorder, kept as the reference
+    """
+    def __init__(self, size):
+        self.deque = deque()
+        self.size = size
+
+    def add(self, obj):
+        self.deque.append(obj)
+        if len(self.deque) > self.size:
+            self.deque.popleft()
+
+    def is_center_stable(self):
+        if len(self.deque) != self.size:
+            return False
+        prev_frame = self.deque[0]
+        for i in range(1, len(self.deque)):
+            frame = self.deque[i]
+            if car_task.bbox_diff(frame["dimensions"], prev_frame["dimensions"]) > car_task.stable_threshold:
+                return False
+            prev_frame = frame
+        return True
+
+    def add_and_check_stable(self, obj):
+        self.add(obj)
+        return self.is_center_stable()
+
+    def averaged_bbox(self):
+        out = [0, 0, 0, 0]
+        for i in range(len(self.deque)):
+            dim = self.deque[i]["dimensions"]
+            for u in range(len(dim)):
+                out[u] += dim[u]
+        return [v / len(self.deque) for v in out]
+
+    def averaged_class(self):
+        all_class = []
+        for i in range(len(self.deque)):
+            if self.deque[i]["class_name"] not in all_class:
+                all_class.append(self.deque[i]["class_name"])
+        return max(set(all_class), key=all_class.count)
+
+
+def detections(count):
+    """
+    Returns a sequence of detected objects of a part held mostly still
+    """
+    random.seed(0)
+    x, y = 300.0, 200.0
+    out = []
+    for _ in range(count):
+        if random.random() < 0.02:
+            x, y = random.uniform(100, 500), random.uniform(100, 300)  # jump, unstable for a window
+        x += random.uniform(-8, 8)
+        y += random.uniform(-8, 8)
+        class_name = classes[0] if random.random() < 0.8 else random.choice(classes)
+        out.append({"class_name": class_name, "dimensions": [x, y, x + 120.0, y + 90.0], "confidence": 0.9})
+    return out
+
+
+def run(recorder, objs):
+    """
+    Returns the time per frame of add_and_check_stable, averaged_bbox and averaged_class, and the results per frame
+    """
+    stable, bboxes = [], []
+    start = time.time()
+    for obj in objs:
+        stable.append(recorder.add_and_check_stable(obj))
+    check_time = time.time() - start
+
+    start = time.time()
+    for _ in objs:
+        bboxes.append(recorder.averaged_bbox())
+    bbox_time = time.time() - start
+
+    start = time.time()
+    for _ in objs:
+        recorder.averaged_class()
+    class_time = time.time() - start
+    return [t / len(objs) * 1e6 for t in (check_time, bbox_time, class_time)], stable
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Timing comparison of FrameRecorder")
+    parser.add_argument("--frames", type=int, default=20000)
+    args = parser.parse_args()
+
+    objs = detections(args.frames)
+    print("%-6s %-10s %14s %14s %14s" % ("size", "recorder", "add+check us", "avg bbox us", "avg class us"))
+    for size in sizes:
+        results = {}
+        for name, recorder in (("original", ReferenceFrameRecorder(size)), ("ring", car_task.FrameRecorder(size))):
+            times, stable = run(recorder, objs)
+            results[name] = stable
+            print("%-6d %-10s %14.2f %14.2f %14.2f" % ((size, name) + tuple(times)))
+
+        # per frame agreement, including the averaged bbox of each window
+        reference, ring = ReferenceFrameRecorder(size), car_task.FrameRecorder(size)
+        for obj in objs:
+            assert reference.add_and_check_stable(obj) == ring.add_and_check_stable(obj)
+            assert max(abs(a - b) for a, b in zip(reference.averaged_bbox(), ring.averaged_bbox())) < 1e-6
+        assert results["original"] == results["ring"]
+    print("stability and averaged bbox agree at every frame")
+
+
+if __name__ == "__main__":
+    main()
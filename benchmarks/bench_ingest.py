@@ -0,0 +1,96 @@
+"""
+Ingest cost of a frame at each config.IMAGE_MAX_WH cap
+
+Takes frames of the bundled videos scaled up to phone camera size, and for each cap measures the decode time of
+frame.Frame, the bytes uploaded to TPOD and the detection time, which includes re-encoding the reduced frame and the
+round trip to the stand-in TPOD server of benchmarks/replay.py (it answers a fixed box, so this is upload and HTTP, not
+a model). Also checks that the detected box comes back in full size coordinates.
+
+Usage: python benchmarks/bench_ingest.py [--width 1920 --height 1080] [--frames 60]
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cv2
+import numpy as np
+
+import frame
+import object_detection
+import util
+from replay import ScriptedTPOD
+
+caps = [None, 1280, 960, 640, 480, 320]
+box = [0.25, 0.3, 0.5, 0.7]  # normed box the stand-in server answers
+
+
+def phone_frames(directory, count, width, height):
+    """
+    Returns frames of the videos in a directory, scaled to width x height and JPEG encoded like the phone sends them
+    """
+    out = []
+    paths = sorted(glob.glob(os.path.join(directory, "*.mp4")))
+    for path in paths:
+        capture = cv2.VideoCapture(path)
+        for _ in range(max(1, count // len(paths))):
+            ok, img = capture.read()
+            if not ok:
+                break
+            out.append(util.cv_image2raw_jpg(cv2.resize(img, (width, height), interpolation=cv2.INTER_CUBIC), 90))
+        capture.release()
+    return out[:count]
+
+
+def main():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    parser = argparse.ArgumentParser(description="Ingest cost of a frame at each IMAGE_MAX_WH cap")
+    parser.add_argument("--videos", default=os.path.join(root, "resources", "videos"))
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=60)
+    args = parser.parse_args()
+
+    frames = phone_frames(args.videos, args.frames, args.width, args.height)
+    server = ScriptedTPOD({"bench": [["bench_object", box, 0.9]]}, {"bench": {"bench_object"}}, lambda: "bench")
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    client = object_detection.TPODClient()
+    url = server.url("bench")
+    expected = [box[0] * args.width, box[1] * args.height, box[2] * args.width, box[3] * args.height]
+
+    print("%d frames of %dx%d, %.0f KB JPEG on average" %
+          (len(frames), args.width, args.height, np.mean([len(data) for data in frames]) / 1024.0))
+    print("%-6s %-10s %11s %11s %13s %11s" % ("cap", "decoded", "decode ms", "upload KB", "detect ms", "box error"))
+    for cap in caps:
+        decode, upload, round_trip, error = [], [], [], []
+        for data in frames:
+            img = frame.Frame(data, max_wh=cap)
+            start = time.time()
+            img.image()
+            decode.append(time.time() - start)
+
+            server.shape = img.shape()
+            start = time.time()
+            img_encoded, _ = object_detection.encode_for_tpod(img)
+            detected = object_detection.tpod_request(img, url, client)
+            round_trip.append(time.time() - start)
+            upload.append(len(img_encoded))
+            error.append(max(abs(a - b) for a, b in zip(detected[0]["dimensions"], expected)))
+
+        shape = img.shape()
+        print("%-6s %-10s %11.2f %11.1f %13.2f %9.1fpx" %
+              (cap or "full", "%dx%d" % (shape[1], shape[0]), np.median(decode) * 1000, np.mean(upload) / 1024.0,
+               np.median(round_trip) * 1000, max(error)))
+    server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,91 @@
+"""
+Frame throughput of the proxy's CPU heavy frame work against the number of offload worker processes
+
+Takes frames of the bundled videos scaled up to phone camera size, and has DETECTION_WORKERS threads (the detection
+stage) decode each of them as frame.Frame, capped at IMAGE_MAX_WH, and re-encode it as JPEG for TPOD, as the proxy does.
+With 0 workers everything runs in the threads, otherwise in an offload.ProcessPool. Also checks that the pool decodes
+the same images as the threads.
+
+Usage: python benchmarks/bench_offload.py [--width 1920 --height 1080] [--frames 200] [--workers 0 1 2 4]
+"""
+from __future__ import print_function
+
+import argparse
+import multiprocessing
+import os
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import numpy as np
+
+import config
+import frame
+import offload
+from bench_ingest import phone_frames
+
+
+def throughput(frames, threads, pool):
+    """
+    Returns the frames per second decoded and re-encoded by a number of threads, sharing the frames
+    """
+    remaining = list(frames)
+    lock = threading.Lock()
+
+    def work():
+        while True:
+            with lock:
+                if not remaining:
+                    return
+                data = remaining.pop()
+            img = frame.Frame(data, config.ROTATE_IMAGE, config.RESIZE_IMAGE, config.IMAGE_MAX_WH, pool)
+            img.image()
+            img.jpeg()
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    start = time.time()
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    return len(frames) / (time.time() - start)
+
+
+def main():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    cores = multiprocessing.cpu_count()
+    parser = argparse.ArgumentParser(description="Frame throughput against offload worker processes")
+    parser.add_argument("--videos", default=os.path.join(root, "resources", "videos"))
+    parser.add_argument("--width", type=int, default=1920)
+    parser.add_argument("--height", type=int, default=1080)
+    parser.add_argument("--frames", type=int, default=200)
+    parser.add_argument("--threads", type=int, default=config.DETECTION_WORKERS)
+    parser.add_argument("--workers", type=int, nargs="+", default=sorted({0, 1, 2, 4, cores}))
+    args = parser.parse_args()
+
+    frames = phone_frames(args.videos, args.frames, args.width, args.height)
+    slot_bytes = args.width * args.height * 3
+    print("%d frames of %dx%d, %d threads, %d cores" % (len(frames), args.width, args.height, args.threads, cores))
+    print("%-8s %12s %9s" % ("workers", "frames/s", "speedup"))
+    base = None
+    for workers in args.workers:
+        pool = offload.new_pool(workers, slot_bytes)
+        try:
+            if pool is not None:
+                for data in frames[:10]:
+                    local = frame.Frame(data, max_wh=config.IMAGE_MAX_WH)
+                    offloaded = frame.Frame(data, max_wh=config.IMAGE_MAX_WH, pool=pool)
+                    assert np.array_equal(local.image(), offloaded.image())
+            throughput(frames[:10], args.threads, pool)  # warm up
+            rate = throughput(frames, args.threads, pool)
+        finally:
+            if pool is not None:
+                pool.close()
+        base = base or rate
+        print("%-8d %12.1f %8.2fx" % (workers, rate, rate / base))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,117 @@
+"""
+Timing comparison of the pink gear orientation check in car_task.Task.insert_pink_gear_back
+
+Crops gear sized regions out of the pink_gear_*.jpg resources, scaled to a 640 px wide frame, and runs both the original
+per-pixel loops and car_task.more_dark_pixels_up on them, checking that they make the same decision.
+
+Usage: python benchmarks/bench_pink_gear.py
+"""
+from __future__ import print_function
+
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import cv2
+
+import car_task
+
+images = ["pink_gear_1.jpg", "pink_gear_2.jpg"]
+crop_sizes = [40, 80, 120]
+frame_width = 640
+
+
+def reference_dark_pixels_up(img):
+    """
+    Original insert_pink_gear_back image processing, kept as the reference decision
+    """
+    # resize (unclear if this matters)
+    scale_percent = 400
+    width = int(img.shape[1] * scale_percent / 100)
+    height = int(img.shape[0] * scale_percent / 100)
+    dim = (width, height)
+    img = cv2.resize(img, dim, interpolation=cv2.INTER_AREA)
+
+    # cut black parts from the up
+    throw_out_cols_cap = 0
+    for y in range(img.shape[0]):
+        white_pixels = 0
+        for x in range(img.shape[1]):
+            if not car_task.check_dark_pixel(img[y][x], car_task.dark_pixel_threshold):
+                white_pixels += 1
+        if float(white_pixels) / float(img.shape[1]) > car_task.pink_gear_side_threshold:
+            break
+        else:
+            throw_out_cols_cap = y
+    img = img[throw_out_cols_cap:, 0:img.shape[1]]
+
+    # cut black parts from the down
+    for y in reversed(range(img.shape[0])):
+        white_pixels = 0
+        for x in reversed(range(img.shape[1])):
+            if not car_task.check_dark_pixel(img[y][x], car_task.dark_pixel_threshold):
+                white_pixels += 1
+        if float(white_pixels) / float(img.shape[1]) > car_task.pink_gear_side_threshold:
+            break
+        else:
+            throw_out_cols_cap = y
+    img = img[0:throw_out_cols_cap, 0:img.shape[1]]
+
+    # count dark pixels for left and right side of the screen
+    height = img.shape[0]
+    midpoint = height // 2
+
+    up_dark_pixels = 0
+    down_dark_pixels = 0
+    for x in range(img.shape[1]):
+        for y in range(img.shape[0]):
+            if y <= midpoint:
+                if car_task.check_dark_pixel(img[y][x], car_task.dark_pixel_threshold):
+                    up_dark_pixels += 1
+            else:
+                if car_task.check_dark_pixel(img[y][x], car_task.dark_pixel_threshold):
+                    down_dark_pixels += 1
+    return up_dark_pixels > down_dark_pixels
+
+
+def crops(frame, size):
+    """
+    Gear sized crops around the center of the frame and shifted from it
+    """
+    rows, cols = frame.shape[:2]
+    for dx, dy in [(0, 0), (-size // 2, 0), (size // 2, 0), (0, -size // 2), (0, size // 2)]:
+        x = cols // 2 + dx - size // 2
+        y = rows // 2 + dy - size // 2
+        yield frame[y:y + size, x:x + size]
+
+
+def main():
+    print("%18s %6s %14s %14s %9s" % ("image", "crop", "reference ms", "vectorized ms", "speedup"))
+    for name in images:
+        frame = cv2.imread(os.path.join(car_task.resources, name))
+        frame = cv2.resize(frame, (frame_width, frame.shape[0] * frame_width // frame.shape[1]))
+
+        for size in crop_sizes:
+            reference = 0
+            vectorized = 0
+            for crop in crops(frame, size):
+                gray = cv2.cvtColor(crop, cv2.COLOR_RGB2GRAY)
+
+                start = time.time()
+                expected = reference_dark_pixels_up(gray)
+                reference += time.time() - start
+
+                start = time.time()
+                actual = car_task.more_dark_pixels_up(gray)
+                vectorized += time.time() - start
+
+                assert expected == actual, "decisions differ for %s crop %d" % (name, size)
+
+            print("%18s %6d %14.2f %14.3f %8.0fx" % (name, size, reference / 5 * 1000, vectorized / 5 * 1000,
+                                                      reference / vectorized))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,114 @@
+"""
+Startup time of the proxy's frame processing, up to the first frame answered
+
+Starts fresh Python processes that import the task's modules, create the Task and its Detector, and answer one frame
+the way CarApp.handle does (frame.Frame, Task.prefetch, Task.get_instruction and responses.ResponseEncoder), on a step
+that sends it to the classifiers. Detection is answered by the stand-in TPOD server of benchmarks/replay.py, running in
+this process so that its startup isn't counted. Nothing in the startup path needs the network or Docker, so this also
+runs offline.
+
+Usage: python benchmarks/bench_startup.py [--runs 5] [--init-state layout_wheel_rim_1]
+"""
+from __future__ import print_function
+
+import time
+
+started = time.time()  # process start, for the child processes' measurements
+
+import argparse
+import json
+import os
+import subprocess
+import sys
+import tempfile
+import threading
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+phases = ["interpreter", "imports", "setup", "first_frame", "total"]
+
+
+def child(frame_path, tpod_port, init_state):
+    """
+    Answer one frame in this fresh process, and print the time each startup phase took as JSON
+    """
+    import config
+    import car_task
+    import frame
+    import responses
+    imported = time.time()
+
+    config.TPOD_ENDPOINTS = {}  # every classifier is pointed at the stand-in server
+    task = car_task.Task(init_state=init_state)
+    task.detector.pool.endpoints.update((image_id, "http://127.0.0.1:%d/%s" % (tpod_port, image_id))
+                                        for image_id in task.detector.docker_image_to_objs)
+    encoder = responses.ResponseEncoder()
+    ready = time.time()
+
+    with open(frame_path, "rb") as f:
+        img = frame.Frame(f.read(), config.ROTATE_IMAGE, config.RESIZE_IMAGE, config.IMAGE_MAX_WH)
+    task.prefetch(img, 1)
+    viz_objects, instruction = task.get_instruction(img, {"task_id": "startup"}, 1)
+    encoder.encode({"task_id": "startup"}, instruction, viz_objects)
+    answered = time.time()
+
+    print(json.dumps({"started": started, "imports": imported - started, "setup": ready - imported,
+                      "first_frame": answered - ready}))
+
+
+def main():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    parser = argparse.ArgumentParser(description="Startup time up to the first frame answered")
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--init-state", default="layout_wheel_rim_1", help="step the first frame is answered on")
+    parser.add_argument("--videos", default=os.path.join(root, "resources", "videos"))
+    parser.add_argument("--script", default=os.path.join(root, "benchmarks", "replay_script.json"))
+    parser.add_argument("--child", nargs=2, metavar=("FRAME", "PORT"), help=argparse.SUPPRESS)
+    args = parser.parse_args()
+    if args.child:
+        child(args.child[0], int(args.child[1]), args.init_state)
+        return
+
+    import object_detection
+    from replay import ScriptedTPOD, video_frames
+
+    with open(args.script) as f:
+        script = json.load(f)
+    registry = object_detection.Detector(None, endpoints={}).docker_image_to_objs
+    server = ScriptedTPOD(script, registry, lambda: args.init_state)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    data = next(video_frames(args.videos, 640, 360))
+    server.shape = (360, 640, 3)
+    frame_file = tempfile.NamedTemporaryFile(suffix=".jpg", delete=False)
+    frame_file.write(data)
+    frame_file.close()
+
+    timings = dict((phase, []) for phase in phases)
+    try:
+        for _ in range(args.runs):
+            spawned = time.time()
+            output = subprocess.check_output([sys.executable, os.path.abspath(__file__), "--init-state",
+                                              args.init_state, "--child", frame_file.name,
+                                              str(server.server_address[1])], cwd=root)
+            finished = time.time()
+            result = json.loads(output.decode("utf-8").strip().splitlines()[-1])
+            result["interpreter"] = result["started"] - spawned
+            result["total"] = finished - spawned
+            for phase in phases:
+                timings[phase].append(result[phase])
+    finally:
+        os.remove(frame_file.name)
+        server.shutdown()
+
+    print("%d runs, first frame on %s" % (args.runs, args.init_state))
+    print("%-12s %8s %8s  (ms)" % ("phase", "median", "max"))
+    for phase in phases:
+        values = sorted(timings[phase])
+        print("%-12s %8.1f %8.1f" % (phase, values[len(values) // 2] * 1000, values[-1] * 1000))
+
+
+if __name__ == "__main__":
+    main()
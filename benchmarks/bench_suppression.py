@@ -0,0 +1,110 @@
+"""
+Benchmark of the overlapping bounding box suppression in object_detection.tpod_request
+
+Compares object_detection.suppress_overlapping against the original one-box-at-a-time list implementation on random
+detections, and checks that both give the same output. Detections are drawn from a mix of classes, and from a single
+class where every box competes with every other.
+
+Usage: python benchmarks/bench_suppression.py
+"""
+from __future__ import print_function
+
+import os
+import random
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+import object_detection
+
+box_counts = [10, 30, 100, 300, 1000]
+class_names = ["thin_wheel_side", "thick_wheel_side", "thin_rim_side", "thick_rim_side", "hole_green", "hole_gold",
+               "hole_empty", "front_gear_good", "front_gear_bad", "gear_on_axle"]
+shape = (480, 640, 3)
+
+
+def reference_suppression(converted, shape):
+    """
+    Original tpod_request suppression, kept as the reference output
+    """
+    detected_objects = []
+
+    by_class = {}
+    for obj_list_form in converted:
+        class_name = object_detection.group_class_names(obj_list_form[0])
+        if class_name not in by_class.keys():
+            by_class[class_name] = []
+
+        # norm dimensions field
+        norm = obj_list_form[1][:]
+        norm[0] /= shape[1]
+        norm[2] /= shape[1]
+        norm[1] /= shape[0]
+        norm[3] /= shape[0]
+
+        intermediate = {"class_name": obj_list_form[0], "dimensions": obj_list_form[1],
+                        "confidence": obj_list_form[2], "norm": norm}
+
+        # wipe intersecting bounding boxes for same class or certain groups of classes
+        conflicts = [x for x in by_class[class_name] if object_detection.intersecting_objs(intermediate, x)]
+        non_conflicts = [x for x in by_class[class_name] if x not in conflicts]
+
+        highest_confidence_obj = intermediate
+        for other in conflicts:
+            if other["confidence"] > highest_confidence_obj["confidence"]:
+                highest_confidence_obj = other
+
+        filtered = [x for x in conflicts if not object_detection.intersecting_objs(highest_confidence_obj, x)]
+        resolved = non_conflicts + filtered + [highest_confidence_obj]
+
+        by_class[class_name] = resolved
+
+    for class_name in by_class:
+        for obj in by_class[class_name]:
+            detected_objects.append({
+                "class_name": obj["class_name"],
+                "dimensions": obj["dimensions"],
+                "confidence": obj["confidence"],
+                "norm": obj["norm"]})
+
+    return detected_objects
+
+
+def random_detections(count, rng, classes=class_names):
+    """
+    Random TPOD style detections, boxes sized like parts in a 640x480 frame so that many of them overlap
+    """
+    converted = []
+    for _ in range(count):
+        x = rng.uniform(0, shape[1] - 20)
+        y = rng.uniform(0, shape[0] - 20)
+        w = rng.uniform(10, 120)
+        h = rng.uniform(10, 120)
+        converted.append([rng.choice(classes), [x, y, min(x + w, shape[1]), min(y + h, shape[0])],
+                          round(rng.uniform(0.5, 1.0), 3)])
+    return converted
+
+
+def main():
+    rng = random.Random(0)
+    for title, classes in [("mixed classes", class_names), ("single class", class_names[:1])]:
+        print(title)
+        print("%8s %14s %14s %9s %6s" % ("boxes", "reference ms", "vectorized ms", "speedup", "kept"))
+        for count in box_counts:
+            converted = random_detections(count, rng, classes)
+
+            expected = reference_suppression(converted, shape)
+            actual = object_detection.suppress_overlapping(converted, shape)
+            assert expected == actual, "outputs differ for %d boxes" % count
+
+            number = max(1, 2000 // count)
+            reference = min(timeit.repeat(lambda: reference_suppression(converted, shape), number=number, repeat=3))
+            vectorized = min(timeit.repeat(lambda: object_detection.suppress_overlapping(converted, shape),
+                                           number=number, repeat=3))
+            print("%8d %14.3f %14.3f %8.1fx %6d" % (count, reference / number * 1000, vectorized / number * 1000,
+                                                     reference / vectorized, len(actual)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,258 @@
+"""
+Offline end-to-end replay of the proxy's frame processing
+
+Decodes the bundled resources/videos/*.mp4 as the camera stream and runs every frame through the same path as
+CarApp.handle: frame.Frame, Task.prefetch and Task.get_instruction, and responses.ResponseEncoder. Detection is
+answered by a local stand-in TPOD HTTP server with the scripted detections of the task's current state
+(benchmarks/replay_script.json, boxes normed to 0 to 1), so no phone, Gabriel server, Docker or GPU is needed.
+
+The task runs on a clock advanced by one frame interval per frame, so delays and timed steps take as many frames as
+they would with a live camera, without waiting for them. A state that doesn't advance within --step-timeout frames is
+skipped to the next one and reported.
+
+Usage: python benchmarks/replay.py [--frames N] [--fps 30] [--width 640 --height 360]
+                                  [--detector-mode record|replay --trace detections.jsonl]
+"""
+from __future__ import print_function
+
+import argparse
+import glob
+import json
+import os
+import socket
+import sys
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), ".."))
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+
+import cv2
+import numpy as np
+
+import config
+import car_task
+import frame
+import metrics
+import responses
+import util
+
+stages = ["decode", "detect", "step", "encode"]
+
+
+class ScriptedTPOD(ThreadingMixIn, HTTPServer):
+    """
+    Stand-in TPOD server. Answers POST /<classifier image ID>/detect with the scripted detections of the task's current
+    state that the classifier detects
+    """
+    daemon_threads = True
+
+    def __init__(self, script, classifier_objs, state):
+        """
+        :param script: dict of state -> list of [class name, normed bounding box, confidence]
+        :param classifier_objs: dict of classifier image ID -> objects it detects
+        :param state: function returning the task's current state
+        """
+        HTTPServer.__init__(self, ("127.0.0.1", 0), ScriptedTPODHandler)
+        self.script = script
+        self.classifier_objs = classifier_objs
+        self.state = state
+        self.shape = None  # of the frames sent, to scale the normed boxes
+
+    def detections(self, image_id):
+        height, width = self.shape[:2]
+        out = []
+        for class_name, box, confidence in self.script.get(self.state(), []):
+            if class_name in self.classifier_objs.get(image_id, ()):
+                out.append([class_name, [box[0] * width, box[1] * height, box[2] * width, box[3] * height], confidence])
+        return out
+
+    def url(self, image_id):
+        return "http://127.0.0.1:%d/%s" % (self.server_address[1], image_id)
+
+
+class ScriptedTPODHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, like the real classifiers
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        # headers and body go out in separate writes, don't let them wait on the client's delayed ACK
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+    def do_POST(self):
+        self.rfile.read(int(self.headers.get("Content-Length", 0)))
+        image_id = self.path.strip("/").split("/")[0]
+        body = json.dumps(self.server.detections(image_id)).encode("ascii")
+        self.send_response(200)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def log_message(self, *args):
+        pass
+
+
+class ReplayClock:
+    """
+    Clock of the task, advanced by one frame interval per frame
+    """
+    def __init__(self, fps):
+        self.now = time.time()
+        self.interval = 1.0 / fps
+
+    def __call__(self):
+        return self.now
+
+    def tick(self):
+        self.now += self.interval
+
+
+def video_frames(directory, width, height):
+    """
+    Yields the frames of every video in a directory, JPEG encoded at the client's resolution like the phone sends them
+    """
+    for path in sorted(glob.glob(os.path.join(directory, "*.mp4"))):
+        capture = cv2.VideoCapture(path)
+        while True:
+            ok, img = capture.read()
+            if not ok:
+                break
+            img = cv2.resize(img, (width, height))
+            yield util.cv_image2raw_jpg(img, 90)
+        capture.release()
+
+
+def percentiles(samples):
+    if not samples:
+        return "-"
+    p50, p95, p99 = np.percentile(np.array(samples) * 1000, [50, 95, 99])
+    return "%8.2f %8.2f %8.2f" % (p50, p95, p99)
+
+
+def main():
+    root = os.path.join(os.path.dirname(os.path.abspath(__file__)), "..")
+    parser = argparse.ArgumentParser(description="Offline end-to-end replay of the proxy's frame processing")
+    parser.add_argument("--videos", default=os.path.join(root, "resources", "videos"))
+    parser.add_argument("--script", default=os.path.join(root, "benchmarks", "replay_script.json"))
+    parser.add_argument("--frames", type=int, default=0, help="max frames to replay, 0 for all, looping videos")
+    parser.add_argument("--fps", type=float, default=30, help="frame rate of the replayed camera")
+    parser.add_argument("--width", type=int, default=640)
+    parser.add_argument("--height", type=int, default=360)
+    parser.add_argument("--step-timeout", type=int, default=900, help="frames before a stuck state is skipped")
+    parser.add_argument("--init-state", default=None)
+    parser.add_argument("--detector-mode", default="live", choices=["live", "record", "replay"],
+                        help="record the stand-in's responses to --trace, or replay them from it to profile the task alone")
+    parser.add_argument("--trace", default="detections.jsonl")
+    args = parser.parse_args()
+
+    with open(args.script) as f:
+        script = json.load(f)
+
+    clock = ReplayClock(args.fps)
+    task = None
+    server = ScriptedTPOD(script, {}, lambda: task.current_state)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+
+    config.TPOD_ENDPOINTS = {}  # every classifier of the registry is pointed at the stand-in server below
+    config.PRELOAD_ASSETS = True
+    config.DETECTOR_MODE = args.detector_mode
+    config.DETECTOR_TRACE = args.trace
+    task = car_task.Task(init_state=args.init_state, clock=clock)
+    registry = task.detector.docker_image_to_objs
+    server.classifier_objs = registry
+    task.detector.pool.endpoints.update((image_id, server.url(image_id)) for image_id in registry)
+    encoder = responses.ResponseEncoder()
+    header = {"task_id": "replay"}
+
+    timings = dict((stage, []) for stage in stages)
+    totals = []
+    transitions = []  # (state, frames, seconds of task time, seconds of wall time, skipped)
+    state, state_frames, state_start, state_wall = task.current_state, 0, clock(), time.time()
+    processed = drained = frame_id = 0
+    start = time.time()
+
+    while args.frames == 0 or frame_id < args.frames:
+        for data in video_frames(args.videos, args.width, args.height):
+            if args.frames and frame_id >= args.frames:
+                break
+            frame_id += 1
+            clock.tick()
+
+            t0 = time.time()
+            if task.is_deferred():
+                encoder.encode(header, None, None)
+                drained += 1
+                continue
+
+            img = frame.Frame(data, config.ROTATE_IMAGE, config.RESIZE_IMAGE, config.IMAGE_MAX_WH)
+            server.shape = img.shape()
+            t1 = time.time()
+            task.prefetch(img, frame_id)
+            t2 = time.time()
+            viz_objects, instruction = task.get_instruction(img, header, frame_id)
+            t3 = time.time()
+            encoder.encode(header, instruction, viz_objects)
+            t4 = time.time()
+
+            processed += 1
+            for stage, seconds in zip(stages, (t1 - t0, t2 - t1, t3 - t2, t4 - t3)):
+                timings[stage].append(seconds)
+            totals.append(t4 - t0)
+
+            state_frames += 1
+            skipped = state_frames >= args.step_timeout and task.current_state == state
+            if skipped:
+                index = car_task.step_sequence.index(state)
+                task.current_state = car_task.step_sequence[(index + 1) % len(car_task.step_sequence)]
+            if task.current_state != state:
+                transitions.append((state, state_frames, clock() - state_start, time.time() - state_wall, skipped))
+                state, state_frames, state_start, state_wall = task.current_state, 0, clock(), time.time()
+        if frame_id == 0:
+            sys.exit("no frames in %s" % args.videos)
+        if args.frames == 0:
+            break
+
+    elapsed = time.time() - start
+    server.shutdown()
+
+    print("replayed %d frames in %.1f s: %d processed (%.1f fps), %d drained while deferred" %
+          (frame_id, elapsed, processed, processed / elapsed, drained))
+    print()
+    print("%-8s %8s %8s %8s  (ms)" % ("stage", "p50", "p95", "p99"))
+    for stage in stages:
+        print("%-8s %s" % (stage, percentiles(timings[stage])))
+    print("%-8s %s" % ("total", percentiles(totals)))
+    print()
+    print("%-28s %7s %9s %9s" % ("state", "frames", "task s", "wall s"))
+    for name, frames, task_seconds, wall_seconds, skipped in transitions:
+        print("%-28s %7d %9.2f %9.2f%s" % (name, frames, task_seconds, wall_seconds, "  skipped" if skipped else ""))
+    print("%-28s %7d (current)" % (state, state_frames))
+    print()
+    print("TPOD connections: %s" % task.detector.tpod.stats())
+    print("detection batches: %s" % task.detector.scheduler.stats())
+    if task.detector.trace is not None:
+        print("detection trace: %s" % task.detector.trace.stats())
+    print("detection cache: %s" % task.detector.cache.stats())
+    if task.motion_gate is not None:
+        print("motion gate: %s, reused detections: %s" % (task.motion_gate.stats(), task.detector.reuse_stats))
+    if task.tracker is not None:
+        print("tracking: %s" % task.tracker.stats())
+    print("assets: %s" % car_task.guidance_assets.stats())
+    print("latency: %s" % metrics.summary())
+
+
+if __name__ == "__main__":
+    main()
@@ -35,6 +35,7 @@ from optparse import OptionParser
 
 import config
 import cv2
+import eventlog
 import gabriel
 import gabriel.proxy
 import car_task_stream
@@ -80,6 +81,7 @@ class CarApp(gabriel.proxy.CognitiveProcessThread):
         super(CarApp, self).__init__(image_queue, output_queue, engine_id)
         self.is_first_image = True
         self.first_n_cnt = 0
+        self.frame_count = 0
         self.last_msg = ""
         self.dup_msg_cnt = 0
         # task initialization
@@ -116,9 +118,6 @@ class CarApp(gabriel.proxy.CognitiveProcessThread):
 
     def handle(self, header, data):
         # PERFORM Cognitive Assistance Processing
-        LOG.info("processing: ")
-        LOG.info("%s\n" % header)
-
         rtn_data = {}
 
         if self.first_n_cnt < 10:
@@ -141,8 +140,11 @@ class CarApp(gabriel.proxy.CognitiveProcessThread):
         vis_objects, instruction = self.task.get_instruction(objects, header)
         header['status'] = 'success'
 
-        print("object detection result: %s" % [obj["class_name"] for obj in objects])
-        LOG.info("object detection result: %s" % objects)
+        self.frame_count += 1
+        if eventlog.sampled():
+            eventlog.record({"event": "frame", "session": header.get("task_id", None), "frame_id": self.frame_count,
+                             "labels": [obj["class_name"] for obj in objects],
+                             "speech": instruction.get("speech", None) if instruction else None})
 
         rtn_data["viz_obj"] = json.dumps(objects)
 
@@ -179,6 +181,11 @@ if __name__ == "__main__":
     result_pub.start()
     result_pub.isDaemon = True
 
+    # sampled log of per-frame decisions
+    if config.EVENT_LOG is not None:
+        eventlog.start(config.EVENT_LOG, config.EVENT_LOG_SAMPLE_RATE, config.EVENT_LOG_MAX_BYTES,
+                       config.EVENT_LOG_BACKUPS)
+
     try:
         while True:
             time.sleep(1)
@@ -192,4 +199,6 @@ if __name__ == "__main__":
         if car_app is not None:
             car_app.terminate()
         result_pub.terminate()
+        if eventlog.events is not None:
+            eventlog.events.stop()
 
@@ -2,11 +2,18 @@ import math
 import time
 from collections import defaultdict, deque
 import cv2
+import numpy as np
 import os
-from requests import get
+import threading
 
+import assets
 import config
+import frame
+import metrics
+import motion
 import object_detection
+import tracking
+import util
 
 """
 This file contains the Task object for the model car kit, which handles all processing of a frame, that is:
@@ -15,11 +22,11 @@ This file contains the Task object for the model car kit, which handles all proc
 3. Additional features such as stable frame detection
 """
 
-ip = get('https://api.ipify.org').text
-
 resources = os.path.abspath("resources/images")  # for images, which are sent directly from this library
-video_url = "http://" + ip + ":9095/"  # for videos, which are accessed from a separate resource server
-tpod_url = "http://0.0.0.0:8000"  # object detection classifier URL
+guidance_assets = assets.AssetCache(resources, config.GUIDANCE_IMAGE_PROFILES)  # images read and encoded once
+video_host = None  # address the video server is advertised at, resolved on first use
+video_host_lock = threading.Lock()
+tpod_url = "http://0.0.0.0:8000"  # object detection classifier URL, additional classifiers use the following ports
 
 #  max Euclidean distance between consecutive frames in pixels, to be considered stable
 stable_threshold = 50
@@ -29,10 +36,152 @@ wheel_compare_threshold = 15
 dark_pixel_threshold = 0.3
 #  number of "light" pixels detected to know when to stop cropping gear bbox
 pink_gear_side_threshold = 0.5
+#  factor the gear bbox crop is upscaled by before trimming its dark rows (unclear if this matters)
+pink_gear_scale = 4
 #  number of frames needed to consider a workspace cluttered
 clutter_threshold = 5
 clutter_speech = "Your workspace is cluttered. Please remove any stray parts from my view."
 
+#  objects the steps detect, as (objects, classifier image ID override) pairs. the step table declares them for
+#  pre-warming and prefetching, and the step handlers detect them
+thin_rim_detection = ({"thin_rim_side"}, None)
+thin_wheel_detection = ({"thin_wheel_side"}, None)
+thick_rim_detection = ({"thick_rim_side"}, None)
+thick_wheel_detection = ({"thick_wheel_side"}, None)
+confirm_wheel_detection = ({"wrong_wheel", "thick_wheel_side", "thin_wheel_side"}, "a4b34fd8f0f6")
+wheel_in_axle_detection = {"thin": ({"wheel_in_axle_thin"}, None), "thick": ({"wheel_in_axle_thick"}, None)}
+frame_marker_detection = ({"frame_marker_right", "frame_marker_left"}, None)
+hole_green_detection = ({"hole_empty", "hole_green"}, None)
+hole_gold_detection = ({"hole_empty", "hole_green", "hole_gold"}, None)
+front_gear_bad_detection = ({"front_gear_bad"}, None)
+front_gear_good_detection = ({"front_gear_good"}, None)
+axle_in_frame_detection = ({"axle_in_frame_good"}, None)
+wheel_side_detection = ({"thick_wheel_side", "thin_wheel_side"}, None)
+back_pink_gear_detection = ({"back_pink", "pink_back"}, None)
+brown_gear_detection = ({"brown_good", "brown_bad"}, None)
+gear_on_axle_detection = ({"gear_on_axle"}, None)
+gears_detection = ({"front_gear_good", "front_gear_bad", "back_pink", "brown_bad", "brown_good", "pink_back"}, None)
+
+#  objects the tire and rim steps detect
+tire_rim_objects = [thin_rim_detection, thin_wheel_detection, thick_rim_detection, thick_wheel_detection]
+
+
+def step_detections(step, task):
+    """
+    Returns the objects a step (None for an unknown state) detects on the task's current frame, as (objects, classifier
+    image ID override) pairs. Empty if the frame needs no detection
+    """
+    return step.detecting(task) if step is not None else []
+
+
+class Step:
+    """
+    A step of the task, as an entry of the step table
+    """
+    def __init__(self, state, handler, next_state, detects=(), select=None):
+        """
+        :param state: name of the step
+        :param handler: function of the Task and the frame returning the step's intermediate response, whose "next" is
+                        set to True to advance to next_state
+        :param next_state: state after this step
+        :param detects: objects the step detects, as (objects, classifier image ID override) pairs. Empty for steps that
+                        need no detection, whose frames are not sent to any classifier
+        :param select: function of the Task returning the part of detects its current frame is detected with, for steps
+                       that go through several checks. None to detect all of detects on every frame
+        """
+        self.state = state
+        self.handler = handler
+        self.next_state = next_state
+        self.detects = list(detects)
+        self.select = select
+
+    def needs_detection(self):
+        return len(self.detects) > 0
+
+    def detecting(self, task):
+        """
+        Returns the part of detects the task's current frame is detected with
+        """
+        return self.detects if self.select is None else self.select(task)
+
+
+def final_check_detects(task):
+    """
+    The final check looks at the wheels, then at the gears, so that only one of their classifiers is used at a time
+    """
+    if task.history["final_check_1"] is False:
+        return []
+    if task.history["final_check_2"] is False:
+        return [wheel_side_detection]
+    return [gears_detection]
+
+
+#  the steps of the task, in order
+steps = [
+    Step("start", lambda task, img: task.start(), "intro"),
+    Step("intro", lambda task, img: task.intro(), "layout_wheel_rim_1"),
+    Step("layout_wheel_rim_1", lambda task, img: task.layout_wheel_rim(img, 1), "combine_wheel_rim_1",
+         tire_rim_objects),
+    Step("combine_wheel_rim_1", lambda task, img: task.combine_tire_rim(img, 1), "confirm_combine_wheel_rim_1",
+         tire_rim_objects),
+    Step("confirm_combine_wheel_rim_1", lambda task, img: task.confirm_combine_tire_rim(img, 1), "layout_wheel_rim_2",
+         [confirm_wheel_detection]),
+    Step("layout_wheel_rim_2", lambda task, img: task.layout_wheel_rim(img, 2), "combine_wheel_rim_2",
+         tire_rim_objects),
+    Step("combine_wheel_rim_2", lambda task, img: task.combine_tire_rim(img, 2), "confirm_combine_wheel_rim_2",
+         tire_rim_objects),
+    Step("confirm_combine_wheel_rim_2", lambda task, img: task.confirm_combine_tire_rim(img, 2), "acquire_axle_1",
+         [confirm_wheel_detection]),
+    Step("acquire_axle_1", lambda task, img: task.acquire_axle(1), "axle_into_wheel_1"),
+    Step("axle_into_wheel_1", lambda task, img: task.axle_into_wheel(img, 1), "acquire_frame_1",
+         [wheel_in_axle_detection["thin"], wheel_in_axle_detection["thick"]]),
+    Step("acquire_frame_1", lambda task, img: task.acquire_frame(img, 1), "insert_green_washer_1",
+         [frame_marker_detection]),
+    Step("insert_green_washer_1", lambda task, img: task.insert_green_washer(img, 1), "insert_gold_washer_1",
+         [hole_green_detection]),
+    Step("insert_gold_washer_1", lambda task, img: task.insert_gold_washer(img, 1), "insert_pink_gear_front",
+         [hole_gold_detection]),
+    Step("insert_pink_gear_front", lambda task, img: task.insert_pink_gear_front(img), "insert_axle_1",
+         [front_gear_bad_detection, front_gear_good_detection]),
+    Step("insert_axle_1", lambda task, img: task.insert_axle(img, 1), "insert_green_washer_2",
+         [axle_in_frame_detection]),
+    Step("insert_green_washer_2", lambda task, img: task.insert_green_washer(img, 2), "insert_gold_washer_2",
+         [hole_green_detection]),
+    Step("insert_gold_washer_2", lambda task, img: task.insert_gold_washer(img, 2), "press_wheel_1",
+         [hole_gold_detection]),
+    Step("press_wheel_1", lambda task, img: task.press_wheel(img, 1), "acquire_axle_2",
+         [wheel_side_detection]),
+    Step("acquire_axle_2", lambda task, img: task.acquire_axle(2), "axle_into_wheel_2"),
+    Step("axle_into_wheel_2", lambda task, img: task.axle_into_wheel(img, 2), "acquire_frame_2",
+         [wheel_in_axle_detection["thick"], wheel_in_axle_detection["thin"]]),
+    Step("acquire_frame_2", lambda task, img: task.acquire_frame(img, 2), "insert_green_washer_3",
+         [frame_marker_detection]),
+    Step("insert_green_washer_3", lambda task, img: task.insert_green_washer(img, 3), "insert_gold_washer_3",
+         [hole_green_detection]),
+    Step("insert_gold_washer_3", lambda task, img: task.insert_gold_washer(img, 3), "insert_pink_gear_back",
+         [hole_gold_detection]),
+    Step("insert_pink_gear_back", lambda task, img: task.insert_pink_gear_back(img), "insert_brown_gear",
+         [back_pink_gear_detection]),
+    Step("insert_brown_gear", lambda task, img: task.insert_brown_gear_back(img), "insert_axle_2",
+         [brown_gear_detection]),
+    Step("insert_axle_2", lambda task, img: task.insert_axle(img, 2), "insert_green_washer_4",
+         [axle_in_frame_detection]),
+    Step("insert_green_washer_4", lambda task, img: task.insert_green_washer(img, 4), "insert_gold_washer_4",
+         [hole_green_detection]),
+    Step("insert_gold_washer_4", lambda task, img: task.insert_gold_washer(img, 4), "press_wheel_2",
+         [hole_gold_detection]),
+    Step("press_wheel_2", lambda task, img: task.press_wheel(img, 2), "add_gear_axle",
+         [wheel_side_detection]),
+    Step("add_gear_axle", lambda task, img: task.add_gear_axle(img), "final_check",
+         [gear_on_axle_detection, front_gear_good_detection]),
+    Step("final_check", lambda task, img: task.final_check(img), "complete",
+         [wheel_side_detection, gears_detection], final_check_detects),
+    Step("complete", lambda task, img: task.complete(), "nothing"),
+    Step("nothing", lambda task, img: task.nothing(), "start")
+]
+step_table = dict((step.state, step) for step in steps)  # state -> Step
+step_sequence = [step.state for step in steps]  # order of the states
+
 class FrameRecorder:
     """
     FrameRecorder is used to check whether or not a detected object in a frame is "stable" that is:
@@ -42,11 +191,25 @@ class FrameRecorder:
     One FrameRecorder per object
     This object is given detected object bounding boxes, not raw frames. It is up to the user to figure out which object
     in the frame to pass in.
+
+    The last n bounding boxes and class IDs are kept in a ring buffer, along with the running sum of the boxes, the
+    running max distance between consecutive box centers and the count of each class, so that the stability check,
+    averaged bbox and averaged class take constant time per frame rather than a pass over all n frames
     """
-    def __init__(self, size):
-        self.deque = deque()
+    def __init__(self, size, checks=None):
+        """
+        :param size: number of frames the object must be stable over
+        :param checks: list the result of each add_and_check_stable is appended to, None to not keep them
+        """
         self.size = size
+        self.checks = checks
+        self.boxes = np.zeros((size, 4))  # ring buffer of bounding boxes
+        self.centers = np.zeros((size, 2))  # ring buffer of their centers
+        self.class_ids = np.zeros(size, dtype=np.int32)  # ring buffer of their class IDs
+        self.class_index = {}  # class name -> class ID
+        self.class_names = []  # class ID -> class name
         self.clear_count = 0
+        self.clear()
 
     def add(self, obj):
         """
@@ -54,10 +217,45 @@ class FrameRecorder:
         Resets the staged clear counter
         :param obj: to add
         """
-        self.deque.append(obj)
-
-        if len(self.deque) > self.size:
-            self.deque.popleft()
+        box = obj["dimensions"]
+        center = bbox_center(box)
+        class_name = obj["class_name"]
+        if class_name not in self.class_index:
+            self.class_index[class_name] = len(self.class_names)
+            self.class_names.append(class_name)
+        class_id = self.class_index[class_name]
+
+        position = self.added % self.size
+        if self.count == self.size:
+            # overwrite the oldest box
+            self.box_sum -= self.boxes[position]
+            old_id = self.class_ids[position]
+            self.class_counts[old_id] -= 1
+            if self.class_counts[old_id] == 0:
+                del self.class_counts[old_id]
+        else:
+            self.count += 1
+
+        if self.added > 0:
+            # distance to the previous box, kept in a deque of decreasing distances whose front is the window's max
+            previous = self.centers[(self.added - 1) % self.size]
+            step = math.hypot(center[0] - previous[0], center[1] - previous[1])
+            while self.steps and self.steps[-1][1] <= step:
+                self.steps.pop()
+            self.steps.append((self.added, step))
+
+        self.boxes[position] = box
+        self.centers[position] = center
+        self.class_ids[position] = class_id
+        self.box_sum += self.boxes[position]
+        self.class_counts[class_id] = self.class_counts.get(class_id, 0) + 1
+        self.class_last[class_id] = self.added
+        self.added += 1
+
+        # drop the distances to boxes that left the window, the first box in it has no previous one
+        first = self.added - self.count
+        while self.steps and self.steps[0][0] <= first:
+            self.steps.popleft()
 
         self.clear_count = 0
 
@@ -65,27 +263,25 @@ class FrameRecorder:
         """
         Returns whether or not the object being recorded is stable
         """
-        if len(self.deque) != self.size:
+        if self.count != self.size:
             return False
+        return self.max_step() <= stable_threshold
 
-        prev_frame = self.deque[0]
-        for i in range(1, len(self.deque)):
-            frame = self.deque[i]
-            diff = bbox_diff(frame["dimensions"], prev_frame["dimensions"])
-
-            if diff > stable_threshold:
-                return False
-
-            prev_frame = frame
-
-        return True
+    def max_step(self):
+        """
+        Returns the max distance in pixels between the centers of consecutive recorded boxes
+        """
+        return self.steps[0][1] if self.steps else 0
 
     def add_and_check_stable(self, obj):
         """
         Add a new frame and return if the object is stable
         """
         self.add(obj)
-        return self.is_center_stable()
+        stable = self.is_center_stable()
+        if self.checks is not None:
+            self.checks.append(stable)
+        return stable
 
     def staged_clear(self):
         """
@@ -99,30 +295,46 @@ class FrameRecorder:
         """
         Clears the FrameRecorder's frames
         """
-        self.deque = deque()
+        self.count = 0  # number of boxes in the window
+        self.added = 0  # number of boxes added since the last clear
+        self.box_sum = np.zeros(4)
+        self.steps = deque()  # (number of the box, distance to the box before it), decreasing distances
+        self.class_counts = {}  # class ID -> number of boxes of that class in the window
+        self.class_last = {}  # class ID -> number of the last box of that class, to break ties
 
     def averaged_bbox(self):
         """
         Return the averaged bbox from all recorded frames
         """
-        out = [0, 0, 0, 0]
-
-        for i in range(len(self.deque)):
-            dim = self.deque[i]["dimensions"]
-            for u in range(len(dim)):
-                out[u] += dim[u]
-
-        return [v / len(self.deque) for v in out]
+        return (self.box_sum / self.count).tolist()
 
     def averaged_class(self):
         """
-        Return the mode detected object class from all recorded frames
+        Return the mode detected object class from all recorded frames, the most recent one of equally frequent classes
         """
-        all_class = []
-        for i in range(len(self.deque)):
-            if self.deque[i]["class_name"] not in all_class:
-                all_class.append(self.deque[i]["class_name"])
-        return max(set(all_class), key = all_class.count) 
+        class_id = max(self.class_counts, key=lambda c: (self.class_counts[c], self.class_last[c]))
+        return self.class_names[class_id]
+
+
+def new_detector():
+    """
+    Returns a Detector set up from config, which may be shared by the tasks of several client sessions
+    """
+    return object_detection.Detector(tpod_url,
+                                     max_resident=config.MAX_RESIDENT_CLASSIFIERS,
+                                     start_timeout=config.CLASSIFIER_START_TIMEOUT,
+                                     connect_timeout=config.TPOD_CONNECT_TIMEOUT,
+                                     read_timeout=config.TPOD_READ_TIMEOUT,
+                                     cache_frames=config.DETECTION_CACHE_FRAMES,
+                                     endpoints=config.TPOD_ENDPOINTS,
+                                     mode=config.DETECTOR_MODE,
+                                     trace=config.DETECTOR_TRACE,
+                                     replay_latency=config.DETECTOR_REPLAY_LATENCY,
+                                     batch_window=config.DETECTION_BATCH_WINDOW,
+                                     max_batch=config.DETECTION_MAX_BATCH,
+                                     max_concurrent=config.DETECTION_MAX_CONCURRENT,
+                                     validate_reuse=config.MOTION_GATE_VALIDATE,
+                                     reuse_tolerance=config.MOTION_GATE_TOLERANCE)
 
 
 class Task:
@@ -131,19 +343,40 @@ class Task:
     Bulk of AAA exists here.
     """
 
-    def __init__(self, init_state=None):
+    def __init__(self, init_state=None, clock=time.time, detector=None):
+        """
+        :param init_state: state to start in, defaults to "start"
+        :param clock: function returning the current time in seconds, for delays and timed steps
+        :param detector: Detector shared with the tasks of other client sessions, a new one is made if None
+        """
+        self.clock = clock
         if init_state is None:
             self.current_state = "start"
         else:
             self.current_state = init_state
 
-        self.frame_recs = defaultdict(lambda: FrameRecorder(15))  # dictionary of frame recorders for different objs
+        self.stability_checks = []  # results of the frame recorders' stability checks on the current frame
+        # dictionary of frame recorders for different objs
+        self.frame_recs = defaultdict(lambda: FrameRecorder(15, self.stability_checks))
         self.session_id = None  # ID from client to know the same session is still going on
         self.history = defaultdict(lambda: False)  # keeps track of which steps were completed
         self.delay_flag = False  # set to True to delay processing (usually after user makes mistake, needs time to fix)
+        self.defer_until = 0  # input is ignored until this time, without blocking the frame thread
 
-        self.detector = object_detection.Detector(tpod_url)  # Detector object for object detection
+        # Detector object for object detection
+        self.owns_detector = detector is None  # a shared detector is not reset when this task's client changes
+        self.detector = new_detector() if detector is None else detector
         self.frame_id = 0  #  unique ID for each frame, for detector's cache
+        #  lets frames of a still scene reuse the detections of an earlier frame
+        self.motion_gate = None
+        if config.MOTION_GATE:
+            self.motion_gate = motion.MotionGate(config.MOTION_GATE_THRESHOLD, config.MOTION_GATE_MAX_REUSE)
+        #  moves the boxes of the last frame detected along with the objects, for the frames in between classifier calls
+        self.tracker = None
+        if config.TRACKING:
+            self.tracker = tracking.BoxTracker(config.TRACKING_INTERVAL, config.TRACKING_MAX_INTERVAL,
+                                               config.TRACKING_MIN_CONFIDENCE, config.TRACKING_WIDTH,
+                                               config.MOTION_GATE_TOLERANCE)
 
         self.clutter_count = 0  #  tracks number of times workspace was detected to be cluttered, before triggering message
 
@@ -151,6 +384,11 @@ class Task:
         self.time = None
         self.time_trigger = False
 
+        self.prewarmed_state = None  # state whose upcoming classifiers were last pre-warmed
+
+        if config.PRELOAD_ASSETS:
+            guidance_assets.preload_in_background()
+
     def get_objects_by_categories(self, img, categories, image_id=None):
         """
         Detects objects in a given frame/image. Need to supply objects to be detected
@@ -162,12 +400,132 @@ class Task:
         """
         return self.detector.detect_object(img, categories, self.frame_id, image_id)
 
-    def get_instruction(self, img, header=None):
+    def prewarm_upcoming(self):
+        """
+        Pre-warm the classifiers of the current step and of the next step that detects objects, so that the cold start
+        of a classifier container is out of the step transition
+        """
+        if self.current_state not in step_table:
+            return
+
+        index = step_sequence.index(self.current_state)
+        current = step_table[self.current_state].detects
+        upcoming = []
+        for state in step_sequence[index + 1:]:
+            if step_table[state].needs_detection():
+                upcoming = step_table[state].detects
+                break
+
+        for objects, image_id in current + upcoming:
+            self.detector.prewarm(objects, image_id)
+
+    def upcoming_classifiers(self):
+        """
+        Returns the Docker image IDs of the classifiers the current step and the rest of the sequence detect with, in
+        the order they are first needed
+        """
+        out = []
+        if self.current_state not in step_table:
+            return out
+
+        for state in step_sequence[step_sequence.index(self.current_state):]:
+            for objects, image_id in step_table[state].detects:
+                classifier = self.detector.classifier_for(objects, image_id)
+                if classifier not in out:
+                    out.append(classifier)
+        return out
+
+    def prefetch(self, img, frame_id):
+        """
+        Detect the objects the current step looks for in a frame, ahead of its get_instruction call. The detections are
+        cached, so that the proxy can overlap detection of a frame with the task logic of the previous one
+
+        :param img: frame with objects to detect
+        :param frame_id: ID the frame will be passed to get_instruction with
+        """
+        detects = step_detections(step_table.get(self.current_state), self)
+        if self.is_deferred() or not detects:
+            return
+        propagated = self.propagate(img, frame_id)
+        for objects, image_id in detects:
+            self.detector.detect_object(img, objects, frame_id, image_id)
+        if not propagated:
+            self.detected(img, frame_id)
+
+    def propagate(self, img, frame_id):
+        """
+        Fill in a frame's detections without the classifiers where possible: reused from the last frame detected if the
+        scene hasn't changed since, or tracked from it
+
+        :return: True if the frame's detections were filled in, False if it is to be sent to the classifiers
+        """
+        if self.motion_gate is not None:
+            reference_id = self.motion_gate.check(img, frame_id)
+            if reference_id is not None:
+                self.detector.cache.reuse(frame_id, reference_id)
+                return True
+        if self.tracker is not None:
+            tracked = self.tracker.track(img, frame_id, self.current_state)
+            if tracked is not None:
+                for classifier, detected_objs in tracked.items():
+                    self.detector.cache.put(frame_id, classifier, detected_objs, [])
+                return True
+        return False
+
+    def detected(self, img, frame_id):
+        """
+        Let the tracker pick up the detections of a frame sent to the classifiers
+        """
+        if self.tracker is not None:
+            self.tracker.keyframe(img, frame_id, self.current_state, self.detector.cache.detections(frame_id))
+
+    def reset_propagation(self):
+        """
+        Forget the last frame detected, whose detections are of another step's classifiers or another client's scene
+        """
+        if self.motion_gate is not None:
+            self.motion_gate.reset()
+        if self.tracker is not None:
+            self.tracker.reset()
+
+    def defer(self, seconds):
+        """
+        Ignore input for some time. Frames arriving until then are answered right away with an empty result, without
+        detecting objects
+
+        :param seconds: from now
+        """
+        self.defer_until = max(self.defer_until, self.clock() + seconds)
+
+    def is_deferred(self):
+        """
+        Returns whether or not input is currently ignored
+        """
+        return self.clock() < self.defer_until
+
+    def wait(self, key, seconds):
+        """
+        Pause processing for some time the first time it's called with a key, in place of sleeping on the frame thread
+
+        :param key: identifies the wait, in self.history
+        :param seconds: to wait for
+        :return: True if the wait just started and the caller should return, False once it is over
+        """
+        key = "wait_" + key
+        if self.history[key] is False:
+            self.history[key] = True
+            self.defer(seconds)
+            return True
+        return False
+
+    @metrics.timed("step")
+    def get_instruction(self, img, header=None, frame_id=None):
         """
         Get the next instruction, given a new frame
 
         :param img: frame with objects to detect
         :param header: from client's request, used to track session ID
+        :param frame_id: unique ID of the frame, as passed to prefetch. defaults to counting frames
         :return: tuple of objects to visualize and a response object with image, video, and/or speech references
         """
 
@@ -179,150 +537,45 @@ class Task:
                 self.session_id = header["task_id"]
                 self.current_state = "start"
                 self.history.clear()
-                self.detector.reset()
-
-        # sleep if previous frame set the delay flag
-        if self.delay_flag is True:
-            time.sleep(4)
-            self.delay_flag = False
+                self.frame_recs.clear()
+                self.reset_propagation()
+                if self.owns_detector:
+                    self.detector.reset()
+                self.defer_until = 0
 
         result = defaultdict(lambda: None)
         result['status'] = "success"
-        self.frame_id += 1
+
+        # ignore input while a previous frame deferred processing
+        if self.is_deferred():
+            return [], result
+
+        self.frame_id = self.frame_id + 1 if frame_id is None else frame_id
 
         inter = defaultdict(lambda: None)
 
-        # the start, branch into desired instruction
-        if self.current_state == "start":
-            self.current_state = "intro"
-        elif self.current_state == "intro":
-            inter = self.intro()
-            if inter["next"] is True:
-                self.current_state = "layout_wheel_rim_1"
-        elif self.current_state == "layout_wheel_rim_1":
-            inter = self.layout_wheel_rim(img, 1)
-            if inter["next"] is True:
-                self.current_state = "combine_wheel_rim_1"
-        elif self.current_state == "combine_wheel_rim_1":
-            inter = self.combine_tire_rim(img, 1)
-            if inter["next"] is True:
-                self.current_state = "confirm_combine_wheel_rim_1"
-        elif self.current_state == "confirm_combine_wheel_rim_1":
-            inter = self.confirm_combine_tire_rim(img, 1)
-            if inter["next"] is True:
-                self.current_state = "layout_wheel_rim_2"
-        elif self.current_state == "layout_wheel_rim_2":
-            inter = self.layout_wheel_rim(img, 2)
-            if inter["next"] is True:
-                self.current_state = "combine_wheel_rim_2"
-        elif self.current_state == "combine_wheel_rim_2":
-            inter = self.combine_tire_rim(img, 2)
-            if inter["next"] is True:
-                self.current_state = "confirm_combine_wheel_rim_2"
-        elif self.current_state == "confirm_combine_wheel_rim_2":
-            inter = self.confirm_combine_tire_rim(img, 2)
-            if inter["next"] is True:
-                self.current_state = "acquire_axle_1"
-        elif self.current_state == "acquire_axle_1":
-            inter = self.acquire_axle(1)
-            if inter["next"] is True:
-                self.current_state = "axle_into_wheel_1"
-        elif self.current_state == "axle_into_wheel_1":
-            inter = self.axle_into_wheel(img, 1)
-            if inter["next"] is True:
-                self.current_state = "acquire_frame_1"
-        elif self.current_state == "acquire_frame_1":
-            inter = self.acquire_frame(img, 1)
-            if inter["next"] is True:
-                self.current_state = "insert_green_washer_1"
-        elif self.current_state == "insert_green_washer_1":
-            inter = self.insert_green_washer(img, 1)
-            if inter["next"] is True:
-                self.current_state = "insert_gold_washer_1"
-        elif self.current_state == "insert_gold_washer_1":
-            inter = self.insert_gold_washer(img, 1)
-            if inter["next"] is True:
-                self.current_state = "insert_pink_gear_front"
-        elif self.current_state == "insert_pink_gear_front":
-            inter = self.insert_pink_gear_front(img)
-            if inter["next"] is True:
-                self.current_state = "insert_axle_1"
-        elif self.current_state == "insert_axle_1":
-            inter = self.insert_axle(img, 1)
-            if inter["next"] is True:
-                self.current_state = "insert_green_washer_2"
-        elif self.current_state == "insert_green_washer_2":
-            inter = self.insert_green_washer(img, 2)
-            if inter["next"] is True:
-                self.current_state = "insert_gold_washer_2"
-        elif self.current_state == "insert_gold_washer_2":
-            inter = self.insert_gold_washer(img, 2)
-            if inter["next"] is True:
-                self.current_state = "press_wheel_1"
-        elif self.current_state == "press_wheel_1":
-            inter = self.press_wheel(img, 1)
-            if inter["next"] is True:
-                self.current_state = "acquire_axle_2"
-        elif self.current_state == "acquire_axle_2":
-            inter = self.acquire_axle(2)
-            if inter["next"] is True:
-                self.current_state = "axle_into_wheel_2"
-        elif self.current_state == "axle_into_wheel_2":
-            inter = self.axle_into_wheel(img, 2)
-            if inter["next"] is True:
-                self.current_state = "acquire_frame_2"
-        elif self.current_state == "acquire_frame_2":
-            inter = self.acquire_frame(img, 2)
-            if inter["next"] is True:
-                self.current_state = "insert_green_washer_3"
-        elif self.current_state == "insert_green_washer_3":
-            inter = self.insert_green_washer(img, 3)
-            if inter["next"] is True:
-                self.current_state = "insert_gold_washer_3"
-        elif self.current_state == "insert_gold_washer_3":
-            inter = self.insert_gold_washer(img, 3)
-            if inter["next"] is True:
-                self.current_state = "insert_pink_gear_back"
-        elif self.current_state == "insert_pink_gear_back":
-            inter = self.insert_pink_gear_back(img)
-            if inter["next"] is True:
-                self.current_state = "insert_brown_gear"
-        elif self.current_state == "insert_brown_gear":
-            inter = self.insert_brown_gear_back(img)
-            if inter["next"] is True:
-                self.current_state = "insert_axle_2"
-        elif self.current_state == "insert_axle_2":
-            inter = self.insert_axle(img, 2)
-            if inter["next"] is True:
-                self.current_state = "insert_green_washer_4"
-        elif self.current_state == "insert_green_washer_4":
-            inter = self.insert_green_washer(img, 4)
-            if inter["next"] is True:
-                self.current_state = "insert_gold_washer_4"
-        elif self.current_state == "insert_gold_washer_4":
-            inter = self.insert_gold_washer(img, 4)
-            if inter["next"] is True:
-                self.current_state = "press_wheel_2"
-        elif self.current_state == "press_wheel_2":
-            inter = self.press_wheel(img, 2)
+        # look up the current step and run it
+        step = step_table.get(self.current_state)
+        del self.stability_checks[:]
+        detects = step_detections(step, self)
+        propagated = len(detects) > 0 and self.propagate(img, self.frame_id)
+        if step is not None:
+            inter = step.handler(self, img)
+            if detects and not propagated:
+                self.detected(img, self.frame_id)
             if inter["next"] is True:
-                self.current_state = "add_gear_axle"
-        elif self.current_state == "add_gear_axle":
-            inter = self.add_gear_axle(img)
-            if inter["next"] is True:
-                self.current_state = "final_check"
-        elif self.current_state == "final_check":
-            inter = self.final_check(img)
-            if inter["next"] is True:
-                self.current_state = "complete"
-        elif self.current_state == "complete":
-            inter = self.complete()
-            if inter["next"] is True:
-                self.current_state = "nothing"
-        elif self.current_state == "nothing":
-            self.history = defaultdict(lambda: False)
-            time.sleep(10)
-            self.current_state = "start"
+                self.current_state = step.next_state
+                self.reset_propagation()
+
+        # pause if this frame set the delay flag
+        if self.delay_flag is True:
+            self.defer(4)
+            self.delay_flag = False
+
+        # start the classifiers of the next steps while the user is still on this one
+        if self.current_state != self.prewarmed_state:
+            self.prewarmed_state = self.current_state
+            self.prewarm_upcoming()
 
         # copy intermediate response to output
         for field in inter.keys():
@@ -331,7 +584,8 @@ class Task:
 
         # set up objects with instructions on how to visualize
         exclude = {"frame_marker_left", "frame_marker_right", "frame_horn"}  # exclude these unused objects
-        viz_objects = [obj for obj in self.detector.all_detected_objects() if obj["class_name"] not in exclude]
+        detected_objs = self.detector.all_detected_objects(self.frame_id) if detects else []
+        viz_objects = [obj for obj in detected_objs if obj["class_name"] not in exclude]
         for obj in viz_objects:
             if "color" not in obj.keys():
                 obj["color"] = "blue" if inter["good_frame"] else "red"  # color based on if frame was used or not
@@ -349,7 +603,16 @@ class Task:
     3. Simultaneously detecting if any error conditions are met and returning corresponding guidance.
     4. Setting out["next"] to True as a signal to the get_instruction to advance to the next step
     5. Setting self.delay_flag to True to pause processing for a short time
+    6. Calling self.wait to pause processing before giving guidance, without blocking the frame thread
     """
+    def start(self):
+        """
+        First step, moves on to the intro right away
+        """
+        out = defaultdict(lambda: None)
+        out["next"] = True
+        return out
+
     def intro(self):
         """
         Beginning tutorial on how to read the interface
@@ -413,10 +676,10 @@ class Task:
             out['speech'] = speech[count]
             return out
 
-        thin_rim = self.get_objects_by_categories(img, {"thin_rim_side"})
-        thin_wheel = self.get_objects_by_categories(img, {"thin_wheel_side"})
-        thick_rim = self.get_objects_by_categories(img, {"thick_rim_side"})
-        thick_wheel = self.get_objects_by_categories(img, {"thick_wheel_side"})
+        thin_rim = self.get_objects_by_categories(img, *thin_rim_detection)
+        thin_wheel = self.get_objects_by_categories(img, *thin_wheel_detection)
+        thick_rim = self.get_objects_by_categories(img, *thick_rim_detection)
+        thick_wheel = self.get_objects_by_categories(img, *thick_wheel_detection)
 
         if len(thin_rim) == 1 and len(thick_rim) == 1 and len(thin_wheel) == 1 and len(thick_wheel) == 1:
             thin_rim_check = self.frame_recs[0].add_and_check_stable(thin_rim[0])
@@ -441,40 +704,40 @@ class Task:
         if self.history[name] is False:
             self.history[name] = True
             out["speech"] = "Well done. Now put the tires and rims together by color."
-            out["video"] = video_url + "tire_rim_combine.mp4"
-            self.time = time.time()
+            out["video"] = video_url("tire_rim_combine.mp4")
+            self.time = self.clock()
 
-        thin_rim = self.get_objects_by_categories(img, {"thin_rim_side"})
-        thin_wheel = self.get_objects_by_categories(img, {"thin_wheel_side"})
-        thick_rim = self.get_objects_by_categories(img, {"thick_rim_side"})
-        thick_wheel = self.get_objects_by_categories(img, {"thick_wheel_side"})
+        thin_rim = self.get_objects_by_categories(img, *thin_rim_detection)
+        thin_wheel = self.get_objects_by_categories(img, *thin_wheel_detection)
+        thick_rim = self.get_objects_by_categories(img, *thick_rim_detection)
+        thick_wheel = self.get_objects_by_categories(img, *thick_wheel_detection)
 
         # hack using time because we need to process each frame, but want to also play for 10 seconds
         if len(thin_rim) == 1 and len(thick_rim) == 1 and len(thin_wheel) == 1 and len(thick_wheel) == 1:
             if not self.time_trigger:
                 self.time_trigger = True
-                self.time = time.time()
+                self.time = self.clock()
 
         # color matching pairs
         if len(thin_rim) == 1:
             self.detector.color_detected_object({
                 "thin_rim_side": "yellow",
                 "thin_wheel_side": "yellow"
-            })
+            }, self.frame_id)
         if len(thin_wheel) == 1:
             self.detector.color_detected_object({
                 "thin_wheel_side": "yellow"
-            })
+            }, self.frame_id)
         if len(thick_rim) == 1:
             self.detector.color_detected_object({
                 "thick_rim_side": "orange",
-            })
+            }, self.frame_id)
         if len(thick_wheel) == 1:
             self.detector.color_detected_object({
                 "thick_wheel_side": "orange"
-            })
+            }, self.frame_id)
 
-        if self.time_trigger and time.time() > self.time + 10:
+        if self.time_trigger and self.clock() > self.time + 10:
             out["next"] = True
 
         return out
@@ -496,7 +759,7 @@ class Task:
             out["speech"] = "Then, show me the wheels like this."
             out["image"] = read_image("wheels_assembled.jpg")
 
-        wheels = self.get_objects_by_categories(img, {"wrong_wheel", "thick_wheel_side", "thin_wheel_side"}, "a4b34fd8f0f6")
+        wheels = self.get_objects_by_categories(img, *confirm_wheel_detection)
         if len(wheels) == 2:
             out["good_frame"] = True
             left_wheel, right_wheel = separate_two(wheels)
@@ -556,8 +819,8 @@ class Task:
             return out
 
         # detects a small area where axle meets wheel, small distinguishing feature
-        good = self.get_objects_by_categories(img, {"wheel_in_axle_%s" % good_str})
-        bad = self.get_objects_by_categories(img, {"wheel_in_axle_%s" % bad_str})
+        good = self.get_objects_by_categories(img, *wheel_in_axle_detection[good_str])
+        bad = self.get_objects_by_categories(img, *wheel_in_axle_detection[bad_str])
 
         if len(good) != 1 and len(bad) != 1:
             self.all_staged_clear()
@@ -598,12 +861,12 @@ class Task:
             self.clear_states()
             self.history[name] = True
             out["speech"] = "Moving on. Grab the black frame. Show me a side view of the axle holes like this."
-            out['video'] = video_url + name + ".mp4"
+            out['video'] = video_url(name + ".mp4")
             return out
 
         # doesn't matter which side, just that a frame marker is found
         # TODO: should detect that correct side is shown, but needs more training data
-        frame_marker = self.get_objects_by_categories(img, {"frame_marker_right", "frame_marker_left"})
+        frame_marker = self.get_objects_by_categories(img, *frame_marker_detection)
         
         marker_check = False
         if len(frame_marker) == 1:
@@ -638,7 +901,8 @@ class Task:
             out["image"] = read_image("green_washer.png")
             return out
         if self.history[name] is False:
-            time.sleep(4)
+            if self.wait(name, 4):
+                return out
             self.history[name] = True
             speech = {1: "Insert the green washer into the %s hole. Then, show me a side view of the holes like in the video." % side_str,
                       2: "Now, insert a green washer into the %s hole. Then, show me a side view of the holes." % side_str,
@@ -646,10 +910,10 @@ class Task:
                       4: "Now, insert a green washer into the %s hole. Then, show me a side view of the holes." % side_str}
             out["speech"] = speech[count]
 
-            out["video"] = video_url + name + ".mp4"
+            out["video"] = video_url(name + ".mp4")
             return out
 
-        holes = self.get_objects_by_categories(img, {"hole_empty", "hole_green"})
+        holes = self.get_objects_by_categories(img, *hole_green_detection)
 
         if 0 < len(holes) < 3:
             out["good_frame"] = True
@@ -700,13 +964,14 @@ class Task:
             out["image"] = read_image("gold_washer.png")
             return out
         if self.history[name] is False:
-            time.sleep(4)
+            if self.wait(name, 4):
+                return out
             self.history[name] = True
             out["speech"] = "Insert the gold washer into the green washer."
-            out["video"] = video_url + name + ".mp4"
+            out["video"] = video_url(name + ".mp4")
             return out
 
-        holes = self.get_objects_by_categories(img, {"hole_empty", "hole_green", "hole_gold"})
+        holes = self.get_objects_by_categories(img, *hole_gold_detection)
 
         if 0 < len(holes) < 3:
             out["good_frame"] = True
@@ -752,7 +1017,7 @@ class Task:
             return out
 
         # good and bad states were trained on and can be detected
-        bad_pink = self.get_objects_by_categories(img, {"front_gear_bad"})
+        bad_pink = self.get_objects_by_categories(img, *front_gear_bad_detection)
         if len(bad_pink) >= 1:
             out["good_frame"] = True
             if self.frame_recs[1].add_and_check_stable(bad_pink[0]):
@@ -763,7 +1028,7 @@ class Task:
         else:
             self.frame_recs[1].staged_clear()
 
-        good_pink = self.get_objects_by_categories(img, {"front_gear_good"})
+        good_pink = self.get_objects_by_categories(img, *front_gear_good_detection)
         if len(good_pink) == 1:
             out["good_frame"] = True
             if self.frame_recs[0].add_and_check_stable(good_pink[0]) is True:
@@ -786,10 +1051,10 @@ class Task:
             self.clear_states()
             self.history[name] = True
             out["speech"] = "Great, now insert the axle through the washers and the pink gear. Then give me a birds eye view."
-            out["video"] = video_url + name + ".mp4"
+            out["video"] = video_url(name + ".mp4")
             return out
 
-        axles = self.get_objects_by_categories(img, {"axle_in_frame_good"})
+        axles = self.get_objects_by_categories(img, *axle_in_frame_detection)
 
         # need to handle 1 and 2 cases because more than one could be visible based on first and second repetition
         if 0 < len(axles) < 3:
@@ -827,10 +1092,10 @@ class Task:
             self.clear_states()
             self.history[name] = True
             out["speech"] = "Press the other %s wheel into the axle. Then, show me the bird's eye view." % good_str
-            out["video"] = video_url + name + ".mp4"
+            out["video"] = video_url(name + ".mp4")
             return out
 
-        wheels = self.get_objects_by_categories(img, {"thick_wheel_side", "thin_wheel_side"})
+        wheels = self.get_objects_by_categories(img, *wheel_side_detection)
 
         # need to handle two cases for two iterations (second iteration has front wheels in already)
         if len(wheels) == 2 or len(wheels) == 4:
@@ -881,63 +1146,16 @@ class Task:
             out["image"] = read_image("pink_gear_2.jpg")
             return out
 
-        gear = self.get_objects_by_categories(img,{"back_pink","pink_back"})
+        gear = self.get_objects_by_categories(img, *back_pink_gear_detection)
 
         # traditional image processing. side with more dark pixels == probably where the teeth are
         if len(gear) == 1:
             out["good_frame"] = True
             if self.frame_recs[0].add_and_check_stable(gear[0]):
-                img = img[int(gear[0]['dimensions'][1]):int(gear[0]['dimensions'][3]),int(gear[0]['dimensions'][0]):int(gear[0]['dimensions'][2])]
+                img = frame.crop(img, gear[0]['dimensions'])
                 img = cv2.cvtColor(img, cv2.COLOR_RGB2GRAY)
-                
-                # resize (unclear if this matters)
-                scale_percent = 400
-                width = int(img.shape[1] * scale_percent / 100)
-                height = int(img.shape[0] * scale_percent / 100)
-                dim = (width, height)
-                img = cv2.resize(img, dim, interpolation = cv2.INTER_AREA)
-
-
-                # cut black parts from the up
-                throw_out_cols_cap = 0 
-                for y in range(img.shape[0]):
-                    white_pixels = 0
-                    for x in range(img.shape[1]):
-                        if not check_dark_pixel(img[y][x],dark_pixel_threshold):
-                            white_pixels += 1
-                    if float(white_pixels) / float(img.shape[1]) > pink_gear_side_threshold:
-                        break
-                    else:
-                        throw_out_cols_cap = y
-                img = img[throw_out_cols_cap:,0:img.shape[1]]
-
-                # cut black parts from the down
-                for y in reversed(range(img.shape[0])):
-                    white_pixels = 0
-                    for x in reversed(range(img.shape[1])):
-                        if not check_dark_pixel(img[y][x],dark_pixel_threshold):
-                            white_pixels += 1
-                    if float(white_pixels) / float(img.shape[1]) > pink_gear_side_threshold:
-                        break
-                    else:
-                        throw_out_cols_cap = y
-                img = img[0:throw_out_cols_cap,0:img.shape[1]]
-
-                # count dark pixels for left and right side of the screen
-                height = img.shape[0]
-                midpoint = height / 2
-
-                up_dark_pixels = 0
-                down_dark_pixels = 0
-                for x in range(img.shape[1]):
-                    for y in range(img.shape[0]):
-                        if y <= midpoint:
-                            if check_dark_pixel(img[y][x],dark_pixel_threshold):
-                                up_dark_pixels += 1
-                        else:
-                            if check_dark_pixel(img[y][x],dark_pixel_threshold):
-                                down_dark_pixels += 1
-                if up_dark_pixels > down_dark_pixels:
+
+                if more_dark_pixels_up(img):
                     out["next"] = True
                     out["speech"] = "Great! you're done"
                     out["next"] = True
@@ -969,7 +1187,7 @@ class Task:
             out["image"] = read_image("brown_gear.jpg")
             return out
         
-        brown_gear = self.get_objects_by_categories(img, {"brown_good", "brown_bad"})
+        brown_gear = self.get_objects_by_categories(img, *brown_gear_detection)
 
         # detects the correct state using ML object detection
         if len(brown_gear) == 1:
@@ -999,11 +1217,11 @@ class Task:
             self.clear_states()
             self.history["add_gear_axle"] = True
             out["speech"] = "Finally, find the gear axle. Use it to connect the two gear systems together."
-            out["video"] = video_url + "gear_axle.mp4"
+            out["video"] = video_url("gear_axle.mp4")
             return out
 
-        gear_on_axle = self.get_objects_by_categories(img, {"gear_on_axle"})
-        front_pink_gear = self.get_objects_by_categories(img, {"front_gear_good"})
+        gear_on_axle = self.get_objects_by_categories(img, *gear_on_axle_detection)
+        front_pink_gear = self.get_objects_by_categories(img, *front_gear_good_detection)
 
         # only checks that the gear on gear axle for the front gear is in, back gear couldn't be detected
         # TODO make it work for both sides
@@ -1051,7 +1269,7 @@ class Task:
             out["image"] = read_image("final_check.jpg")
             return out
         elif self.history["final_check_2"] is False:  # check wheels
-            wheels = self.get_objects_by_categories(img, {"thin_wheel_side", "thick_wheel_side"})
+            wheels = self.get_objects_by_categories(img, *wheel_side_detection)
 
             if len(wheels) == 4:
                 out["good_frame"] = True
@@ -1082,11 +1300,12 @@ class Task:
                         self.history["final_check_2"] = True
                         out["speech"] = "The wheels look good! Please stay still for a little longer. Now I'm checking the gears."
                         self.clear_states()
+                        self.reset_propagation()  # the wheels' boxes aren't to be tracked into the gear check
             else:
                 self.all_staged_clear()
 
         elif self.history["final_check_3"] is False:  # check gears
-            gears = self.get_objects_by_categories(img, {"front_gear_good", "front_gear_bad", "back_pink", "brown_bad", "brown_good", "pink_back"})
+            gears = self.get_objects_by_categories(img, *gears_detection)
             
             if len(gears) == 3:
                 out["good_frame"] = True
@@ -1123,6 +1342,16 @@ class Task:
 
         return out
 
+    def nothing(self):
+        """
+        After completion, pause for a while and start over
+        """
+        out = defaultdict(lambda: None)
+        self.history = defaultdict(lambda: False)
+        self.defer(10)
+        out["next"] = True
+        return out
+
     # Utility functions
     def clear_states(self):
         """
@@ -1260,9 +1489,20 @@ def compare(box1, box2, threshold):
 def read_image(name):
     """
     Helper for reading image from a resource directory
+    :return: cached Asset of the encoded image, or None if it can't be read
+    """
+    return guidance_assets.get(name)
+
+def video_url(name):
+    """
+    Helper for the URL of a guidance video, served by video_server at VIDEO_HOST:VIDEO_PORT. Without a VIDEO_HOST the
+    address of this machine's default route interface is advertised, looked up once on first use
     """
-    image_path = os.path.join(resources, name)
-    return cv2.imread(image_path)
+    global video_host
+    with video_host_lock:
+        if video_host is None:
+            video_host = config.VIDEO_HOST or util.local_address()
+    return "http://%s:%d/%s" % (video_host, config.VIDEO_PORT, name)
 
 def get_orientation(side_marker, horn):
     """
@@ -1280,6 +1520,46 @@ def get_orientation(side_marker, horn):
 
     return side, flipped
 
+def more_dark_pixels_up(img):
+    """
+    Whether or not the upper half of a grayscale gear crop has more dark pixels than the lower half
+    Rows that are mostly dark are first trimmed from the top and the bottom
+
+    Works on the per-row dark pixel counts instead of walking every pixel. The crop used to be upscaled 4x before
+    trimming, which changes which rows survive the trimming. Upscaling only repeats rows and columns, so its effect is
+    reproduced by repeating the per-row counts instead of the image.
+    """
+    if img.size == 0:
+        return False
+
+    width = img.shape[1]
+    row_dark = np.count_nonzero(img <= dark_pixel_threshold * 255, axis=1)
+    row_white = (width - row_dark) / float(width) > pink_gear_side_threshold
+
+    dark = np.repeat(row_dark, pink_gear_scale) * pink_gear_scale  # dark pixels of each row of the upscaled crop
+    white = np.repeat(row_white, pink_gear_scale)
+
+    # cut black parts from the up, keeping the last black row
+    white_rows = np.flatnonzero(white)
+    if len(white_rows) == 0:
+        cap = len(dark) - 1
+    else:
+        cap = max(white_rows[0] - 1, 0)
+    dark = dark[cap:]
+    white = white[cap:]
+
+    # cut black parts from the down. if the last row is not black, the cap from the up is used
+    white_rows = np.flatnonzero(white)
+    if len(white_rows) == 0:
+        cap = 0
+    elif white_rows[-1] < len(white) - 1:
+        cap = white_rows[-1] + 1
+    dark = dark[:cap]
+
+    # count dark pixels for upper and lower half
+    midpoint = len(dark) // 2
+    return dark[:midpoint + 1].sum() > dark[midpoint + 1:].sum()
+
 def check_dark_pixel(pixel,threshold):
     """
     Binary reduction of pixel into whether or not it's a light or dark pixel, based on a threshold
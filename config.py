@@ -32,11 +32,129 @@ TASK_SERVER_PORT = 2722
 
 # Configs for object detection
 USE_GPU = True
+# Max number of TPOD classifier containers kept running at once, each on its own port after the TPOD URL's port
+MAX_RESIDENT_CLASSIFIERS = 3
+# Max seconds to wait for a newly started classifier container to answer requests
+CLASSIFIER_START_TIMEOUT = 30
+# Max seconds to connect to a classifier, and to wait for its detections
+TPOD_CONNECT_TIMEOUT = 1
+TPOD_READ_TIMEOUT = 5
+# Dict of classifier Docker image ID -> URL of a classifier already running, used instead of starting containers.
+# None to start classifier containers with Docker
+TPOD_ENDPOINTS = None
+# "live" to detect with TPOD, "record" to also append every TPOD response to DETECTOR_TRACE, or "replay" to serve
+# detections from DETECTOR_TRACE without Docker or HTTP
+DETECTOR_MODE = "live"
+DETECTOR_TRACE = "detections.jsonl"
+# In replay mode, wait for as long as each recorded TPOD request took
+DETECTOR_REPLAY_LATENCY = False
+# Number of most recent frames to keep detections of, enough for every frame in flight in the proxy pipeline, for
+# several concurrent client sessions
+DETECTION_CACHE_FRAMES = 16
+
+# Configs for the proxy pipeline
+# Run decode, detection, task step and response encode as separate stages, instead of serially on one thread
+PIPELINED = True
+# Max number of frames waiting between two stages, the oldest is dropped when a newer one arrives
+PIPELINE_QUEUE_SIZE = 1
+# Max seconds a frame may wait to be admitted into the pipeline before it is dropped as stale
+PIPELINE_MAX_FRAME_AGE = 0.5
+# Seconds between logs of the pipeline queue depths and drop counts
+PIPELINE_REPORT_INTERVAL = 10
+# Number of threads sending frames to the classifiers, so that the frames of different sessions are detected in parallel
+DETECTION_WORKERS = 4
+# Max seconds a request to a classifier waits for requests of other sessions' frames to be sent along with it. Raise
+# for throughput with many sessions on the same step, at the cost of latency. 0 sends each request right away
+DETECTION_BATCH_WINDOW = 0.003
+# Number of requests to a classifier sent without waiting for the rest of the window, at most DETECTION_WORKERS
+DETECTION_MAX_BATCH = DETECTION_WORKERS
+# Max number of requests in flight to each classifier
+DETECTION_MAX_CONCURRENT = 4
+# Number of worker processes decoding frames and encoding images, to use more than one core for them. 0 to do it in the
+# pipeline threads, where OpenCV already runs without holding the interpreter lock
+OFFLOAD_WORKERS = 0
+# Bytes of each shared memory buffer frames go through to the workers, the largest decoded frame offloaded (BGR)
+OFFLOAD_SLOT_BYTES = 1920 * 1080 * 3
+
+# Configs for the motion gate
+# Let frames nearly identical to the last frame detected reuse its detections, instead of sending them to the classifiers
+MOTION_GATE = True
+# Max mean absolute difference of gray levels (0 to 255) between 32x24 thumbnails of the frames, to reuse detections
+MOTION_GATE_THRESHOLD = 2.0
+# Max number of frames in a row reusing the detections of the same frame
+MOTION_GATE_MAX_REUSE = 5
+# Detect the frames that could reuse detections anyway, and count how often the reused detections would have been wrong
+MOTION_GATE_VALIDATE = False
+# Max pixels a reused bounding box corner may be off from the real one, in validation
+MOTION_GATE_TOLERANCE = 20
+
+# Configs for tracking between classifier calls
+# Move the boxes of the last frame sent to the classifiers along with the objects, sending only every few frames
+TRACKING = True
+# Number of frames tracked between classifier calls when a step starts. Grows by one per keyframe where the tracked
+# boxes matched the classifiers' (within MOTION_GATE_TOLERANCE pixels), and halves when they didn't
+TRACKING_INTERVAL = 2
+# Max number of frames tracked between classifier calls
+TRACKING_MAX_INTERVAL = 8
+# Min fraction of the points inside a box that were tracked, to trust its tracked position
+TRACKING_MIN_CONFIDENCE = 0.6
+# Width of the grayscale frames tracked on
+TRACKING_WIDTH = 160
+
+# Configs for metrics
+# Local address and port the latency histograms and counters are published on in Prometheus text format (GET /metrics),
+# None to not publish them. A summary is logged every PIPELINE_REPORT_INTERVAL seconds either way
+METRICS_HOST = "127.0.0.1"
+METRICS_PORT = 9102
+
+# Configs for the event log
+# JSON lines file of per-frame records: frame ID, state, detected objects, stability checks and step outcome. None to
+# not log them
+EVENT_LOG = "/tmp/car_events.jsonl"
+# Fraction (0 to 1) of the frames logged. State transitions and errors are always logged
+EVENT_LOG_SAMPLE_RATE = 0.05
+# Size of the event log at which it is rotated, and number of rotated files kept
+EVENT_LOG_MAX_BYTES = 10 * 1024 * 1024
+EVENT_LOG_BACKUPS = 5
+
+# Configs for client sessions
+# Seconds without frames after which a client's session, and its progress through the task, is dropped
+SESSION_IDLE_TIMEOUT = 600
+
+# Configs for guidance videos
+# Serve the guidance videos from the proxy, instead of from a separate server
+VIDEO_SERVE = True
+# Directory of the guidance videos, with their renditions in <height>p subdirectories (see video_server.py)
+VIDEO_DIRECTORY = "resources/videos"
+# Address clients are given to fetch guidance videos from, None for the address of this machine's default route interface
+VIDEO_HOST = None
+# Port of the video server
+VIDEO_PORT = 9095
+# Seconds clients may play a cached video without checking that it didn't change
+VIDEO_CACHE_MAX_AGE = 24 * 60 * 60
+# Fraction (0 to 1) of a client's measured throughput a video rendition's bitrate may take, so it downloads faster than
+# it plays
+VIDEO_BANDWIDTH_SHARE = 0.8
+
+# Configs for guidance images
+# Read and encode all guidance images at startup, instead of on first use
+PRELOAD_ASSETS = True
+# Send only the content hash of a guidance image the client was already sent in this session. Needs a client that keeps
+# the images it received
+ASSET_REFERENCES = False
+# Encoding of guidance images per client profile, chosen by the "image_profile" a client sends in its frame headers, or
+# "default". max_wh: max width and height the images are scaled down to, None for full size. quality: of photos (JPEG
+# files), sent as JPEG, None to send them as PNG. Other images are always sent as PNG
+GUIDANCE_IMAGE_PROFILES = {
+    "default": {"max_wh": 640, "quality": 85},  # DISPLAY_MAX_PIXEL wide
+    "low": {"max_wh": 320, "quality": 70},  # for small screens or weak links
+    "lossless": {"max_wh": None, "quality": None},  # full size PNG, as sent before profiles
+}
 
 # Whether or not to save the displayed image in a temporary directory
 SAVE_IMAGE = False
 
-# Max image width and height
+# Max image width and height, larger frames are decoded and detected at reduced resolution. None for full size
 IMAGE_MAX_WH = 640
 
 # Display
@@ -54,9 +172,15 @@ ROTATE_IMAGE = False
 RESIZE_IMAGE = False
 VISUALIZE_ALL = False
 
-with open('model/labels.txt', 'r') as f:
-    content = f.read().splitlines()
-    LABELS = content
+LABELS = None  # class names of model/labels.txt, read on first use by labels()
+
+
+def labels():
+    global LABELS
+    if LABELS is None:
+        with open('model/labels.txt', 'r') as f:
+            LABELS = f.read().splitlines()
+    return LABELS
 
 
 def setup(is_streaming):
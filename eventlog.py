@@ -0,0 +1,119 @@
+import json
+import logging
+import logging.handlers
+import random
+import threading
+import time
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+"""
+Structured log of the proxy's per-frame decisions, as JSON lines in rotating files. Frames are sampled, state
+transitions and errors are always logged, and records are formatted and written by a background thread, so the frame
+threads only hand them over
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class EventLog(threading.Thread):
+    """
+    Writes records handed to it with record to a rotating JSONL file, on its own thread. Callers check sampled before
+    building a record. When the writer falls behind by queue_size records, further records are dropped and counted
+    rather than blocking the caller
+    """
+    def __init__(self, path, sample_rate, max_bytes, backups, queue_size=1000):
+        """
+        :param path: of the log file, rotated to path.1, path.2, ...
+        :param sample_rate: fraction (0 to 1) of the frame records to keep
+        :param max_bytes: size of a log file at which it is rotated
+        :param backups: number of rotated log files kept
+        :param queue_size: max number of records waiting to be written
+        """
+        threading.Thread.__init__(self, name="eventlog")
+        self.daemon = True
+        self.sample_rate = sample_rate
+        self.handler = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups)
+        self.handler.setFormatter(logging.Formatter("%(message)s"))
+        self.records = queue.Queue(queue_size)
+        self.stopped = threading.Event()
+
+        self.written = 0
+        self.dropped = 0
+
+    def sampled(self, always=False):
+        """
+        Whether or not to log a record, so that callers only build the records kept
+        :param always: for transitions and errors, which aren't sampled
+        """
+        return always or random.random() < self.sample_rate
+
+    def record(self, event):
+        """
+        Hand a record over to the writer
+        :param event: dict of JSON serializable values, timestamped on the way
+        """
+        event["time"] = time.time()
+        try:
+            self.records.put_nowait(event)
+        except queue.Full:
+            self.dropped += 1
+
+    def run(self):
+        while not self.stopped.is_set() or not self.records.empty():
+            try:
+                event = self.records.get(timeout=0.1)
+            except queue.Empty:
+                continue
+            try:
+                self.handler.emit(logging.makeLogRecord({"msg": json.dumps(event, default=str)}))
+                self.written += 1
+            except Exception:
+                LOG.exception("failed to write event %s" % event)
+
+    def stop(self):
+        """
+        Write the records still waiting, and close the file
+        """
+        self.stopped.set()
+        self.join()
+        self.handler.close()
+
+    def stats(self):
+        """
+        Returns the number of records written, waiting and dropped for the writer falling behind
+        """
+        return {"written": self.written, "waiting": self.records.qsize(), "dropped": self.dropped}
+
+
+events = None  # EventLog of this process, None until started
+
+
+def start(path, sample_rate, max_bytes, backups):
+    """
+    Start logging events to a file
+    :return: the EventLog writer thread
+    """
+    global events
+    events = EventLog(path, sample_rate, max_bytes, backups)
+    events.start()
+    LOG.info("logging %.0f%% of frames and every transition and error to %s" % (sample_rate * 100, path))
+    return events
+
+
+def sampled(always=False):
+    """
+    Whether or not to build a record for the event log, False if it isn't started
+    """
+    return events is not None and events.sampled(always)
+
+
+def record(event):
+    """
+    Log a record, if the event log is started. Frame records are built and logged only if sampled
+    """
+    if events is not None:
+        events.record(event)
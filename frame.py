@@ -0,0 +1,254 @@
+import hashlib
+import struct
+import threading
+
+import cv2
+import numpy as np
+
+import metrics
+import util
+
+"""
+Frames from the client, which are decoded and converted only when something reads their pixels
+"""
+
+# OpenCV decode modes that scale a JPEG down while decoding it, by factor. Missing before OpenCV 3.2
+reduced_modes = [(factor, getattr(cv2, "IMREAD_REDUCED_COLOR_%d" % factor)) for factor in (8, 4, 2)
+                 if hasattr(cv2, "IMREAD_REDUCED_COLOR_%d" % factor)]
+
+# the same for grayscale
+reduced_gray_modes = [(factor, getattr(cv2, "IMREAD_REDUCED_GRAYSCALE_%d" % factor)) for factor in (8, 4, 2)
+                      if hasattr(cv2, "IMREAD_REDUCED_GRAYSCALE_%d" % factor)]
+
+# JPEG start of frame markers, which hold the image size (all 0xC0 to 0xCF but DHT, JPG and DAC)
+sof_markers = set(range(0xC0, 0xD0)) - {0xC4, 0xC8, 0xCC}
+
+
+class Frame:
+    """
+    A JPEG frame as sent by the client. Keeps the original bytes and computes the decoded, grayscale, resized and JPEG
+    views on demand, caching each of them. When the frame isn't rotated, resized or capped, its JPEG view is the original
+    bytes
+
+    Frames larger than max_wh are decoded at reduced resolution. Bounding boxes are still given in the coordinates of
+    the full size frame (full_shape), scale maps between the two
+
+    With an offload.ProcessPool, decoding and JPEG encoding run in its worker processes
+    """
+    def __init__(self, data, rotate=False, resize=False, max_wh=None, pool=None):
+        """
+        :param data: JPEG bytes from the client
+        :param rotate: rotate the frame by 90 degrees when decoding it
+        :param resize: resize the frame to 720x480 when decoding it
+        :param max_wh: max width and height of the decoded image, None for full size
+        :param pool: offload.ProcessPool to decode and encode in, None to do it in the calling thread
+        """
+        self.data = data
+        self.rotate = rotate
+        self.resize = resize
+        self.max_wh = max_wh
+        self.pool = pool
+        self.lock = threading.RLock()  # views may be requested from different pipeline stages, and build on others
+        self.views = {}  # view name -> cached view
+
+    def view(self, name, compute):
+        """
+        Returns a cached view, computing it on first use
+        """
+        with self.lock:
+            if name not in self.views:
+                self.views[name] = compute()
+            return self.views[name]
+
+    def image(self):
+        """
+        Returns the decoded (and rotated/resized, if set) BGR image, at most max_wh wide and high
+        """
+        return self.view("image", self.decode)
+
+    @metrics.timed("decode")
+    def decode(self):
+        target = self.target_size()
+        if self.pool is not None:
+            return self.pool.run(decode, self.data, self.rotate, self.resize, target)
+        return decode(self.data, self.rotate, self.resize, target)
+
+    def full_shape(self):
+        """
+        Returns the shape of the frame at full size (after rotating/resizing), the coordinate space of its bounding boxes
+        """
+        if self.resize:
+            return 480, 720, 3
+        return self.view("full_shape", lambda: jpeg_shape(self.data) or util.preprocess(self.data, self.rotate).shape)
+
+    def target_size(self):
+        """
+        Returns the (width, height) the frame is decoded at when it is larger than max_wh, otherwise None
+        """
+        if self.max_wh is None:
+            return None
+        height, width = self.full_shape()[:2]
+        if max(height, width) <= self.max_wh:
+            return None
+        ratio = float(self.max_wh) / max(height, width)
+        return max(1, int(round(width * ratio))), max(1, int(round(height * ratio)))
+
+    def scale(self):
+        """
+        Returns the (x, y) factors from decoded image coordinates to full size frame coordinates
+        """
+        target = self.target_size()
+        if target is None:
+            return 1.0, 1.0
+        height, width = self.full_shape()[:2]
+        return float(width) / target[0], float(height) / target[1]
+
+    def crop(self, dims):
+        """
+        Returns the region of the decoded image inside a bounding box given in full size frame coordinates
+        :param dims: [top-left x, top-left y, bottom-right x, bottom-right y]
+        """
+        sx, sy = self.scale()
+        return self.image()[int(dims[1] / sy):int(dims[3] / sy), int(dims[0] / sx):int(dims[2] / sx)]
+
+    def gray(self):
+        """
+        Returns the grayscale image
+        """
+        return self.view("gray", lambda: cv2.cvtColor(self.image(), cv2.COLOR_BGR2GRAY))
+
+    def resized(self, width, height):
+        """
+        Returns the image resized to width x height
+        """
+        return self.view(("resized", width, height), lambda: cv2.resize(self.image(), (width, height)))
+
+    def thumbnail(self, width, height):
+        """
+        Returns a small grayscale version of the frame, width x height. Unless the frame is already decoded (or rotated),
+        it is decoded for this at the smallest reduced resolution still at least that size, which is several times
+        cheaper than a full decode
+        """
+        return self.view(("thumbnail", width, height), lambda: self.decode_thumbnail(width, height))
+
+    def decode_thumbnail(self, width, height):
+        img = None
+        shape = jpeg_shape(self.data) if "image" not in self.views and not self.rotate else None
+        for factor, mode in reduced_gray_modes if shape is not None else []:
+            if shape[1] // factor >= width and shape[0] // factor >= height:
+                img = cv2.imdecode(np.frombuffer(self.data, dtype=np.uint8), mode)
+                break
+        if img is None:
+            img = self.gray()
+        if (img.shape[1], img.shape[0]) == (width, height):
+            return img
+        return cv2.resize(img, (width, height), interpolation=cv2.INTER_AREA)
+
+    def jpeg(self):
+        """
+        Returns the frame JPEG encoded, which is the original bytes unless the frame is rotated, resized or capped
+        """
+        if not self.rotate and not self.resize and self.target_size() is None:
+            return self.data
+        if self.pool is not None:
+            return self.view("jpeg", lambda: self.pool.run(encode_jpeg, self.image()))
+        return self.view("jpeg", lambda: encode_jpeg(self.image()))
+
+    def shape(self):
+        """
+        Returns the shape of the decoded image, without decoding it if it isn't
+        """
+        if "image" in self.views:
+            return self.image().shape
+        target = self.target_size()
+        if target is None:
+            return self.full_shape()
+        return (target[1], target[0]) + tuple(self.full_shape()[2:])
+
+    def digest(self):
+        """
+        Returns a hash of the original bytes, which identifies the frame
+        """
+        return self.view("digest", lambda: hashlib.sha1(self.data).hexdigest())
+
+
+def decode(data, rotate, resize, target):
+    """
+    Decode a frame from the client, as for Frame.image. Runs in the offload worker processes as well
+    :param data: JPEG bytes, or a uint8 array of them
+    :param rotate: rotate the frame by 90 degrees
+    :param resize: resize the frame to 720x480
+    :param target: (width, height) to decode the frame at, None for full size
+    """
+    if isinstance(data, np.ndarray):
+        data = data.tobytes()  # as the workers get it, for reading the JPEG header
+    if target is None:
+        return util.preprocess(data, rotate, resize)
+
+    # decode at the smallest reduced resolution that is still at least the target size, then resize to it
+    shape = jpeg_shape(data)
+    img = None
+    for factor, mode in reduced_modes if shape is not None else []:
+        if shape[1] // factor >= target[0] and shape[0] // factor >= target[1]:
+            img = cv2.imdecode(np.frombuffer(data, dtype=np.uint8), mode)
+            break
+    if img is None:
+        img = util.raw2cv_image(data)
+    if rotate:
+        img = util.rotate_90(img)
+    if (img.shape[1], img.shape[0]) != target:
+        # area averaging only pays off when shrinking by 2 or more, bilinear is several times faster otherwise
+        shrink = float(img.shape[1]) / target[0]
+        img = cv2.resize(img, target, interpolation=cv2.INTER_AREA if shrink >= 2 else cv2.INTER_LINEAR)
+    return img
+
+
+def encode_jpeg(img):
+    return cv2.imencode('.jpg', img)[1].tobytes()
+
+
+def jpeg_shape(data):
+    """
+    Read the image shape from a JPEG's start of frame header
+    :param data: JPEG bytes
+    :return: (height, width, channels), or None if no header is found
+    """
+    i = 2  # after the start of image marker
+    while i + 9 < len(data):
+        if bytearray(data[i:i + 1])[0] != 0xFF:
+            return None
+        marker = bytearray(data[i + 1:i + 2])[0]
+        if marker == 0xFF:  # fill byte
+            i += 1
+            continue
+        if marker in sof_markers:
+            height, width, channels = struct.unpack(">HHB", data[i + 5:i + 10])
+            return height, width, channels
+        length, = struct.unpack(">H", data[i + 2:i + 4])
+        i += 2 + length
+    return None
+
+
+def crop(img, dims):
+    """
+    Returns the region of a Frame or image array inside a bounding box, given in full size frame coordinates
+    """
+    if isinstance(img, Frame):
+        return img.crop(dims)
+    return img[int(dims[1]):int(dims[3]), int(dims[0]):int(dims[2])]
+
+
+def scale_detections(detected_objs, img):
+    """
+    Map the bounding boxes of objects detected in a Frame's decoded image to full size frame coordinates. Normed
+    dimensions are unchanged
+    """
+    if not isinstance(img, Frame):
+        return detected_objs
+    sx, sy = img.scale()
+    if sx == 1.0 and sy == 1.0:
+        return detected_objs
+    for obj in detected_objs:
+        d = obj["dimensions"]
+        obj["dimensions"] = [d[0] * sx, d[1] * sy, d[2] * sx, d[3] * sy]
+    return detected_objs
@@ -0,0 +1,227 @@
+import bisect
+import functools
+import logging
+import threading
+import time
+from collections import OrderedDict
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+
+"""
+Latency histograms and counters of the proxy's frame processing, published in Prometheus text format on a local port
+and summarized in a periodic log line
+"""
+
+LOG = logging.getLogger(__name__)
+
+# upper bounds of the latency histogram buckets, in seconds
+latency_buckets = [0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30]
+
+
+class Histogram:
+    """
+    Counts of observed values in buckets, with their sum
+    """
+    def __init__(self, buckets):
+        """
+        :param buckets: increasing upper bounds of the buckets, a last bucket for larger values is added
+        """
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q):
+        """
+        Estimate a quantile (0 to 1) of the observed values, interpolating inside its bucket
+        """
+        if self.count == 0:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for i in range(len(self.counts)):
+            if seen + self.counts[i] >= rank and self.counts[i] > 0:
+                lower = self.buckets[i - 1] if i > 0 else 0.0
+                upper = self.buckets[i] if i < len(self.buckets) else self.buckets[-1]
+                return lower + (upper - lower) * (rank - seen) / self.counts[i]
+            seen += self.counts[i]
+        return self.buckets[-1]
+
+
+class Registry:
+    """
+    Latency histograms by stage and counters by name and label
+    """
+    def __init__(self, prefix="car"):
+        """
+        :param prefix: of the metric names
+        """
+        self.prefix = prefix
+        self.latencies = OrderedDict()  # stage -> Histogram of seconds
+        self.counters = OrderedDict()  # counter name -> {(label name, label value) or None -> count}
+        self.lock = threading.Lock()  # observed from the pipeline stages and read from the metrics server
+
+    def observe(self, stage, seconds):
+        """
+        Record the time spent in a stage
+        """
+        with self.lock:
+            if stage not in self.latencies:
+                self.latencies[stage] = Histogram(latency_buckets)
+            self.latencies[stage].observe(seconds)
+
+    def increment(self, name, label=None, amount=1):
+        """
+        Add to a counter
+        :param name: of the counter
+        :param label: (label name, label value) pair, None for an unlabeled counter
+        """
+        with self.lock:
+            if name not in self.counters:
+                self.counters[name] = OrderedDict()
+            self.counters[name][label] = self.counters[name].get(label, 0) + amount
+
+    def render(self):
+        """
+        Returns all metrics in Prometheus text exposition format
+        """
+        lines = []
+        with self.lock:
+            name = self.prefix + "_latency_seconds"
+            lines.append("# HELP %s Time spent per frame processing stage" % name)
+            lines.append("# TYPE %s histogram" % name)
+            for stage, histogram in self.latencies.items():
+                cumulative = 0
+                for i in range(len(histogram.buckets)):
+                    cumulative += histogram.counts[i]
+                    lines.append('%s_bucket{stage="%s",le="%s"} %d' % (name, stage, histogram.buckets[i], cumulative))
+                lines.append('%s_bucket{stage="%s",le="+Inf"} %d' % (name, stage, histogram.count))
+                lines.append('%s_sum{stage="%s"} %f' % (name, stage, histogram.sum))
+                lines.append('%s_count{stage="%s"} %d' % (name, stage, histogram.count))
+
+            for counter, values in self.counters.items():
+                name = "%s_%s_total" % (self.prefix, counter)
+                lines.append("# TYPE %s counter" % name)
+                for label, value in values.items():
+                    labels = '{%s="%s"}' % label if label is not None else ""
+                    lines.append("%s%s %d" % (name, labels, value))
+        return "\n".join(lines) + "\n"
+
+    def summary(self):
+        """
+        Returns a one line summary of the count, median and 95th percentile of each stage, and of the counters
+        """
+        with self.lock:
+            parts = []
+            for stage, histogram in self.latencies.items():
+                parts.append("%s n=%d p50=%.1fms p95=%.1fms" % (stage, histogram.count,
+                                                               histogram.quantile(0.5) * 1000,
+                                                               histogram.quantile(0.95) * 1000))
+            for counter, values in self.counters.items():
+                for label, value in values.items():
+                    parts.append("%s%s=%d" % (counter, "[%s]" % label[1] if label is not None else "", value))
+            return ", ".join(parts)
+
+
+class Timer:
+    """
+    Context manager recording the time spent in its block as a stage's latency
+    """
+    def __init__(self, registry, stage):
+        self.registry = registry
+        self.stage = stage
+
+    def __enter__(self):
+        self.start = time.time()
+        return self
+
+    def __exit__(self, *exc_info):
+        self.registry.observe(self.stage, time.time() - self.start)
+        return False
+
+
+class MetricsServer(threading.Thread):
+    """
+    Serves the metrics of a registry to Prometheus on GET /metrics
+    """
+    def __init__(self, registry, host, port):
+        threading.Thread.__init__(self, name="metrics")
+        self.daemon = True
+        self.server = HTTPServer((host, port), MetricsHandler)
+        self.server.registry = registry
+
+    def run(self):
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = self.server.registry.render().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, *args):
+        pass
+
+
+registry = Registry()  # metrics of this process
+
+
+def observe(stage, seconds):
+    registry.observe(stage, seconds)
+
+
+def increment(name, label=None, amount=1):
+    registry.increment(name, label, amount)
+
+
+def timer(stage):
+    """
+    Returns a context manager recording the time spent in its block as the latency of a stage
+    """
+    return Timer(registry, stage)
+
+
+def timed(stage):
+    """
+    Decorator recording the time spent in each call of a function as the latency of a stage
+    """
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with Timer(registry, stage):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def summary():
+    return registry.summary()
+
+
+def serve(host, port):
+    """
+    Start publishing the metrics on http://host:port/metrics
+    :return: the MetricsServer thread
+    """
+    server = MetricsServer(registry, host, port)
+    server.start()
+    LOG.info("metrics on http://%s:%d/metrics" % (host, port))
+    return server
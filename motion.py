@@ -0,0 +1,96 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import frame
+
+"""
+Frame difference gate, which lets frames of a scene that isn't moving reuse the detections of an earlier frame instead
+of being sent to the classifiers again. While the user holds a part still for the stable checks, consecutive frames are
+nearly identical, so their detections would be too
+"""
+
+
+class MotionGate:
+    """
+    Compares each frame of a session to the last frame that got detections of its own (the reference frame), from the
+    classifiers or tracking.BoxTracker, on a tiny grayscale thumbnail. Frames that differ from it by less than a
+    threshold reuse its detections, others are detected and become the new reference. A reference is reused for at
+    most max_reuse frames, so detections are refreshed regularly even in a static scene
+    """
+    def __init__(self, threshold, max_reuse, size=(32, 24)):
+        """
+        :param threshold: max mean absolute difference of the thumbnails' gray levels (0 to 255) to reuse detections
+        :param max_reuse: max number of frames reusing the same reference frame's detections
+        :param size: (width, height) of the thumbnails
+        """
+        self.threshold = threshold
+        self.max_reuse = max_reuse
+        self.size = size
+
+        self.reference_id = None  # frame ID of the reference frame
+        self.reference = None  # thumbnail of the reference frame
+        self.reuse_count = 0  # frames that reused the reference frame's detections
+        self.checked = OrderedDict()  # frame ID -> result of check, for frames checked again later in the pipeline
+        self.lock = threading.Lock()  # frames of a session may be checked from several detection threads
+
+        self.frames = 0
+        self.reused = 0
+
+    def check(self, img, frame_id):
+        """
+        Decide whether a frame can reuse the detections of the reference frame
+        :param img: a frame.Frame or an image array
+        :param frame_id: ID of the frame
+        :return: ID of the frame whose detections it may reuse, or None if it is to be detected
+        """
+        thumbnail = self.thumbnail(img)
+        with self.lock:
+            if frame_id in self.checked:
+                return self.checked[frame_id]
+
+            out = None
+            self.frames += 1
+            # a frame overtaken by a newer one in another detection thread is detected, without becoming the reference
+            if self.reference is None or frame_id > self.reference_id:
+                if self.reference is not None and self.reuse_count < self.max_reuse and \
+                        difference(thumbnail, self.reference) < self.threshold:
+                    out = self.reference_id
+                    self.reuse_count += 1
+                    self.reused += 1
+                else:
+                    self.reference_id = frame_id
+                    self.reference = thumbnail
+                    self.reuse_count = 0
+
+            self.checked[frame_id] = out
+            while len(self.checked) > 8:
+                self.checked.popitem(last=False)
+            return out
+
+    def thumbnail(self, img):
+        if isinstance(img, frame.Frame):
+            return img.thumbnail(self.size[0], self.size[1])
+        return cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), self.size, interpolation=cv2.INTER_AREA)
+
+    def reset(self):
+        with self.lock:
+            self.reference_id = None
+            self.reference = None
+            self.reuse_count = 0
+            self.checked.clear()
+
+    def stats(self):
+        """
+        Returns the number of frames checked and of frames that reused detections
+        """
+        return {"frames": self.frames, "reused": self.reused}
+
+
+def difference(a, b):
+    """
+    Returns the mean absolute difference of two grayscale images of the same size
+    """
+    return float(np.mean(cv2.absdiff(a, b)))
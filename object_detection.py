@@ -1,9 +1,21 @@
 import requests
+import requests.adapters
 import cv2
+import numpy as np
 import ast
-import docker
 import time
 import atexit
+import threading
+import hashlib
+import json
+import logging
+from collections import OrderedDict, defaultdict
+
+import eventlog
+import frame
+import metrics
+
+LOG = logging.getLogger(__name__)
 
 class Detector:
     """
@@ -16,8 +28,36 @@ class Detector:
     1. the image
     2. what objects you want to detect
     """
-    def __init__(self, url):
+    def __init__(self, url, max_resident=1, start_timeout=30, connect_timeout=1, read_timeout=5, cache_frames=1,
+                 endpoints=None, mode="live", trace=None, replay_latency=False, batch_window=0, max_batch=1,
+                 max_concurrent=4, validate_reuse=False, reuse_tolerance=20):
+        """
+        :param url: of the first TPOD classifier port e.g. http://0.0.0.0:8000. Further resident classifiers are
+                    published on the ports following it
+        :param max_resident: max number of classifier containers kept running at the same time
+        :param start_timeout: max seconds to wait for a newly started classifier to answer requests
+        :param connect_timeout: max seconds to connect to a classifier
+        :param read_timeout: max seconds to wait for a classifier's detections
+        :param cache_frames: number of most recent frames to keep detections of, more than 1 when frames are detected
+                             ahead of the task
+        :param endpoints: dict of classifier image ID -> URL of a classifier that is already running, e.g. outside of
+                          Docker. When given, no containers are started and url is unused
+        :param mode: "live" to detect with TPOD, "record" to also append every TPOD response to the trace file, or
+                     "replay" to serve detections from the trace file, without Docker or HTTP
+        :param trace: path of the trace file, for record and replay modes
+        :param replay_latency: in replay mode, wait for as long as the recorded request took
+        :param batch_window: max seconds a request waits for requests of other frames to the same classifier to be sent
+                             along with it, 0 to send each right away
+        :param max_batch: number of requests that are sent without waiting for the rest of the window
+        :param max_concurrent: max number of requests in flight to each classifier
+        :param validate_reuse: detect frames allowed to reuse an earlier frame's detections anyway, and count how often
+                               the reused detections differ from the real ones
+        :param reuse_tolerance: max pixels a reused bounding box corner may be off to still match the real one
+        """
         self.tpod_url = url
+        self.tpod = TPODClient(connect_timeout, read_timeout, max_concurrent)  # HTTP client kept alive across frames
+        # groups requests of frames of different sessions to the same classifier
+        self.scheduler = DetectionScheduler(self.tpod, batch_window, max_batch, max_concurrent)
 
         """
         registry of TPOD classifier docker image IDs and the objects they should be used to recognize 
@@ -71,55 +111,101 @@ class Detector:
 
         # reverse look up dict
         self.objs_to_docker_image = {}
-        for url in self.docker_image_to_objs.keys():
-            objs = self.docker_image_to_objs[url]
+        for image_id in self.docker_image_to_objs.keys():
+            objs = self.docker_image_to_objs[image_id]
             for o in objs:
-                self.objs_to_docker_image[o] = url
+                self.objs_to_docker_image[o] = image_id
 
-        self.last_id = None  # image ID of last classifier (to determine whether or not to spin up a new one)
-        self.cache = []  # cache of detected objects to avoid multiple calls with same image. wiped on new frame
+        self.last_id = None  # frame ID of last detection
+        self.cache = DetectionCache(cache_frames)  # cache of detected objects to avoid multiple calls with same image and classifier
 
-        # Docker API to spin up/destroy containers
-        self.client = docker.from_env()
-        self.last_image = None
-        self.container = None
+        self.last_image = None  # image ID of last classifier used
+        self.last_url = None  # URL of last classifier used
+        self.lock = threading.Lock()  # guards last_image/last_url, detect_object may be called from several threads
+
+        self.validate_reuse = validate_reuse
+        self.reuse_tolerance = reuse_tolerance
+        self.reuse_stats = {"avoided": 0, "validated": 0, "mismatched": 0}  # detections of static frames reused
+
+        if mode not in ("live", "record", "replay"):
+            raise ValueError("Unknown detector mode %s" % mode)
+        self.mode = mode
+        self.trace = DetectionTrace(trace, mode == "replay") if mode != "live" else None
+        self.replay_latency = replay_latency
+
+        if mode == "replay":
+            self.pool = StaticClassifiers({})
+        elif endpoints is not None:
+            self.pool = StaticClassifiers(endpoints)
+        else:
+            # containers are spun up/destroyed through the Docker API, connected to on the first classifier switch
+            host, base_port = self.tpod_url.rsplit(":", 1)
+            self.pool = ClassifierPool(None, host, int(base_port), max_resident, start_timeout)
 
         atexit.register(self.cleanup)
 
+    def classifier_for(self, objects, image_id=None):
+        """
+        Look up the Docker image ID of the classifier that detects certain objects
+        :param objects: to detect
+        :param image_id: overrides registry look up
+        :return: Docker image ID
+        """
+        if image_id is not None:
+            return image_id
+
+        image_for_objects = None
+        for obj in objects:
+            if obj not in self.objs_to_docker_image.keys():
+                raise ValueError("Unknown object %s. Make sure object is registered in object_detection.py" % obj)
+            image_for_objects = self.objs_to_docker_image[obj]
+        return image_for_objects
 
     def init_docker_classifier(self, objects, image_id=None):
         """
-        Spin up the Docker container to detect certain objects
+        Make sure the Docker container to detect certain objects is running
+        Containers already resident in the pool are reused, otherwise one is started (possibly evicting another)
         :param objects: to detect
         :param image_id: overrides registry look up and spins up a specific classifier by image ID
+        :return: URL of the classifier
         """
-        if image_id is not None:
-            image_for_objects = image_id
-        else:
-            for obj in objects:
-                if obj not in self.objs_to_docker_image.keys():
-                    raise ValueError("Unknown object %s. Make sure object is registered in object_detection.py")
-                image_for_objects = self.objs_to_docker_image[obj]
+        image_for_objects = self.classifier_for(objects, image_id)
 
-        if image_for_objects == self.last_image:
-            return
+        with self.lock:
+            if image_for_objects == self.last_image and self.pool.is_resident(image_for_objects):
+                return self.last_url  # same classifier as last time, not a switch
 
-        self.last_image = image_for_objects
-        self.cleanup()
-        self.container = self.client.containers.run(image_for_objects,
-                                                    "/bin/bash run_server.sh",
-                                                    ports={8000: "8000/tcp"},
-                                                    remove=True,
-                                                    detach=True,
-                                                    runtime="nvidia")
-        time.sleep(4)
+        # not holding the lock while a container starts, so that other sessions' detections on resident ones go on
+        with metrics.timer("classifier_switch"):
+            url = self.pool.acquire(image_for_objects)
+        metrics.increment("classifier_switches")
+        with self.lock:
+            self.last_image = image_for_objects
+            self.last_url = url
+        return url
 
 
+    def prewarm(self, objects, image_id=None):
+        """
+        Start the classifier for certain objects in the background, ahead of when it is needed
+        :param objects: to detect
+        :param image_id: overrides registry look up and spins up a specific classifier by image ID
+        """
+        self.pool.prewarm(self.classifier_for(objects, image_id))
+
+    def prewarm_stats(self):
+        """
+        Returns counts of classifier switches that were served by a pre-warmed container that was ready ("hits") or
+        still starting ("late"), by one resident from an earlier use ("resident") and that had to cold start one
+        ("misses"), and the number of pre-warms started
+        """
+        return dict(self.pool.stats)
+
     def detect_object(self, img, objects, f_id, image_id=None):
         """
         Detects objects in an image
 
-        :param img: to detect
+        :param img: to detect, a frame.Frame or an image array
         :param objects: expected in the img to detect
         :param f_id: frame ID to determine whether or not use cache
         :param image_id: overrides registry look up and spins up a specific classifier by image ID
@@ -132,119 +218,903 @@ class Detector:
             "confidence": confidence of detection (0 to 1)
             }
         """
-        # clear cache if new frame
-        if f_id != self.last_id:
-            self.last_id = f_id
-            self.cache = []
+        self.last_id = f_id
+        classifier = self.classifier_for(objects, image_id)
 
-        self.init_docker_classifier(objects, image_id)
+        out = self.cache.get(f_id, classifier, objects)
+        if out is not None:
+            return out
 
-        out = []
+        # nearly identical to an earlier frame, see motion.MotionGate
+        reused = self.cache.reusable(f_id, classifier)
+        if reused is not None and not self.validate_reuse:
+            with self.lock:
+                self.reuse_stats["avoided"] += 1
+            return self.cache.put(f_id, classifier, reused, objects)
 
-        if len(self.cache) == 0:
-            detected_objs = tpod_request(img, self.tpod_url)
-            self.cache = detected_objs
-        else:
-            detected_objs = self.cache
+        if self.mode == "replay":
+            detected_objs = self.replay(img, f_id, classifier)
+            self.check_reused(reused, detected_objs)
+            return self.cache.put(f_id, classifier, detected_objs, objects)
 
-        for d in detected_objs:
-            if d["class_name"] in objects:
-                out.append(d)
+        try:
+            url = self.init_docker_classifier(objects, image_id)
+            if self.mode == "record":
+                detected_objs = self.record(img, f_id, classifier, url)
+            else:
+                detected_objs = tpod_request(img, url, self.scheduler)
+        except (requests.exceptions.RequestException, ClassifierStartError):
+            return []  # classifier unreachable or too slow, skip it rather than block on it. not cached, so retried
 
-        return out
+        self.check_reused(reused, detected_objs)
+        return self.cache.put(f_id, classifier, detected_objs, objects)
 
-    def color_detected_object(self, color_dict):
+    def check_reused(self, reused, detected_objs):
+        """
+        In validate_reuse mode, count whether the detections a frame could have reused match its real ones
+        """
+        if reused is None:
+            return
+        match = detections_match(reused, detected_objs, self.reuse_tolerance)
+        with self.lock:
+            self.reuse_stats["validated"] += 1
+            if not match:
+                self.reuse_stats["mismatched"] += 1
+
+    def record(self, img, f_id, classifier, url):
+        """
+        Detect with TPOD like tpod_request, appending the response to the trace
+        """
+        img_encoded, shape = encode_for_tpod(img)
+        start = time.time()
+        converted = self.scheduler.detect(img_encoded, url)
+        latency = time.time() - start
+
+        self.trace.append(f_id, frame_hash(img), classifier, latency, shape, converted)
+        return frame.scale_detections(suppress_overlapping(converted, shape), img)
+
+    def replay(self, img, f_id, classifier):
+        """
+        Serve the detections of a frame and classifier from the trace, by frame hash if the frame was recorded and
+        otherwise by frame ID
+        :return: detected objects, empty if the trace has none
+        """
+        entry = self.trace.lookup(f_id, frame_hash(img) if img is not None else None, classifier)
+        if entry is None:
+            return []
+
+        if self.replay_latency:
+            time.sleep(entry["latency"])
+        return frame.scale_detections(suppress_overlapping(entry["response"], entry["shape"]), img)
+
+    def color_detected_object(self, color_dict, f_id=None):
         """
         Adds a color field to detected object in cache
         :param color_dict: mapping objects to colors
+        :param f_id: frame ID, defaults to the frame of the last detect_object call
         """
-        for obj in self.cache:
+        for obj in self.cache.all(self.last_id if f_id is None else f_id):
             if obj["class_name"] in color_dict.keys():
                 obj["color"] = color_dict[obj["class_name"]]
 
-    def all_detected_objects(self):
+    def all_detected_objects(self, f_id=None):
         """
         Returns all object detections from this frame, regardless of the objects requested in detect_object call
-        :return: list of detected objects
+        :param f_id: frame ID, defaults to the frame of the last detect_object call
+        :return: list of detected objects, of all classifiers used on this frame
         """
-        return self.cache[:]
+        return self.cache.all(self.last_id if f_id is None else f_id)
 
     def cleanup(self):
         """
-        Stop Docker container if it's running
+        Stop all running Docker containers
         """
-        if self.container is not None:
-            self.container.kill()
-            self.container = None
+        self.pool.cleanup()
+        if self.trace is not None:
+            self.trace.close()
+        self.last_image = None
+        self.last_url = None
 
     def reset(self):
         """
         Reset detector for a new client connection
+        Resident classifiers are kept running, since the new client goes through the same steps
         """
         self.last_image = None
-        self.cleanup()
+        self.last_url = None
+        self.last_id = None
+        self.cache.clear()
+
+
+class DetectionCache:
+    """
+    Detected objects of the most recent frames, per classifier
+
+    A frame is sent to each classifier at most once: later look ups of the same frame and classifier, for any objects,
+    are answered from the cache. Empty detections are cached too, since "nothing there" is a valid answer. Detections
+    are indexed by class, so look ups don't filter the whole list. Only the last max_frames frames are kept, so that
+    a pipeline stage detecting ahead on a new frame does not wipe the frame the task is still on.
+    """
+    def __init__(self, max_frames=1):
+        """
+        :param max_frames: number of most recent frames to keep detections of
+        """
+        self.max_frames = max_frames
+        self.frames = OrderedDict()  # frame ID -> {classifier image ID -> (detected objects, {class: positions})}
+        self.references = OrderedDict()  # frame ID -> ID of an earlier frame whose detections it may reuse
+        self.lock = threading.Lock()  # detections may be looked up and cached from different pipeline stages
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, f_id, classifier, objects):
+        """
+        Look up the cached detections of certain objects
+        :param f_id: frame ID
+        :param classifier: image ID of the classifier
+        :param objects: to look up
+        :return: list of detected objects of those classes in detection order, or None if not cached
+        """
+        with self.lock:
+            if f_id not in self.frames or classifier not in self.frames[f_id]:
+                self.misses += 1
+                return None
+            self.hits += 1
+            return self.select(f_id, classifier, objects)
+
+    def select(self, f_id, classifier, objects):
+        """
+        Returns the cached detections of certain objects of a frame, in detection order
+        """
+        detected_objs, by_class = self.frames[f_id][classifier]
+        positions = []
+        for obj in objects:
+            positions.extend(by_class.get(obj, []))
+        positions.sort()
+        return [detected_objs[p] for p in positions]
+
+    def put(self, f_id, classifier, detected_objs, objects):
+        """
+        Cache the detections of a classifier, dropping the oldest frame if there are too many
+        :return: list of detected objects of the given classes in detection order
+        """
+        by_class = defaultdict(list)
+        for p in range(len(detected_objs)):
+            by_class[detected_objs[p]["class_name"]].append(p)
+
+        with self.lock:
+            if f_id not in self.frames:
+                self.frames[f_id] = OrderedDict()
+                while len(self.frames) > self.max_frames:
+                    self.frames.popitem(last=False)
+            self.frames[f_id][classifier] = (detected_objs, by_class)
+            return self.select(f_id, classifier, objects)
+
+    def reuse(self, f_id, reference_id):
+        """
+        Let a frame reuse the detections of an earlier, nearly identical frame, for the classifiers the earlier one was
+        sent to
+        """
+        with self.lock:
+            self.references[f_id] = reference_id
+            while len(self.references) > self.max_frames:
+                self.references.popitem(last=False)
+
+    def reusable(self, f_id, classifier):
+        """
+        Returns the detections of a classifier a frame may reuse from its reference frame, or None if there are none.
+        The reference frame is kept as the newest frame, so that it isn't dropped while frames still reuse it
+        """
+        with self.lock:
+            reference_id = self.references.get(f_id)
+            if reference_id not in self.frames or classifier not in self.frames[reference_id]:
+                return None
+            self.frames[reference_id] = self.frames.pop(reference_id)
+            return [uncolored(obj) for obj in self.frames[reference_id][classifier][0]]
 
+    def detections(self, f_id):
+        """
+        Returns dict of classifier image ID -> detected objects, of the classifiers used on a frame
+        """
+        with self.lock:
+            return dict((classifier, [uncolored(obj) for obj in entry[0]])
+                        for classifier, entry in self.frames.get(f_id, {}).items())
 
-def tpod_request(img, url):
+    def all(self, f_id):
+        """
+        Returns the detections of all classifiers used on a frame
+        """
+        with self.lock:
+            out = []
+            for detected_objs, _ in self.frames.get(f_id, {}).values():
+                out.extend(detected_objs)
+            return out
+
+    def clear(self):
+        with self.lock:
+            self.frames = OrderedDict()
+            self.references = OrderedDict()
+
+    def stats(self):
+        return {"hits": self.hits, "misses": self.misses}
+
+
+class ClassifierPool:
+    """
+    Bounded pool of resident TPOD classifier containers, each published on its own host port
+
+    Starting a classifier takes several seconds, so containers are kept running after use and switching back to one is
+    free. When the pool is full, the least recently used container is killed to make room for a new one.
+    Containers can also be pre-warmed in the background before they are needed.
+    """
+    def __init__(self, client, host, base_port, max_resident, start_timeout):
+        """
+        :param client: Docker API client, None to connect to Docker when the first container is started
+        :param host: URL of the Docker host, without port e.g. http://0.0.0.0
+        :param base_port: first host port to publish classifiers on
+        :param max_resident: max number of containers running at the same time
+        :param start_timeout: max seconds to wait for a new classifier to answer requests
+        """
+        self.client = client
+        self.host = host
+        self.max_resident = max(1, max_resident)
+        self.start_timeout = start_timeout
+
+        self.free_ports = [base_port + i for i in range(self.max_resident)]
+        self.next_port = base_port + self.max_resident  # for when the free ports are held by evicted containers
+        self.resident = OrderedDict()  # image ID -> ResidentClassifier, least recently used first
+        self.lock = threading.Lock()
+
+        # classifier switches served by a pre-warmed container that was ready (hits) or still starting up (late), by
+        # one resident from an earlier use (resident), or that had to start a container (misses)
+        self.stats = {"hits": 0, "late": 0, "resident": 0, "misses": 0, "prewarms": 0}
+
+    def url(self, port):
+        return "%s:%s" % (self.host, port)
+
+    def docker(self):
+        """
+        Returns the Docker API client, connecting on first use. The docker package is imported only then, since it
+        takes a noticeable part of the proxy's startup and isn't needed with TPOD_ENDPOINTS or in replay mode
+        """
+        with self.lock:
+            if self.client is None:
+                import docker
+                self.client = docker.from_env()
+            return self.client
+
+    def is_resident(self, image_id):
+        return image_id in self.resident
+
+    def acquire(self, image_id):
+        """
+        Get the URL of a running classifier, starting its container if it is not resident
+        Blocks until the classifier answers requests
+        :param image_id: Docker image ID of the classifier
+        :return: URL of the classifier
+        :raises ClassifierStartError: if the container failed to start or didn't answer within start_timeout. It is
+                                      evicted, so the next acquire starts it again
+        """
+        with self.lock:
+            entry = self.resident.get(image_id)
+            if entry is None:
+                self.stats["misses"] += 1
+                entry = self.start(image_id)
+            else:
+                if entry.prewarmed:
+                    self.stats["hits" if entry.ready.is_set() else "late"] += 1
+                    entry.prewarmed = False  # counted once, later switches back to it are plain reuse
+                else:
+                    self.stats["resident"] += 1
+                self.resident[image_id] = self.resident.pop(image_id)  # mark as most recently used
+
+        entry.ready.wait()
+        if entry.failed:
+            raise ClassifierStartError("Classifier %s failed to start on %s" % (image_id, entry.url))
+        return entry.url
+
+    def prewarm(self, image_id):
+        """
+        Start a classifier in the background so that a later acquire does not wait for it
+        Never evicts the most recently used classifier, since that is the one currently in use
+        :param image_id: Docker image ID of the classifier
+        """
+        with self.lock:
+            if image_id in self.resident or self.max_resident == 1:
+                return
+
+            in_use = next(reversed(self.resident), None)
+            self.stats["prewarms"] += 1
+            self.start(image_id).prewarmed = True
+
+            # pre-warmed classifier is not in use yet, keep the current one as most recently used
+            if in_use is not None:
+                self.resident[in_use] = self.resident.pop(in_use)
+
+    def start(self, image_id):
+        """
+        Reserve a port for a classifier and start its container in the background. Caller must hold the lock
+        :return: ResidentClassifier, its ready event is set once the classifier answers requests
+        """
+        if len(self.resident) >= self.max_resident:
+            self.evict(next(iter(self.resident)))
+
+        if self.free_ports:
+            port = self.free_ports.pop(0)
+        else:  # every free port is held by an evicted container still starting, see evict
+            port = self.next_port
+            self.next_port += 1
+        entry = ResidentClassifier(image_id, port, self.url(port))
+        self.resident[image_id] = entry
+
+        thread = threading.Thread(target=self.run_container, args=(entry,))
+        thread.daemon = True
+        thread.start()
+        return entry
+
+    def run_container(self, entry):
+        """
+        Run a classifier container and wait until its server answers
+        """
+        try:
+            container = self.docker().containers.run(entry.image_id,
+                                                     "/bin/bash run_server.sh",
+                                                     ports={"8000/tcp": entry.port},
+                                                     remove=True,
+                                                     detach=True,
+                                                     runtime="nvidia")
+            with self.lock:
+                entry.container = container
+                if entry.evicted:
+                    entry.failed = True  # evicted while starting, anyone still waiting on it has to start it again
+                    container.kill()
+                    return
+
+            if not wait_until_ready(entry.url, self.start_timeout):
+                LOG.error("classifier %s didn't answer on %s within %ss, stopping it"
+                          % (entry.image_id, entry.url, self.start_timeout))
+                eventlog.record({"event": "error", "stage": "classifier_start", "image_id": entry.image_id,
+                                 "url": entry.url, "error": "start timeout"})
+                self.failed(entry)
+        except Exception as e:
+            LOG.exception("classifier %s failed to start" % entry.image_id)
+            eventlog.record({"event": "error", "stage": "classifier_start", "image_id": entry.image_id,
+                             "url": entry.url, "error": repr(e)})
+            self.failed(entry)
+        finally:
+            with self.lock:
+                if entry.evicted:
+                    self.release(entry)  # evicted before its container was up, see evict
+            entry.ready.set()
+
+    def failed(self, entry):
+        """
+        Mark a classifier that didn't start as failed, and evict it unless it already was
+        """
+        with self.lock:
+            entry.failed = True
+            if self.resident.get(entry.image_id) is entry:
+                self.evict(entry.image_id)
+
+    def evict(self, image_id):
+        """
+        Stop a resident container and free its port. Caller must hold the lock
+        A container still being started is killed by run_container once Docker returns it, and its port freed only then,
+        so that the port isn't given to another classifier while the evicted container may still be published on it
+        """
+        entry = self.resident.pop(image_id)
+        entry.evicted = True
+        if entry.container is not None:
+            entry.container.kill()
+            self.release(entry)
+
+    def release(self, entry):
+        """
+        Free the port of an evicted classifier, once. Caller must hold the lock
+        """
+        if not entry.released:
+            entry.released = True
+            self.free_ports.append(entry.port)
+
+    def cleanup(self):
+        """
+        Stop all resident containers
+        """
+        with self.lock:
+            for image_id in list(self.resident.keys()):
+                self.evict(image_id)
+
+
+class DetectionTrace:
+    """
+    Append-only trace file of TPOD responses, one JSON entry per line with the frame ID, a hash of the frame, the
+    classifier image ID, the request latency in seconds, the frame shape and the response as returned by TPOD
+    """
+    def __init__(self, path, load=False):
+        """
+        :param path: of the trace file
+        :param load: read the existing entries for look ups, instead of opening the file to append to it
+        """
+        self.path = path
+        self.lock = threading.Lock()
+        self.by_hash = {}  # (frame hash, classifier) -> entry
+        self.by_frame = {}  # (frame ID, classifier) -> entry
+        self.hits = 0
+        self.misses = 0
+
+        if load:
+            self.file = None
+            with open(path) as f:
+                for line in f:
+                    if line.strip():
+                        entry = json.loads(line)
+                        self.by_hash[(entry["frame_hash"], entry["image_id"])] = entry
+                        self.by_frame[(entry["frame_id"], entry["image_id"])] = entry
+        else:
+            self.file = open(path, "a")
+
+    def append(self, frame_id, frame_hash, image_id, latency, shape, response):
+        entry = {"frame_id": frame_id, "frame_hash": frame_hash, "image_id": image_id, "latency": round(latency, 6),
+                 "shape": list(shape), "response": response}
+        line = json.dumps(entry) + "\n"
+        with self.lock:
+            if self.file is not None:
+                self.file.write(line)
+                self.file.flush()
+
+    def lookup(self, frame_id, frame_hash, image_id):
+        """
+        Returns the entry of a frame and classifier, or None if it wasn't recorded
+        """
+        entry = self.by_hash.get((frame_hash, image_id))
+        if entry is None:
+            entry = self.by_frame.get((frame_id, image_id))
+        with self.lock:
+            if entry is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+        return entry
+
+    def close(self):
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+
+    def stats(self):
+        return {"entries": len(self.by_frame), "hits": self.hits, "misses": self.misses}
+
+
+class StaticClassifiers:
+    """
+    Stand-in for ClassifierPool when the classifiers are already running at fixed URLs, so none are started or stopped
+    """
+    def __init__(self, endpoints):
+        """
+        :param endpoints: dict of classifier image ID -> URL
+        """
+        self.endpoints = endpoints
+        self.stats = {"hits": 0, "late": 0, "resident": 0, "misses": 0, "prewarms": 0}
+
+    def is_resident(self, image_id):
+        return image_id in self.endpoints
+
+    def acquire(self, image_id):
+        if image_id not in self.endpoints:
+            raise ValueError("No endpoint for classifier %s" % image_id)
+        self.stats["resident"] += 1
+        return self.endpoints[image_id]
+
+    def prewarm(self, image_id):
+        pass
+
+    def cleanup(self):
+        pass
+
+
+class ResidentClassifier:
+    """
+    A classifier container owned by the ClassifierPool
+    """
+    def __init__(self, image_id, port, url):
+        self.image_id = image_id
+        self.port = port
+        self.url = url
+        self.container = None  # set once Docker started the container
+        self.ready = threading.Event()  # set once the classifier answers requests (or failed to start)
+        self.prewarmed = False  # started by ClassifierPool.prewarm and not acquired since
+        self.failed = False  # container failed to start or didn't answer in time
+        self.evicted = False
+        self.released = False  # port given back to the pool
+
+
+class ClassifierStartError(Exception):
+    """
+    A classifier container failed to start or didn't answer within the pool's start timeout
+    """
+    pass
+
+
+def wait_until_ready(url, timeout):
+    """
+    Poll a freshly started classifier until its server answers, instead of sleeping for a fixed time
+    Any HTTP response counts, the Docker port proxy accepts connections before the server inside is up
+    :param url: of TPOD classifier
+    :param timeout: max seconds to wait
+    :return: whether or not the classifier answered in time
+    """
+    deadline = time.time() + timeout
+    while time.time() < deadline:
+        try:
+            requests.get(url, timeout=0.5)
+            return True
+        except requests.exceptions.RequestException:
+            time.sleep(0.1)
+    return False
+
+
+class TPODClient:
+    """
+    Long-lived HTTP client for TPOD classifiers
+
+    Keeps a persistent (keep-alive) connection per classifier endpoint, so frames don't pay TCP setup, and reuses the
+    same headers and form fields for every request.
+    """
+    def __init__(self, connect_timeout=1, read_timeout=5, max_connections=4):
+        """
+        :param connect_timeout: max seconds to connect to a classifier
+        :param read_timeout: max seconds to wait for a classifier's detections
+        :param max_connections: max number of connections kept alive to each classifier
+        """
+        self.timeout = (connect_timeout, read_timeout)
+        self.max_connections = max_connections
+        self.headers = {'User-Agent': 'Mozilla/5.0'}
+        self.payload = {"confidence": 0.5, "format": "box"}
+
+        self.sessions = {}  # classifier URL -> requests.Session
+        self.errors = 0
+        self.lock = threading.Lock()
+
+    def session(self, url):
+        """
+        Get the session for a classifier endpoint, creating it on first use
+        """
+        with self.lock:
+            if url not in self.sessions:
+                session = requests.Session()
+                session.headers.update(self.headers)
+                adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=self.max_connections)
+                session.mount(url, adapter)
+                self.sessions[url] = session
+            return self.sessions[url]
+
+    def detect(self, img_encoded, url):
+        """
+        Send an encoded image to a classifier
+        :param img_encoded: JPEG encoded image
+        :param url: of TPOD classifier
+        :return: detections as returned by TPOD, in the form [class name, bounding box, confidence]
+        """
+        try:
+            with metrics.timer("tpod_http"):
+                response = self.session(url).post(url + "/detect", data=self.payload, files={'media': img_encoded},
+                                                  timeout=self.timeout)
+        except requests.exceptions.RequestException as e:
+            with self.lock:
+                self.errors += 1
+            metrics.increment("tpod_errors")
+            eventlog.record({"event": "error", "stage": "tpod", "url": url, "error": repr(e)})
+            raise
+        with metrics.timer("tpod_parse"):
+            return ast.literal_eval(response.text)
+
+    def stats(self):
+        """
+        Returns connection reuse statistics per classifier endpoint
+        """
+        with self.lock:
+            out = {"errors": self.errors}
+            for url, session in self.sessions.items():
+                pools = session.get_adapter(url).poolmanager.pools
+                num_requests = 0
+                num_connections = 0
+                for key in pools.keys():
+                    num_requests += pools[key].num_requests
+                    num_connections += pools[key].num_connections
+                out[url] = {"requests": num_requests, "connections": num_connections,
+                            "reused": num_requests - num_connections}
+        return out
+
+
+class DetectionScheduler:
+    """
+    Groups the requests of frames of different sessions to the same classifier, and bounds the requests in flight to it
+
+    A request to an idle classifier is sent right away. While the classifier is busy, the first request to it opens a
+    batch, and waits up to window seconds for others to join it (or until max_batch joined). The batch is then sent
+    together, as concurrent requests on the classifier's kept-alive connections, at most max_concurrent at a time. TPOD
+    detects one image per request, so a batch is not one call, but the classifier gets its frames in bursts rather than
+    interleaved with the other classifiers' ones. Has the same detect method as TPODClient, which sends the requests
+    """
+    def __init__(self, client, window=0, max_batch=1, max_concurrent=4):
+        """
+        :param client: TPODClient to send the requests with
+        :param window: max seconds the first request of a batch waits for others, 0 to send each right away
+        :param max_batch: number of requests after which a batch is sent without waiting for the rest of the window
+        :param max_concurrent: max number of requests in flight to each classifier
+        """
+        self.client = client
+        self.window = window
+        self.max_batch = max_batch
+        self.max_concurrent = max_concurrent
+        self.lock = threading.Lock()
+        self.batches = {}  # classifier URL -> PendingBatch being collected
+        self.slots = {}  # classifier URL -> semaphore bounding the requests in flight
+        self.in_flight = defaultdict(int)  # classifier URL -> number of requests sent and not answered yet
+
+        self.batch_sizes = defaultdict(int)  # batch size -> number of batches sent of that size
+        self.requests = 0
+        self.queue_delay = 0  # total seconds requests waited, for their batch and for a free slot
+        self.max_queue_delay = 0
+
+    def detect(self, img_encoded, url):
+        """
+        Send an encoded image to a classifier, along with the other requests to it in the same batch
+        :param img_encoded: JPEG encoded image
+        :param url: of TPOD classifier
+        :return: detections as returned by TPOD, in the form [class name, bounding box, confidence]
+        """
+        queued = time.time()
+        with self.lock:
+            batch = self.batches.get(url)
+            first = batch is None
+            if first:
+                batch = PendingBatch()
+                self.batches[url] = batch
+                if url not in self.slots:
+                    self.slots[url] = threading.Semaphore(self.max_concurrent)
+            batch.size += 1
+            if batch.size >= self.max_batch or self.in_flight[url] == 0:
+                self.close(url, batch)
+            slots = self.slots[url]
+
+        if first:
+            batch.sent.wait(self.window)
+            with self.lock:
+                if self.batches.get(url) is batch:
+                    self.close(url, batch)
+        else:
+            batch.sent.wait()
+
+        with slots:
+            delay = time.time() - queued
+            metrics.observe("tpod_queue", delay)
+            with self.lock:
+                self.requests += 1
+                self.queue_delay += delay
+                self.max_queue_delay = max(self.max_queue_delay, delay)
+                self.in_flight[url] += 1
+            try:
+                return self.client.detect(img_encoded, url)
+            finally:
+                with self.lock:
+                    self.in_flight[url] -= 1
+
+    def close(self, url, batch):
+        """
+        Stop collecting requests for a batch and send it. Must hold self.lock
+        """
+        del self.batches[url]
+        self.batch_sizes[batch.size] += 1
+        batch.sent.set()
+
+    def stats(self):
+        """
+        Returns the number of batches sent of each size, and the mean and max milliseconds requests were delayed
+        """
+        with self.lock:
+            mean_delay = self.queue_delay / self.requests if self.requests else 0
+            return {"batch_sizes": dict(self.batch_sizes), "mean_queue_delay_ms": round(mean_delay * 1000, 2),
+                    "max_queue_delay_ms": round(self.max_queue_delay * 1000, 2)}
+
+
+class PendingBatch:
+    """
+    Requests to a classifier waiting to be sent together
+    """
+    def __init__(self):
+        self.size = 0
+        self.sent = threading.Event()  # set once the batch is closed and its requests may go out
+
+
+def detections_match(a, b, tolerance):
+    """
+    Returns whether or not two detections of a frame found the same objects, with every bounding box corner within
+    tolerance pixels of the other's
+    """
+    if len(a) != len(b):
+        return False
+    a = sorted(a, key=lambda obj: (obj["class_name"], obj["dimensions"]))
+    b = sorted(b, key=lambda obj: (obj["class_name"], obj["dimensions"]))
+    for obj_a, obj_b in zip(a, b):
+        if obj_a["class_name"] != obj_b["class_name"]:
+            return False
+        for u, v in zip(obj_a["dimensions"], obj_b["dimensions"]):
+            if abs(u - v) > tolerance:
+                return False
+    return True
+
+
+default_client = None  # TPODClient shared by tpod_request calls that don't supply their own
+sweep_min_boxes = 32  # below this many boxes in a frame, scanning the kept boxes is cheaper than finding pairs first
+sweep_max_candidates = 32  # above this many candidate pairs per box, scanning the kept boxes is cheaper as well
+
+
+def tpod_request(img, url, client=None):
     """
     Send a TPOD HTTP request for object detection
     If bounding boxes of the same class or certain groups of classes intersect, only the highest confidence is returned
-    :param img: to detect
+    Frames decoded at reduced resolution are detected at that resolution, their boxes are mapped back to full size
+    :param img: to detect, a frame.Frame or an image array
     :param url: of TPOD classifier
+    :param client: TPODClient to send the request with, defaults to one shared client
     :return: objects detected
     """
-    headers = {'User-Agent': 'Mozilla/5.0'}
-    payload = {"confidence": 0.5, "format": "box"}
+    global default_client
+    if client is None:
+        if default_client is None:
+            default_client = TPODClient()
+        client = default_client
 
-    _, img_encoded = cv2.imencode('.jpg', img)
-    files = {'media': img_encoded}
+    img_encoded, shape = encode_for_tpod(img)
+    converted = client.detect(img_encoded, url)
 
-    session = requests.Session()
-    response = session.post(url + "/detect", headers=headers, data=payload, files=files)
+    return frame.scale_detections(suppress_overlapping(converted, shape), img)
+
+
+@metrics.timed("tpod_encode")
+def encode_for_tpod(img):
+    """
+    JPEG encode an image for TPOD. Frames that weren't rotated, resized or capped are sent as received, without decoding
+    :param img: a frame.Frame or an image array
+    :return: tuple of the JPEG and the image shape
+    """
+    if isinstance(img, frame.Frame):
+        return img.jpeg(), img.shape()
+    _, img_encoded = cv2.imencode('.jpg', img)
+    return img_encoded, img.shape
 
-    converted = ast.literal_eval(response.text)
-    detected_objects = []
 
-    by_class = {}
-    for obj_list_form in converted:
-        class_name = group_class_names(obj_list_form[0])
-        if class_name not in by_class.keys():
-            by_class[class_name] = []
+def suppress_overlapping(converted, shape):
+    """
+    Wipe intersecting bounding boxes for same class or certain groups of classes, keeping the highest confidence one
 
-        # norm dimensions field
-        norm = obj_list_form[1][:]
-        norm[0] /= img.shape[1]
-        norm[2] /= img.shape[1]
-        norm[1] /= img.shape[0]
-        norm[3] /= img.shape[0]
+    Boxes are resolved in the order TPOD returned them, each against the boxes kept so far in its group, so the output
+    is the same as resolving them one at a time. For larger frames, the intersecting pairs of every group are found up
+    front in one NumPy pass (sort and sweep on x), so each box only looks at the kept boxes it actually intersects
+    instead of scanning all of them.
+    :param converted: detections as returned by TPOD, in the form [class name, bounding box, confidence]
+    :param shape: of the detected image, to norm the bounding boxes
+    :return: objects detected
+    """
+    groups = [group_class_names(obj_list_form[0]) for obj_list_form in converted]
+    confidences = [obj_list_form[2] for obj_list_form in converted]
+    x1, y1, x2, y2 = [[obj_list_form[1][u] for obj_list_form in converted] for u in range(4)]
 
-        intermediate = {"class_name": obj_list_form[0], "dimensions": obj_list_form[1], "confidence": obj_list_form[2], "norm": norm}
+    bounds = None
+    if len(converted) >= sweep_min_boxes:
+        group_ids = {}
+        ids = np.array([group_ids.setdefault(g, len(group_ids)) for g in groups])
+        boxes = np.array([x1, y1, x2, y2], dtype=np.float64).T
+        bounds, earlier = intersecting_pairs(boxes, ids)
 
-        # wipe intersecting bounding boxes for same class or certain groups of classes
-        conflicts = [x for x in by_class[class_name] if intersecting_objs(intermediate, x)]
-        non_conflicts = [x for x in by_class[class_name] if x not in conflicts]
+    by_class = {}  # group name -> {kept box index: output order}
+    order = 0
+    for i in range(len(converted)):
+        if groups[i] not in by_class:
+            by_class[groups[i]] = {}
+        kept = by_class[groups[i]]
 
-        highest_confidence_obj = intermediate
-        for other in conflicts:
-            if other["confidence"] > highest_confidence_obj["confidence"]:
-                highest_confidence_obj = other
+        if bounds is not None and bounds[i + 1] - bounds[i] < len(kept):
+            conflicts = [k for k in earlier[bounds[i]:bounds[i + 1]] if k in kept]
+        else:
+            conflicts = [k for k in kept if x2[i] > x1[k] and x1[i] < x2[k] and y2[i] > y1[k] and y1[i] < y2[k]]
+        conflicts.sort(key=kept.get)
 
-        filtered = [x for x in conflicts if not intersecting_objs(highest_confidence_obj, x)]
-        resolved = non_conflicts + filtered + [highest_confidence_obj]
+        # first most confident conflict wins, the new box only loses to a strictly higher confidence
+        highest = i
+        for k in conflicts:
+            if confidences[k] > confidences[highest]:
+                highest = k
 
-        by_class[class_name] = resolved
+        # conflicts that don't intersect the winner stay, moved after the boxes that didn't conflict
+        for k in conflicts:
+            del kept[k]
+            if k != highest and not (x2[highest] > x1[k] and x1[highest] < x2[k] and
+                                     y2[highest] > y1[k] and y1[highest] < y2[k]):
+                kept[k] = order
+                order += 1
+        kept[highest] = order
+        order += 1
 
+    detected_objects = []
     for class_name in by_class:
-        for obj in by_class[class_name]:
+        kept = by_class[class_name]
+        for i in sorted(kept, key=kept.get):
             detected_objects.append({
-                "class_name": obj["class_name"],
-                "dimensions": obj["dimensions"],
-                "confidence": obj["confidence"],
-                "norm": obj["norm"]})
+                "class_name": converted[i][0],
+                "dimensions": converted[i][1],
+                "confidence": converted[i][2],
+                "norm": norm_dimensions(converted[i][1], shape)})
 
     return detected_objects
 
 
+def intersecting_pairs(boxes, groups):
+    """
+    Find all pairs of intersecting bounding boxes within the same group in one vectorized pass
+    Boxes are sorted by group, then left edge, so the only candidates for a box are the ones of its group whose left
+    edge is within the widest box's width of it, and left of its right edge
+    :param boxes: n x 4 array of bounding boxes
+    :param groups: n array of group IDs
+    :return: tuple of bounds and earlier. The boxes before box i that intersect it are earlier[bounds[i]:bounds[i + 1]]
+             Both are None if there are too many candidate pairs
+    """
+    x1, y1, x2, y2 = boxes[:, 0], boxes[:, 1], boxes[:, 2], boxes[:, 3]
+    width = max((x2 - x1).max(), 0)
+
+    # offset each group along x so that boxes of different groups are never candidates
+    offset = groups * (x1.max() - x1.min() + 2 * width + 1)
+    start = x1 + offset
+    by_x = np.argsort(start, kind="mergesort")
+    sorted_start = start[by_x]
+
+    lo = np.searchsorted(sorted_start, start - width, "right")
+    hi = np.searchsorted(sorted_start, x2 + offset, "left")
+    counts = np.maximum(hi - lo, 0)
+    if counts.sum() > sweep_max_candidates * len(boxes):
+        return None, None  # boxes pile up on each other, few of them will be kept and scanning those is cheaper
+
+    i = np.repeat(np.arange(len(boxes)), counts)
+    j = by_x[np.repeat(lo - (np.cumsum(counts) - counts), counts) + np.arange(counts.sum())]
+    hit = (j < i) & (groups[i] == groups[j]) & (x2[i] > x1[j]) & (x1[i] < x2[j]) & (y2[i] > y1[j]) & (y1[i] < y2[j])
+    i = i[hit]
+    j = j[hit]
+
+    # candidates of a box are generated in x order, put them back in detection order
+    by_i = np.lexsort((j, i))
+    bounds = np.searchsorted(i[by_i], np.arange(len(boxes) + 1)).tolist()
+    return bounds, j[by_i].tolist()
+
+
+def frame_hash(img):
+    """
+    Returns a hash of a frame's pixels (of its bytes for a frame.Frame), to recognize the same frame in a detection trace
+    """
+    if isinstance(img, frame.Frame):
+        return img.digest()
+    return hashlib.sha1(np.ascontiguousarray(img)).hexdigest()
+
+
+def uncolored(obj):
+    """
+    Returns a copy of a detected object for another frame, without the "color" set when its own frame was visualized,
+    so that the other frame's objects are colored by that frame's result
+    """
+    return dict((key, value) for key, value in obj.items() if key != "color")
+
+
+def norm_dimensions(dimensions, shape):
+    """
+    Norm bounding box dimensions to 0 to 1 by the image's width and height
+    """
+    norm = dimensions[:]
+    norm[0] /= shape[1]
+    norm[2] /= shape[1]
+    norm[1] /= shape[0]
+    norm[3] /= shape[0]
+    return norm
+
+
 def group_class_names(name):
     """
     Returns the group name of a class, for intersecting bounding box reduction
@@ -0,0 +1,138 @@
+import ctypes
+import logging
+import multiprocessing
+import signal
+import threading
+
+import cv2
+import numpy as np
+
+try:
+    import Queue as queue
+except ImportError:
+    import queue
+
+"""
+Worker processes for the CPU heavy work on frames (decoding, rotating, resizing, PNG encoding), so that one proxy uses
+every core of the cloudlet instead of the share of one Python process. The pipeline threads only hand the work over and
+wait for it, and the images travel through shared memory buffers instead of being pickled
+"""
+
+LOG = logging.getLogger(__name__)
+
+worker_buffers = None  # in a worker process, the shared memory buffers of its pool
+
+
+class ProcessPool:
+    """
+    A pool of worker processes and a set of shared memory buffers (slots) created before the workers are forked, so
+    that they share them. A job copies its input array into a free slot, the worker runs a function on a view of it and
+    writes the result back into the same slot, which is copied out once the job is done. Only the slot number, shapes
+    and the function's name and small arguments go through the pool's pipes
+
+    Jobs whose input or result doesn't fit in a slot run in the calling thread, or get their result pickled
+    """
+    def __init__(self, workers, slot_bytes, slots=None):
+        """
+        :param workers: number of worker processes
+        :param slot_bytes: size of each shared memory buffer, the largest image a job can take or return through it
+        :param slots: number of shared memory buffers, the max number of jobs in flight. Twice the workers by default,
+                      so that a worker finds its next job waiting
+        """
+        self.workers = workers
+        self.slot_bytes = slot_bytes
+        self.buffers = [multiprocessing.RawArray(ctypes.c_uint8, slot_bytes) for _ in range(slots or 2 * workers)]
+        self.free = queue.Queue()  # numbers of the slots not in use by a job
+        for slot in range(len(self.buffers)):
+            self.free.put(slot)
+        self.pool = multiprocessing.Pool(workers, initializer=init_worker, initargs=(self.buffers,))
+
+        self.lock = threading.Lock()
+        self.jobs = 0
+        self.local = 0  # jobs run in the calling thread, for not fitting in a slot
+
+    def run(self, function, data, *args):
+        """
+        Run function(data, *args) in a worker process, and wait for its result
+        :param function: module level function, so that the workers can look it up by name
+        :param data: input numpy array, or bytes
+        :return: the function's result, numpy arrays and bytes are copied out of the shared memory
+        """
+        if not isinstance(data, np.ndarray):
+            data = np.frombuffer(data, dtype=np.uint8)
+        if data.nbytes > self.slot_bytes:
+            with self.lock:
+                self.local += 1
+            return function(data, *args)
+
+        slot = self.free.get()
+        try:
+            buf = self.slot(slot)
+            buf[:data.nbytes] = np.ascontiguousarray(data).reshape(-1).view(np.uint8)
+            kind, value = self.pool.apply(run_job, (function, slot, data.shape, data.dtype.str, args))
+            if kind == "array":
+                shape, dtype = value
+                out = buf[:array_bytes(shape, dtype)].view(dtype).reshape(shape).copy()
+            elif kind == "bytes":
+                out = buf[:value].tobytes()
+            else:
+                out = value
+        finally:
+            self.free.put(slot)
+
+        with self.lock:
+            self.jobs += 1
+        return out
+
+    def slot(self, slot):
+        return np.frombuffer(self.buffers[slot], dtype=np.uint8)
+
+    def close(self):
+        self.pool.terminate()
+        self.pool.join()
+
+    def stats(self):
+        """
+        Returns the number of worker processes, of jobs run by them and of jobs run in the calling thread
+        """
+        return {"workers": self.workers, "jobs": self.jobs, "local": self.local}
+
+
+def init_worker(buffers):
+    global worker_buffers
+    worker_buffers = buffers
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # the proxy process handles Ctrl-C and terminates the pool
+    cv2.setNumThreads(1)  # the pool is the parallelism, OpenCV's own threads would compete with the other workers
+
+
+def run_job(function, slot, shape, dtype, args):
+    """
+    Run a job in a worker process: function on the input in a slot, with the result written back into the slot
+    :return: tuple of ("array", (shape, dtype)), ("bytes", length) or ("value", result pickled as is)
+    """
+    buf = np.frombuffer(worker_buffers[slot], dtype=np.uint8)
+    data = buf[:array_bytes(shape, dtype)].view(dtype).reshape(shape)
+    out = function(data, *args)
+
+    if isinstance(out, np.ndarray) and out.nbytes <= len(buf):
+        buf[:out.nbytes] = np.ascontiguousarray(out).reshape(-1).view(np.uint8)
+        return "array", (out.shape, out.dtype.str)
+    if isinstance(out, bytes) and len(out) <= len(buf):
+        buf[:len(out)] = np.frombuffer(out, dtype=np.uint8)
+        return "bytes", len(out)
+    return "value", out
+
+
+def array_bytes(shape, dtype):
+    return int(np.prod(shape)) * np.dtype(dtype).itemsize
+
+
+def new_pool(workers, slot_bytes):
+    """
+    Returns a ProcessPool with the given number of workers, None for 0 to run everything in the calling threads
+    """
+    if not workers:
+        return None
+    pool = ProcessPool(workers, slot_bytes)
+    LOG.info("offloading frame work to %d worker processes" % workers)
+    return pool
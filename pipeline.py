@@ -0,0 +1,205 @@
+import logging
+import threading
+import time
+from collections import deque
+
+import eventlog
+
+"""
+Staged processing of frames for the proxy, where each stage runs on its own thread and hands frames to the next one
+through a small bounded queue. While a slow stage (e.g. object detection) works on a frame, newer frames replace the
+ones waiting for it, so that the frame it processes next is the newest one rather than a stale one.
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class Job:
+    """
+    A frame going through the pipeline. Stages add their results to it as attributes
+    """
+    def __init__(self, header, data):
+        """
+        :param header: from client's request
+        :param data: raw frame
+        """
+        self.header = header
+        self.data = data
+        self.received = time.time()  # when the frame was taken from the proxy's input queue
+
+
+class HandOffQueue:
+    """
+    Bounded queue between two stages. Adding to a full queue drops its oldest jobs, and jobs that waited longer than
+    max_age are dropped when taken out, so that the newest frame wins. With a key function, the bound applies to the
+    jobs of each key (e.g. client session) separately, so that one client's frames don't push out another's
+    """
+    def __init__(self, size, max_age=None, key=None):
+        """
+        :param size: max number of jobs waiting, per key if key is given
+        :param max_age: max seconds since a job was received for it to be taken out, None to never drop on age
+        :param key: function of a job returning the key its bound applies to
+        """
+        self.size = size
+        self.max_age = max_age
+        self.key = key
+        self.jobs = deque()
+        self.cond = threading.Condition()
+        self.dropped = 0
+        self.max_depth = 0
+
+    def put(self, job):
+        """
+        Add a job
+        :return: list of older jobs dropped to make room for it
+        """
+        dropped = []
+        with self.cond:
+            if self.key is None:
+                while len(self.jobs) >= self.size:
+                    dropped.append(self.jobs.popleft())
+            else:
+                key = self.key(job)
+                same_key = [j for j in self.jobs if self.key(j) == key]
+                for j in same_key[:max(0, len(same_key) - self.size + 1)]:
+                    self.jobs.remove(j)
+                    dropped.append(j)
+            self.jobs.append(job)
+            self.dropped += len(dropped)
+            self.max_depth = max(self.max_depth, len(self.jobs))
+            self.cond.notify()
+        return dropped
+
+    def get(self, timeout):
+        """
+        Take the oldest job that is not stale, waiting up to timeout seconds for one
+        :return: tuple of the job (None if there is none) and list of the stale jobs dropped
+        """
+        stale = []
+        with self.cond:
+            if not self.jobs:
+                self.cond.wait(timeout)
+            if self.max_age is not None:
+                now = time.time()
+                while self.jobs and now - self.jobs[0].received > self.max_age:
+                    stale.append(self.jobs.popleft())
+                self.dropped += len(stale)
+            job = self.jobs.popleft() if self.jobs else None
+        return job, stale
+
+    def depth(self):
+        return len(self.jobs)
+
+
+class Stage(threading.Thread):
+    """
+    Thread that takes jobs from its input queue, processes them and hands them to the output queue
+    """
+    def __init__(self, name, process, input_queue, output_queue, on_drop):
+        """
+        :param name: of the stage
+        :param process: function of a job, returning the job to hand to the next stage or None once done with it
+        :param input_queue: HandOffQueue to take jobs from
+        :param output_queue: HandOffQueue of the next stage, None for the last stage
+        :param on_drop: function called with each job dropped on the way
+        """
+        threading.Thread.__init__(self, name=name)
+        self.daemon = True
+        self.process = process
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.on_drop = on_drop
+        self.stopped = threading.Event()
+        self.processed = 0
+        self.errors = 0
+
+    def run(self):
+        while not self.stopped.is_set():
+            job, dropped = self.input_queue.get(timeout=0.1)
+            for d in dropped:
+                self.on_drop(d)
+            if job is None:
+                continue
+
+            try:
+                job = self.process(job)
+            except Exception as e:
+                LOG.exception("stage %s failed on a frame" % self.name)
+                eventlog.record({"event": "error", "stage": self.name, "frame_id": getattr(job, "frame_id", None),
+                                 "error": repr(e)})
+                self.errors += 1
+                self.on_drop(job)
+                continue
+            self.processed += 1
+
+            if job is not None and self.output_queue is not None:
+                for d in self.output_queue.put(job):
+                    self.on_drop(d)
+
+    def stop(self):
+        self.stopped.set()
+
+
+class Pipeline:
+    """
+    Chain of stages, each with a bounded queue in front of it. The first queue is the admission queue, which also
+    drops frames that waited too long to get in
+    """
+    def __init__(self, stages, queue_size=1, max_age=None, on_drop=None, key=None):
+        """
+        :param stages: list of (name, function) or (name, function, number of worker threads) tuples, in order. each
+                       function takes a Job and returns it for the next stage, or None once done with it
+        :param queue_size: max number of jobs waiting in front of each stage, per key if key is given
+        :param max_age: max seconds a job may wait for admission, None to never drop on age
+        :param on_drop: function called with each dropped job, e.g. to still answer the client
+        :param key: function of a job returning the key (e.g. client session) queue_size applies to
+        """
+        if on_drop is None:
+            on_drop = lambda job: None
+
+        self.queues = []
+        for i in range(len(stages)):
+            self.queues.append(HandOffQueue(queue_size, max_age if i == 0 else None, key))
+
+        self.stages = []  # one Stage per worker thread
+        for i in range(len(stages)):
+            name, process = stages[i][:2]
+            workers = stages[i][2] if len(stages[i]) > 2 else 1
+            output_queue = self.queues[i + 1] if i + 1 < len(stages) else None
+            for _ in range(workers):
+                self.stages.append(Stage(name, process, self.queues[i], output_queue, on_drop))
+        self.on_drop = on_drop
+
+    def start(self):
+        for stage in self.stages:
+            stage.start()
+
+    def stop(self):
+        for stage in self.stages:
+            stage.stop()
+
+    def submit(self, job):
+        """
+        Admit a new frame into the pipeline
+        """
+        for d in self.queues[0].put(job):
+            self.on_drop(d)
+
+    def stats(self):
+        """
+        Returns per stage the current and max depth of its input queue, the number of jobs dropped from that queue,
+        processed and failed
+        """
+        out = {}
+        for stage in self.stages:
+            if stage.name not in out:
+                out[stage.name] = {
+                    "depth": stage.input_queue.depth(),
+                    "max_depth": stage.input_queue.max_depth,
+                    "dropped": stage.input_queue.dropped,
+                    "processed": 0,
+                    "errors": 0
+                }
+            out[stage.name]["processed"] += stage.processed
+            out[stage.name]["errors"] += stage.errors
+        return out
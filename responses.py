@@ -0,0 +1,81 @@
+import json
+from base64 import b64encode
+
+import assets
+import config
+import metrics
+import util
+
+"""
+Encoding of the task's instructions into the JSON result sent back to the client
+"""
+
+
+class ResponseEncoder:
+    """
+    Builds the result of a frame from its instruction and the objects to visualize. Keeps track of the guidance images
+    sent in the current client session
+    """
+    def __init__(self, pool=None):
+        """
+        :param pool: offload.ProcessPool to PNG encode guidance images in, None to do it in the calling thread
+        """
+        self.pool = pool
+        self.session_id = None  # client session the guidance images in sent_assets were sent to
+        self.sent_assets = set()  # content hashes of the guidance images sent in this session
+        self.profile = None  # guidance image profile the client asked for in its last frame, None for the default
+
+    @metrics.timed("response_encode")
+    def encode(self, header, instruction, viz_objects):
+        """
+        :param header: from client's request, used to track session ID
+        :param instruction: response object from Task.get_instruction, None for an empty result
+        :param viz_objects: objects to visualize from Task.get_instruction
+        :return: JSON result
+        """
+        rtn_data = {}
+        if instruction is None:
+            return json.dumps(rtn_data)
+
+        if header.get("task_id", None) != self.session_id:
+            self.session_id = header.get("task_id", None)
+            self.sent_assets.clear()
+        self.profile = header.get("image_profile", None)
+        if instruction.get('image', None) is not None:
+            self.add_image(rtn_data, 'image', instruction['image'])
+        if instruction.get("legend", None) is not None:
+            self.add_image(rtn_data, "legend", instruction["legend"])
+        if instruction.get('speech', None) is not None:
+            rtn_data['speech'] = instruction['speech']
+        if instruction.get('video', None) is not None:
+            rtn_data['video'] = instruction['video']
+
+        # img_object = util.vis_detections(img, viz_objects)
+        rtn_data["viz_obj"] = json.dumps(viz_objects)
+
+        return json.dumps(rtn_data)
+
+    def add_image(self, rtn_data, key, image):
+        """
+        Add a guidance image to the response. Cached assets are sent pre-encoded for the client's profile, or only as a
+        reference to their content hash if the client was already sent them and ASSET_REFERENCES is on
+        """
+        if not isinstance(image, assets.Asset):
+            if self.pool is not None:
+                png = self.pool.run(util.cv_image2raw_png, image)
+            else:
+                png = util.cv_image2raw_png(image)
+            rtn_data[key] = b64encode(png).decode("ascii")
+            return
+
+        image = image.for_profile(self.profile)
+        if image is None:
+            return
+        if not config.ASSET_REFERENCES:
+            rtn_data[key] = image.encoded
+        elif image.digest in self.sent_assets:
+            rtn_data[key + "_ref"] = image.digest
+        else:
+            rtn_data[key] = image.encoded
+            rtn_data[key + "_hash"] = image.digest
+            self.sent_assets.add(image.digest)
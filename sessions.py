@@ -0,0 +1,85 @@
+import logging
+import threading
+import time
+
+"""
+Client sessions served by one proxy, so that several clients can go through the task at the same time without
+resetting each other's progress
+"""
+
+LOG = logging.getLogger(__name__)
+
+
+class Session:
+    """
+    State of one client, keyed by the task_id in its requests
+    """
+    def __init__(self, session_id, task, encoder):
+        """
+        :param session_id: task_id from the client's requests
+        :param task: Task of this client
+        :param encoder: ResponseEncoder of this client, which tracks the guidance images sent to it
+        """
+        self.session_id = session_id
+        self.task = task
+        self.encoder = encoder
+        self.frames = 0  # frames received from the client
+        # ID of the last frame passed to the task, older ones arriving later are dropped. frames of all sessions are
+        # stepped by the pipeline's single step thread, so the task needs no lock of its own
+        self.last_stepped = 0
+        self.last_seen = 0  # time of the last frame received
+
+
+class SessionTable:
+    """
+    Sessions by ID. Sessions are created on the first frame of a client and evicted once the client has been idle for
+    idle_timeout seconds
+    """
+    def __init__(self, factory, idle_timeout, clock=time.time):
+        """
+        :param factory: function of a session ID returning a new Session
+        :param idle_timeout: seconds without frames after which a session is evicted, None to keep sessions forever
+        :param clock: function returning the current time in seconds
+        """
+        self.factory = factory
+        self.idle_timeout = idle_timeout
+        self.clock = clock
+        self.sessions = {}  # session ID -> Session
+        self.lock = threading.Lock()
+        self.created = 0
+        self.evicted = 0
+
+    def get(self, session_id):
+        """
+        Get the session for a frame of a client, creating it for a new client. Evicts idle sessions
+        """
+        now = self.clock()
+        with self.lock:
+            self.evict_idle(now)
+            session = self.sessions.get(session_id)
+            if session is None:
+                session = self.factory(session_id)
+                self.sessions[session_id] = session
+                self.created += 1
+                LOG.info("new session %s, %d active" % (session_id, len(self.sessions)))
+            session.last_seen = now
+            return session
+
+    def evict_idle(self, now):
+        """
+        Drop the sessions idle for longer than idle_timeout. Must hold self.lock
+        """
+        if self.idle_timeout is None:
+            return
+        for session_id, session in list(self.sessions.items()):
+            if now - session.last_seen > self.idle_timeout:
+                del self.sessions[session_id]
+                self.evicted += 1
+                LOG.info("evicted idle session %s in state %s" % (session_id, session.task.current_state))
+
+    def stats(self):
+        """
+        Returns the number of active sessions, and of sessions created and evicted
+        """
+        with self.lock:
+            return {"active": len(self.sessions), "created": self.created, "evicted": self.evicted}
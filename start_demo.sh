@@ -28,7 +28,6 @@ sleep 5
 ./gabriel-ucomm -s 0.0.0.0:8021 &> /tmp/gabriel-ucomm.log &
 sleep 5
 
-cd ${DIR}
-twistd -n web --path resources/videos --port tcp:9095
+# the guidance videos are served by the proxy itself (see VIDEO_SERVE in config.py)
 
 wait
@@ -0,0 +1,219 @@
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import frame
+import object_detection
+
+"""
+Tracking of detected objects between classifier calls, so that only every few frames are sent to the classifiers and
+the frames in between get their bounding boxes moved along with the objects
+"""
+
+# pyramidal Lucas-Kanade optical flow parameters, for the small tracking images
+lk_params = dict(winSize=(15, 15), maxLevel=2, criteria=(cv2.TERM_CRITERIA_EPS | cv2.TERM_CRITERIA_COUNT, 10, 0.03))
+max_points = 20  # max feature points tracked per bounding box
+max_fb_error = 1.0  # max pixels a point tracked forward and back may end up from where it started, to be trusted
+
+
+class BoxTracker:
+    """
+    Propagates the detections of the last frame sent to the classifiers (the keyframe) to the frames after it, with
+    sparse optical flow on small grayscale versions of the frames. Each bounding box is moved by the median motion of
+    the feature points inside it
+
+    A frame is sent to the classifiers instead once interval frames were tracked since the keyframe, or when too few
+    points of a box could be tracked (confidence). The interval adapts per step: it grows by one when the boxes tracked
+    to a keyframe match the classifiers' ones, and halves when they don't
+    """
+    def __init__(self, interval, max_interval, min_confidence, width=160, tolerance=20):
+        """
+        :param interval: number of frames tracked between keyframes, when a step starts
+        :param max_interval: max number of frames tracked between keyframes
+        :param min_confidence: min fraction (0 to 1) of a box's points tracked, to trust the box's new position
+        :param width: of the tracking images
+        :param tolerance: max pixels a tracked bounding box corner may be off from the classifier's one, to count as a
+                          match for adapting the interval
+        """
+        self.initial_interval = interval
+        self.max_interval = max_interval
+        self.min_confidence = min_confidence
+        self.width = width
+        self.tolerance = tolerance
+        self.intervals = {}  # state -> number of frames tracked between keyframes
+        self.lock = threading.Lock()  # frames of a session may be tracked from several detection threads
+
+        self.last = None  # tracking image of the last frame with detections
+        self.last_id = None  # frame ID of that frame
+        self.detections = None  # classifier image ID -> detected objects of that frame
+        self.since_keyframe = 0  # frames tracked since the last keyframe
+        self.prediction = None  # (frame ID, tracked detections) of a frame sent to the classifiers anyway
+        self.checked = OrderedDict()  # frame ID -> result of track, for frames tracked again later in the pipeline
+
+        self.tracked = 0
+        self.keyframes = 0
+        self.lost = 0
+
+    def interval(self, state):
+        return self.intervals.get(state, self.initial_interval)
+
+    def track(self, img, frame_id, state):
+        """
+        Track the last frame's detections to a new frame, if it isn't due to be sent to the classifiers
+        :param img: a frame.Frame or an image array
+        :param frame_id: ID of the frame
+        :param state: step the task is on
+        :return: dict of classifier image ID -> tracked objects, or None if the frame is to be detected
+        """
+        with self.lock:
+            if frame_id in self.checked:
+                return self.checked[frame_id]
+
+            out = None
+            # a frame overtaken by a newer one in another detection thread is detected
+            if self.last is not None and frame_id > self.last_id:
+                gray = self.tracking_image(img)
+                tracked, confidence = self.propagate(gray, full_shape(img))
+                if confidence >= self.min_confidence and self.since_keyframe < self.interval(state):
+                    out = tracked
+                    self.last = gray
+                    self.last_id = frame_id
+                    self.detections = tracked
+                    self.since_keyframe += 1
+                    self.tracked += 1
+                else:
+                    if confidence < self.min_confidence:
+                        self.lost += 1
+                    self.prediction = (frame_id, tracked)
+
+            self.checked[frame_id] = out
+            while len(self.checked) > 8:
+                self.checked.popitem(last=False)
+            return out
+
+    def keyframe(self, img, frame_id, state, detections):
+        """
+        Start tracking from the detections of a frame sent to the classifiers, and adapt the step's interval
+        :param img: a frame.Frame or an image array
+        :param frame_id: ID of the frame
+        :param state: step the task is on
+        :param detections: dict of classifier image ID -> detected objects
+        """
+        with self.lock:
+            if self.last_id is not None and frame_id <= self.last_id:
+                return  # already picked up, or older than the frame tracked last
+
+            if self.prediction is not None and self.prediction[0] == frame_id:
+                match = True
+                for classifier, detected_objs in detections.items():
+                    tracked = self.prediction[1].get(classifier, [])
+                    if not object_detection.detections_match(tracked, detected_objs, self.tolerance):
+                        match = False
+                if match:
+                    self.intervals[state] = min(self.max_interval, self.interval(state) + 1)
+                else:
+                    self.intervals[state] = max(1, self.interval(state) // 2)
+            self.prediction = None
+
+            self.last = self.tracking_image(img)
+            self.last_id = frame_id
+            self.detections = detections
+            self.since_keyframe = 0
+            self.keyframes += 1
+
+    def propagate(self, gray, shape):
+        """
+        Move the last frame's bounding boxes to a new frame
+        :param gray: tracking image of the new frame
+        :param shape: full size shape of the frames, the coordinate space of the bounding boxes
+        :return: tuple of dict of classifier image ID -> tracked objects, and the confidence of the least confident box.
+                 Without boxes to track the confidence is 0, so that frames are detected until objects show up
+        """
+        scale = float(gray.shape[1]) / shape[1]
+        boxes = []
+        points = []
+        for classifier, detected_objs in self.detections.items():
+            for obj in detected_objs:
+                box_points = features(self.last, [v * scale for v in obj["dimensions"]])
+                boxes.append((classifier, obj, len(points), len(points) + len(box_points)))
+                points.extend(box_points)
+
+        tracked = dict((classifier, []) for classifier in self.detections)
+        if not points:
+            return tracked, 0.0
+
+        start = np.float32(points).reshape(-1, 1, 2)
+        moved, status, _ = cv2.calcOpticalFlowPyrLK(self.last, gray, start, None, **lk_params)
+        back, back_status, _ = cv2.calcOpticalFlowPyrLK(gray, self.last, moved, None, **lk_params)
+        fb_error = np.linalg.norm((start - back).reshape(-1, 2), axis=1)
+        good = (status.ravel() == 1) & (back_status.ravel() == 1) & (fb_error < max_fb_error)
+        motion = (moved - start).reshape(-1, 2)
+
+        confidence = 1.0
+        for classifier, obj, first, last in boxes:
+            box_good = good[first:last]
+            confidence = min(confidence, float(np.mean(box_good)) if last > first else 0.0)
+            if not box_good.any():
+                tracked[classifier].append(object_detection.uncolored(obj))
+                continue
+            dx, dy = [float(v) / scale for v in np.median(motion[first:last][box_good], axis=0)]
+            moved_obj = object_detection.uncolored(obj)
+            d = obj["dimensions"]
+            moved_obj["dimensions"] = [d[0] + dx, d[1] + dy, d[2] + dx, d[3] + dy]
+            moved_obj["norm"] = object_detection.norm_dimensions(moved_obj["dimensions"], shape)
+            tracked[classifier].append(moved_obj)
+        return tracked, confidence
+
+    def tracking_image(self, img):
+        shape = full_shape(img)
+        height = max(1, int(round(self.width * float(shape[0]) / shape[1])))
+        if isinstance(img, frame.Frame):
+            return img.thumbnail(self.width, height)
+        return cv2.resize(cv2.cvtColor(img, cv2.COLOR_BGR2GRAY), (self.width, height), interpolation=cv2.INTER_AREA)
+
+    def reset(self):
+        with self.lock:
+            self.last = None
+            self.last_id = None
+            self.detections = None
+            self.since_keyframe = 0
+            self.prediction = None
+            self.checked.clear()
+
+    def stats(self):
+        """
+        Returns the number of frames tracked, sent to the classifiers as keyframes and whose boxes were lost, and the
+        current interval of each step
+        """
+        return {"tracked": self.tracked, "keyframes": self.keyframes, "lost": self.lost,
+                "intervals": dict(self.intervals)}
+
+
+def features(gray, box):
+    """
+    Returns the points to track inside a bounding box: its strongest corners, or a grid over it if it has none
+    :param gray: tracking image
+    :param box: [top-left x, top-left y, bottom-right x, bottom-right y] in tracking image coordinates
+    """
+    x1, y1 = max(0, int(box[0])), max(0, int(box[1]))
+    x2, y2 = min(gray.shape[1], int(np.ceil(box[2]))), min(gray.shape[0], int(np.ceil(box[3])))
+    if x2 - x1 < 2 or y2 - y1 < 2:
+        return []
+
+    corners = cv2.goodFeaturesToTrack(gray[y1:y2, x1:x2], max_points, 0.01, 2)
+    if corners is not None and len(corners) >= 4:
+        return [(x + x1, y + y1) for x, y in corners.reshape(-1, 2)]
+    xs = np.linspace(x1, x2 - 1, 4)
+    ys = np.linspace(y1, y2 - 1, 4)
+    return [(x, y) for y in ys for x in xs]
+
+
+def full_shape(img):
+    """
+    Returns the shape of a frame.Frame or image array at full size, the coordinate space of its bounding boxes
+    """
+    if isinstance(img, frame.Frame):
+        return img.full_shape()
+    return img.shape
@@ -25,12 +25,14 @@ This is a simple library file for common CV tasks
 '''
 from __future__ import absolute_import, division, print_function
 
+import socket
+
 import cv2
 import numpy as np
 
 
 def raw2cv_image(raw_data, gray_scale=False):
-    img_array = np.asarray(bytearray(raw_data), dtype=np.int8)
+    img_array = np.frombuffer(raw_data, dtype=np.uint8)
     if gray_scale:
         cv_image = cv2.imdecode(img_array, 0)
     else:
@@ -40,12 +42,12 @@ def raw2cv_image(raw_data, gray_scale=False):
 
 def cv_image2raw_jpg(img, jpeg_quality=95):
     result, data = cv2.imencode('.jpg', img, [cv2.IMWRITE_JPEG_QUALITY, jpeg_quality])
-    raw_data = data.tostring()
+    raw_data = data.tobytes()
     return raw_data
 
 def cv_image2raw_png(img):
     result, data = cv2.imencode('.png', img)
-    raw_data = data.tostring()
+    raw_data = data.tobytes()
     return raw_data
 
 
@@ -63,3 +65,40 @@ def vis_detections(img, dets, thresh=0.5):
         cv2.putText(img_detections, text, (int(bbox[0]), int(bbox[1])), cv2.FONT_HERSHEY_SIMPLEX, 1, (0, 0, 0), 2)
 
     return img_detections
+
+
+def rotate_90(img):
+    rows, cols, _ = img.shape
+    M = cv2.getRotationMatrix2D((cols / 2, rows / 2), -90, 1)
+    dst = cv2.warpAffine(img, M, (cols, rows))
+    return dst
+
+
+def preprocess(raw_data, rotate=False, resize=False):
+    """
+    Decode a frame from the client and prepare it for the task
+    :param raw_data: encoded frame
+    :param rotate: rotate the frame by 90 degrees
+    :param resize: resize the frame to 720x480
+    """
+    img = raw2cv_image(raw_data)
+    if rotate:
+        img = rotate_90(img)
+    if resize:
+        img = cv2.resize(img, (720, 480))
+    return img
+
+
+def local_address():
+    """
+    Returns the IP address of the interface the default route goes through, without sending anything (connecting a UDP
+    socket only picks the route). 127.0.0.1 if there is no route
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    try:
+        sock.connect(("8.8.8.8", 53))
+        return sock.getsockname()[0]
+    except socket.error:
+        return "127.0.0.1"
+    finally:
+        sock.close()
@@ -0,0 +1,437 @@
+import argparse
+import email.utils
+import hashlib
+import logging
+import os
+import re
+import shutil
+import socket
+import struct
+import subprocess
+import sys
+import threading
+import time
+
+try:
+    from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+    from SocketServer import ThreadingMixIn
+    from urllib import unquote
+except ImportError:
+    from http.server import BaseHTTPRequestHandler, HTTPServer
+    from socketserver import ThreadingMixIn
+    from urllib.parse import unquote
+
+import cv2
+
+import metrics
+
+"""
+HTTP server for the guidance videos, run by the proxy. Supports range requests (which the phone's player uses to start
+playing before the download finishes, and to seek), sends file contents with sendfile and lets clients cache videos by
+strong ETag
+
+Lower bitrate renditions of the videos are kept in subdirectories named by height, e.g. resources/videos/180p, and
+generated with python video_server.py --renditions 180 135 (which needs ffmpeg, see generate_renditions). A request for
+a video redirects to the largest rendition the client's link can download faster than it plays, measured from the
+previous videos sent to it
+"""
+
+LOG = logging.getLogger(__name__)
+
+rendition_dir = re.compile(r"^(\d+)p$")  # subdirectories holding renditions, named by height
+chunk_bytes = 64 * 1024  # bytes per write when sendfile isn't available
+measure_bytes = 256 * 1024  # bytes of a response the client's throughput is measured on, smaller ones aren't measured
+smoothing = 0.5  # weight of the latest measurement in a client's throughput
+measure_timeout = 10  # max seconds to wait for a client to acknowledge measure_bytes
+measure_poll = 0.005  # seconds between checks of the bytes a client acknowledged
+
+
+class VideoFile:
+    """
+    A video file and its metadata for serving: size, modification time, strong ETag (content hash) and bitrate, the
+    last two computed on first use
+    """
+    def __init__(self, path, url):
+        """
+        :param path: of the file
+        :param url: path the file is served at
+        """
+        self.path = path
+        self.url = url
+        stat = os.stat(path)
+        self.size = stat.st_size
+        self.mtime = stat.st_mtime
+        self._etag = None
+        self._bitrate = None
+
+    def etag(self):
+        if self._etag is None:
+            digest = hashlib.sha1()
+            with open(self.path, "rb") as f:
+                for chunk in iter(lambda: f.read(chunk_bytes), b""):
+                    digest.update(chunk)
+            self._etag = '"%s"' % digest.hexdigest()
+        return self._etag
+
+    def bitrate(self):
+        """
+        Returns the average bits per second of the video, file size over duration
+        """
+        if self._bitrate is None:
+            capture = cv2.VideoCapture(self.path)
+            frames = capture.get(cv2.CAP_PROP_FRAME_COUNT)
+            fps = capture.get(cv2.CAP_PROP_FPS)
+            capture.release()
+            duration = frames / fps if frames > 0 and fps > 0 else 1.0
+            self._bitrate = self.size * 8 / duration
+        return self._bitrate
+
+    def changed(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return True
+        return stat.st_size != self.size or stat.st_mtime != self.mtime
+
+
+class VideoLibrary:
+    """
+    The videos of a directory and their renditions, by name. Files are looked up again when they change on disk
+    """
+    def __init__(self, directory):
+        self.directory = os.path.abspath(directory)
+        self.files = {}  # URL path -> VideoFile
+        self.lock = threading.Lock()
+
+    def get(self, url):
+        """
+        Returns the VideoFile served at a URL path, e.g. /acquire_frame_1.mp4 or /180p/acquire_frame_1.mp4, or None
+        """
+        parts = [part for part in unquote(url).split("/") if part]
+        if not 1 <= len(parts) <= 2 or any(part.startswith(".") for part in parts):
+            return None
+        if len(parts) == 2 and rendition_dir.match(parts[0]) is None:
+            return None
+        path = os.path.join(self.directory, *parts)
+        url = "/" + "/".join(parts)
+
+        with self.lock:
+            video = self.files.get(url)
+            if video is None or video.changed():
+                video = VideoFile(path, url) if os.path.isfile(path) else None
+                if video is None:
+                    self.files.pop(url, None)
+                else:
+                    self.files[url] = video
+            return video
+
+    def renditions(self, name):
+        """
+        Returns the VideoFiles of a video's renditions, including the original, by decreasing bitrate
+        """
+        out = [self.get("/" + name)]
+        for entry in sorted(os.listdir(self.directory)):
+            if rendition_dir.match(entry) and os.path.isdir(os.path.join(self.directory, entry)):
+                out.append(self.get("/%s/%s" % (entry, name)))
+        return sorted([video for video in out if video is not None], key=lambda video: -video.bitrate())
+
+
+class VideoServer(ThreadingMixIn, HTTPServer):
+    """
+    Serves a VideoLibrary, picking renditions by each client's measured throughput
+    """
+    daemon_threads = True
+
+    def __init__(self, directory, host, port, max_age, bandwidth_share):
+        """
+        :param directory: of the videos
+        :param host: address to listen on
+        :param port: to listen on
+        :param max_age: seconds clients may use a cached video without revalidating it
+        :param bandwidth_share: fraction (0 to 1) of a client's measured throughput a rendition's bitrate may take
+        """
+        HTTPServer.__init__(self, (host, port), VideoHandler)
+        self.library = VideoLibrary(directory)
+        self.max_age = max_age
+        self.bandwidth_share = bandwidth_share
+        self.throughput = {}  # client address -> bits per second, smoothed
+        self.lock = threading.Lock()
+
+    def measure(self, connection, client, before, began):
+        """
+        Measure a client's throughput on a response sent to it: the time it took to acknowledge the first measure_bytes
+        of it, or as much as it acknowledged within measure_timeout. Sending returns once the last bytes are in the
+        kernel's send buffer, which can hold much of a video, so the time sending took says little about the client's
+        link. Runs on a thread of its own, so that the connection's next request isn't held up
+        :param connection: socket the response is sent on
+        :param client: address of the client
+        :param before: tcp_acked of the connection before the response was sent
+        :param began: time the response started to be sent
+        """
+        deadline = began + measure_timeout
+        while True:
+            progress = tcp_acked(connection)
+            if progress is None:  # connection closed
+                return
+            acked = progress - before
+            if acked >= measure_bytes or time.time() >= deadline:
+                break
+            time.sleep(measure_poll)
+        self.measured(client, acked, time.time() - began)
+
+    def measured(self, client, sent, seconds):
+        """
+        Update a client's throughput from a response sent to it
+        """
+        if sent < measure_bytes or seconds <= 0:
+            return
+        bps = sent * 8 / seconds
+        with self.lock:
+            last = self.throughput.get(client)
+            self.throughput[client] = bps if last is None else smoothing * bps + (1 - smoothing) * last
+
+    def pick(self, client, name):
+        """
+        Returns the VideoFile of the rendition of a video to send to a client: the largest one whose bitrate fits in
+        its share of the client's throughput, the smallest if none does, the original while the throughput is unknown
+        """
+        with self.lock:
+            throughput = self.throughput.get(client)
+        if throughput is None:
+            return self.library.get("/" + name)
+        renditions = self.library.renditions(name)
+        for video in renditions:
+            if video.bitrate() <= throughput * self.bandwidth_share:
+                return video
+        return renditions[-1] if renditions else None
+
+
+class VideoHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"  # keep-alive, the player makes several range requests per video
+
+    def do_GET(self):
+        self.respond(True)
+
+    def do_HEAD(self):
+        self.respond(False)
+
+    def respond(self, body):
+        url = self.path.split("?")[0]
+        video = self.server.library.get(url)
+        if video is None:
+            self.send_error(404)
+            return
+
+        # a plain video name is redirected to the rendition for this client's link, which has a URL of its own so that
+        # range requests and caching stay on the same file
+        if url.count("/") == 1:
+            rendition = self.server.pick(self.client_address[0], url.lstrip("/"))
+            if rendition is not None and rendition.url != video.url:
+                metrics.increment("video_requests", ("rendition", rendition.url.split("/")[1]))
+                self.send_response(302)
+                self.send_header("Location", rendition.url)
+                self.send_header("Cache-Control", "no-cache")
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            metrics.increment("video_requests", ("rendition", "original"))
+
+        etag = video.etag()
+        if etag in [tag.strip() for tag in self.headers.get("If-None-Match", "").split(",")]:
+            self.send_response(304)
+            self.send_caching_headers(video)
+            self.end_headers()
+            return
+
+        byte_range = None
+        if self.headers.get("If-Range", etag) == etag:
+            byte_range = parse_range(self.headers.get("Range"), video.size)
+        if byte_range == "unsatisfiable":
+            self.send_response(416)
+            self.send_header("Content-Range", "bytes */%d" % video.size)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+
+        if byte_range is None:
+            start, end = 0, video.size - 1
+            self.send_response(200)
+        else:
+            start, end = byte_range
+            self.send_response(206)
+            self.send_header("Content-Range", "bytes %d-%d/%d" % (start, end, video.size))
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start + 1))
+        self.send_header("Accept-Ranges", "bytes")
+        self.send_caching_headers(video)
+        self.end_headers()
+        if body:
+            before = tcp_acked(self.connection)
+            began = time.time()
+            sent = self.send_file(video.path, start, end - start + 1)
+            metrics.increment("video_bytes", amount=sent)
+            if before is not None and sent >= measure_bytes:
+                thread = threading.Thread(target=self.server.measure, name="measure",
+                                          args=(self.connection, self.client_address[0], before, began))
+                thread.daemon = True
+                thread.start()
+
+    def send_caching_headers(self, video):
+        self.send_header("ETag", video.etag())
+        self.send_header("Last-Modified", email.utils.formatdate(video.mtime, usegmt=True))
+        self.send_header("Cache-Control", "public, max-age=%d" % self.server.max_age)
+
+    def send_file(self, path, offset, length):
+        """
+        Send part of a file, with sendfile where available so its contents aren't copied through Python
+        :return: number of bytes sent
+        """
+        self.wfile.flush()
+        sent = 0
+        with open(path, "rb") as f:
+            if hasattr(os, "sendfile"):
+                while sent < length:
+                    count = os.sendfile(self.connection.fileno(), f.fileno(), offset + sent, length - sent)
+                    if count == 0:
+                        break
+                    sent += count
+            else:
+                f.seek(offset)
+                while sent < length:
+                    chunk = f.read(min(chunk_bytes, length - sent))
+                    if not chunk:
+                        break
+                    self.wfile.write(chunk)
+                    sent += len(chunk)
+        return sent
+
+    def log_message(self, *args):
+        pass
+
+
+def tcp_acked(connection):
+    """
+    Returns the bytes of a TCP connection the peer acknowledged so far, from the kernel's TCP_INFO. None where that
+    isn't available (Linux before 4.1, or other systems) or once the connection is closed
+    """
+    if not sys.platform.startswith("linux"):
+        return None
+    try:
+        info = connection.getsockopt(socket.IPPROTO_TCP, getattr(socket, "TCP_INFO", 11), 256)
+    except (socket.error, OSError):
+        return None
+    if len(info) < 128:
+        return None
+    acked, = struct.unpack_from("=Q", info, 120)  # tcpi_bytes_acked of struct tcp_info, linux/tcp.h
+    return acked
+
+
+def parse_range(header, size):
+    """
+    Parse a Range header of a single byte range
+    :return: (first byte, last byte), None to send the whole file (no header, or one that isn't a single byte range),
+             or "unsatisfiable" if the range starts past the end of the file
+    """
+    match = re.match(r"^bytes=(\d*)-(\d*)$", (header or "").strip())
+    if match is None or match.groups() == ("", ""):
+        return None
+    first, last = match.groups()
+    if first == "":  # suffix range, the last bytes of the file
+        length = int(last)
+        if length == 0:
+            return "unsatisfiable"
+        return max(0, size - length), size - 1
+    first = int(first)
+    last = size - 1 if last == "" else min(int(last), size - 1)
+    if first >= size:
+        return "unsatisfiable"
+    if last < first:
+        return None
+    return first, last
+
+
+def serve(directory, host, port, max_age, bandwidth_share):
+    """
+    Start serving the videos of a directory on http://host:port/
+    :return: the VideoServer, serving on a background thread
+    """
+    server = VideoServer(directory, host, port, max_age, bandwidth_share)
+    thread = threading.Thread(target=server.serve_forever, name="videos")
+    thread.daemon = True
+    thread.start()
+    LOG.info("serving videos of %s on http://%s:%d/" % (directory, host, port))
+    return server
+
+
+def generate_renditions(directory, heights):
+    """
+    Write lower resolution and bitrate renditions of every video in a directory into <height>p subdirectories. Uses
+    ffmpeg (H.264, audio kept) if it is installed, otherwise OpenCV (MPEG-4 part 2, without audio). Renditions that
+    don't come out smaller than their original are removed, which is usually all of OpenCV's for the bundled videos,
+    so install ffmpeg to get renditions
+    """
+    names = sorted(name for name in os.listdir(directory) if name.endswith(".mp4"))
+    ffmpeg = find_executable("ffmpeg")
+    if ffmpeg is None:
+        LOG.warning("ffmpeg not found, encoding with OpenCV, whose renditions usually aren't smaller than the originals")
+    for height in heights:
+        out_dir = os.path.join(directory, "%dp" % height)
+        for name in names:
+            src, dst = os.path.join(directory, name), os.path.join(out_dir, name)
+            capture = cv2.VideoCapture(src)
+            width = int(capture.get(cv2.CAP_PROP_FRAME_WIDTH))
+            src_height = int(capture.get(cv2.CAP_PROP_FRAME_HEIGHT))
+            fps = capture.get(cv2.CAP_PROP_FPS) or 30
+            if height >= src_height:
+                capture.release()
+                LOG.info("skipping %s, %dp is not smaller than %dp" % (name, height, src_height))
+                continue
+            if not os.path.isdir(out_dir):
+                os.makedirs(out_dir)
+            size = (int(round(width * float(height) / src_height / 2)) * 2, height)  # even, for the codecs
+            if ffmpeg is not None:
+                capture.release()
+                subprocess.check_call([ffmpeg, "-y", "-loglevel", "error", "-i", src, "-vf", "scale=-2:%d" % height,
+                                       "-c:v", "libx264", "-profile:v", "baseline", "-crf", "28",
+                                       "-movflags", "+faststart", "-c:a", "aac", "-b:a", "64k", dst])
+            else:
+                writer = cv2.VideoWriter(dst, cv2.VideoWriter_fourcc(*"mp4v"), fps, size)
+                while True:
+                    ok, img = capture.read()
+                    if not ok:
+                        break
+                    writer.write(cv2.resize(img, size, interpolation=cv2.INTER_AREA))
+                writer.release()
+                capture.release()
+            if os.path.getsize(dst) >= os.path.getsize(src):
+                os.remove(dst)
+                LOG.info("removed the %dp rendition of %s, it isn't smaller than the original" % (height, name))
+        if os.path.isdir(out_dir) and not os.listdir(out_dir):
+            os.rmdir(out_dir)
+        LOG.info("wrote %dp renditions to %s" % (height, out_dir))
+
+
+def find_executable(name):
+    if hasattr(shutil, "which"):
+        return shutil.which(name)
+    for directory in os.environ.get("PATH", "").split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return path
+    return None
+
+
+if __name__ == "__main__":
+    logging.basicConfig(level=logging.INFO)
+    parser = argparse.ArgumentParser(description="Serve the guidance videos, or generate their renditions")
+    parser.add_argument("--directory", default="resources/videos")
+    parser.add_argument("--port", type=int, default=9095)
+    parser.add_argument("--renditions", type=int, nargs="+", metavar="HEIGHT",
+                        help="generate renditions of these heights instead of serving")
+    args = parser.parse_args()
+    if args.renditions:
+        generate_renditions(args.directory, args.renditions)
+    else:
+        serve(args.directory, "0.0.0.0", args.port, 86400, 0.8)
+        while True:
+            time.sleep(1)